@@ -21,16 +21,25 @@
 
 
 import os
-import importlib
+import sys
+import time
+from dataclasses import replace
+
+# Measures add-on enable time, see register()
+enable_start = time.perf_counter()
+
+if "bpy" in locals():
+    # 'Reload Scripts' from Blender: Drop all loaded submodules, they will be
+    # imported again on first use
+    for module_name in [name for name in sys.modules if name.startswith(__name__ + ".")]:
+        del sys.modules[module_name]
 
 import bpy
 import bpy_extras
 
-from . import nvx2
-from . import import_nvx2
-from . import import_nax
-from . import n3
-from . import import_n3
+# Importer modules (and numpy) are loaded on first use in each operator,
+# only this (standard library) module is needed for registration
+from . import background
 
 
 bl_info = {
@@ -45,20 +54,8 @@ bl_info = {
     "category": "Import-Export"}
 
 
-def reload_package():
-    """Enables reloading the entire add-on with 'Reload Scripts' from Blender"""
-    importlib.reload(nvx2)
-    importlib.reload(import_nvx2)
-    importlib.reload(n3)
-    importlib.reload(import_n3)
-    importlib.reload(import_nax)
-
-
-if "bpy" in locals():
-    reload_package()
-
-
-class ImportNVX2(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
+class ImportNVX2(background.BackgroundImport, bpy.types.Operator,
+                 bpy_extras.io_utils.ImportHelper):
     """Load a Nebula NVX2 File"""
     bl_idname = "import_scene.nvx2"
     bl_label = "Import NVX2"
@@ -82,6 +79,18 @@ class ImportNVX2(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
             name="Use Smooth",
             description="Sets all polygons to smooth",
             default=False)
+    use_single_mesh : bpy.props.BoolProperty(
+            name="Single Mesh",
+            description="Creates one mesh for the whole file with one material slot per group",
+            default=False)
+    use_weld_vertices : bpy.props.BoolProperty(
+            name="Weld Vertices",
+            description="Merges vertices split at uv and normal seams",
+            default=False)
+    weld_distance : bpy.props.FloatProperty(
+            name="Weld Distance",
+            description="Merge vertices closer than this, 0 to only merge identical positions",
+            default=0.0, min=0.0, precision=5)
     create_parent_empty : bpy.props.BoolProperty(
             name="Create Parent Empty",
             description="Creates an empty to which all imported objects will be parented to",
@@ -98,36 +107,139 @@ class ImportNVX2(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
             name="Create Vertex Colors",
             description="Creates colors weights",
             default=False)
+    use_background : bpy.props.BoolProperty(
+            name="Background Import",
+            description="Keeps the UI responsive and shows progress, ESC cancels",
+            default=False)
+    num_threads : bpy.props.IntProperty(
+            name="Decode Threads",
+            description="Threads used to decode large files, 0 to use one per CPU",
+            default=1, min=0, max=64)
+
+    def make_options(self, filepath):
+        """Create nvx2 options for a single file"""
+        from . import nvx2
 
-    def import_file(self, context, filepath):
-        """Imports a single nvx2 file"""
         options = nvx2.Options()
         options.use_smooth = self.use_smooth
+        options.use_single_mesh = self.use_single_mesh
+        options.use_weld_vertices = self.use_weld_vertices
+        options.weld_distance = self.weld_distance
         options.create_parent_empty  = self.create_parent_empty
         options.create_uvs  = self.create_uvs
         options.create_weights  = self.create_weights
         options.create_colors = self.create_colors
+        options.num_threads = self.num_threads
 
         options.nvx2filepath = filepath
         options.nvx2version = int(self.nvx2_version)
+        return options
+
+    def import_file(self, context, filepath, collection=None):
+        """Imports a single nvx2 file"""
+        from . import import_nvx2
 
-        return import_nvx2.load(context, self, options)
+        return import_nvx2.load(context, self, self.make_options(filepath), collection)
 
     def execute(self, context):
-        # Multiple file import
+        from . import import_nvx2
+
+        if self.use_background:
+            filepaths = [self.filepath]
+            if self.files:
+                dirname = os.path.dirname(self.filepath)
+                filepaths = [os.path.join(dirname, file.name) for file in self.files]
+            # Objects are linked to the scene once the job is done
+            import_collection = import_nvx2.ImportCollection("nvx2_import")
+            tasks = [import_nvx2.load_background_task(self.make_options(path),
+                                                      import_collection.collection)
+                     for path in filepaths]
+            return self.start_background(context, tasks, import_collection.link)
+
+        # Multiple file import, objects are linked to the scene once at the end
         if self.files:
             ret = {'CANCELLED'}
+            import_collection = import_nvx2.ImportCollection("nvx2_import")
             dirname = os.path.dirname(self.filepath)
             for file in self.files:
                 path = os.path.join(dirname, file.name)
-                if self.import_file(context, path) == {'FINISHED'}:
+                if self.import_file(context, path, import_collection.collection) == {'FINISHED'}:
                     ret = {'FINISHED'}
+            self.report({'INFO'}, import_collection.link(context))
             return ret
 
         # Single file import
         return self.import_file(context, self.filepath)
 
 
+class ExportNVX2(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
+    """Save a Nebula NVX2 File"""
+    bl_idname = "export_scene.nvx2"
+    bl_label = "Export NVX2"
+
+    filename_ext = ".nvx2"
+    filter_glob : bpy.props.StringProperty(default="*.nvx2", options={'HIDDEN'})
+
+    nvx2_version : bpy.props.EnumProperty(
+            name="Engine Version",
+            description="Nebula version to write the file for",
+            items=(('2', "Nebula 2", "", 2),
+                   ('3', "Nebula 3", "", 3)),
+            default='3')
+    use_selection : bpy.props.BoolProperty(
+            name="Selection Only",
+            description="Only export selected meshes, one group per object",
+            default=True)
+    export_normals : bpy.props.BoolProperty(
+            name="Export Normals",
+            description="Exports (split) normals",
+            default=True)
+    export_uvs : bpy.props.BoolProperty(
+            name="Export UV maps",
+            description="Exports up to 4 uv maps",
+            default=True)
+    export_colors : bpy.props.BoolProperty(
+            name="Export Vertex Colors",
+            description="Exports the active color attribute",
+            default=False)
+    export_weights : bpy.props.BoolProperty(
+            name="Export Vertex Weights",
+            description="Exports weights of vertex groups named after joints",
+            default=True)
+    use_compact : bpy.props.BoolProperty(
+            name="Compact Vertices",
+            description="Stores uvs as shorts, normals, colors and weights as bytes (Nebula 3 only)",
+            default=False)
+    optimize_vertex_cache : bpy.props.BoolProperty(
+            name="Optimize Vertex Cache",
+            description="Reorders triangles and vertices of each group for faster rendering",
+            default=False)
+    byteorder : bpy.props.EnumProperty(
+            name="Byte Order",
+            description="Platform the file is written for",
+            items=(('<', "Little Endian", "PC", 0),
+                   ('>', "Big Endian", "Consoles like PS3 and Xbox 360", 1)),
+            default='<')
+
+    def execute(self, context):
+        from . import nvx2
+        from . import export_nvx2
+
+        options = nvx2.ExportOptions()
+        options.nvx2version = int(self.nvx2_version)
+        options.use_selection = self.use_selection
+        options.export_normals = self.export_normals
+        options.export_uvs = self.export_uvs
+        options.export_colors = self.export_colors
+        options.export_weights = self.export_weights
+        options.use_compact = self.use_compact
+        options.optimize_vertex_cache = self.optimize_vertex_cache
+        options.byteorder = self.byteorder
+        options.nvx2filepath = self.filepath
+
+        return export_nvx2.save(context, self, options)
+
+
 class ImportNAX(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
     """Load a Nebula NAX2 File"""
     bl_idname = "import_scene.nax"
@@ -136,16 +248,38 @@ class ImportNAX(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
 
     filename_ext = ".nax2"
     filter_glob : bpy.props.StringProperty(
-            default="*.nax2",
+            default="*.nax2;*.nax3",
             options={'HIDDEN'})
 
+    clip_names : bpy.props.StringProperty(
+            name="Clips",
+            description="Comma separated list of nax3 clips to import, imports all if empty",
+            default="")
+    reduce_keys : bpy.props.BoolProperty(
+            name="Reduce Keys",
+            description="Remove keys which can be reproduced by interpolation",
+            default=True)
+    reduce_tolerance : bpy.props.FloatProperty(
+            name="Tolerance",
+            description="Maximum error allowed when removing keys",
+            default=0.0001, min=0.0, precision=5)
+
     def execute(self, context):
-        options = import_nax.default_options
+        from . import import_nax
+
+        options = dict(import_nax.default_options)
+        # Curves are applied to the bones of the selected armature
+        options["target_object"] = context.active_object
+        if self.clip_names:
+            options["clip_names"] = [cn.strip() for cn in self.clip_names.split(',')]
+        options["reduce_keys"] = self.reduce_keys
+        options["reduce_tolerance"] = self.reduce_tolerance
 
-        return import_nax.load(context, options, self.filepath)
+        return import_nax.load(context, self, options, self.filepath)
 
 
-class ImportN3(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
+class ImportN3(background.BackgroundImport, bpy.types.Operator,
+               bpy_extras.io_utils.ImportHelper):
     """Load a Nebula N3 File"""
     bl_idname = "import_scene.n3"
     bl_label = "Import N3"
@@ -155,6 +289,10 @@ class ImportN3(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
     filter_glob : bpy.props.StringProperty(
             default="*.n3",
             options={'HIDDEN'})
+    files: bpy.props.CollectionProperty(
+        name='File Path',
+        description='Path used for importing the file',
+        type=bpy.types.OperatorFileListElement)
 
     ignore_version : bpy.props.BoolProperty(
             name="Ignore Version",
@@ -176,47 +314,297 @@ class ImportN3(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
             name="Image Search",
             description="Searches subdirs for any associated images (Warning, may be slow)",
             default=False)
+    texture_budget : bpy.props.IntProperty(
+            name="Texture Memory (MB)",
+            description="Unload least recently used textures above this memory, 0 is unlimited",
+            default=0, min=0)
     import_meshes : bpy.props.BoolProperty(
             name="Import Meshes",
             description="Atempt to import nvx2 meshes from references",
             default=True)
+    lod_policy : bpy.props.EnumProperty(
+            name="LOD",
+            description="Which level of detail branches to import",
+            items=(('ALL', "All", "Import all levels of detail", 0),
+                   ('HIGHEST', "Highest", "Import highest level of detail only", 1),
+                   ('LOWEST', "Lowest", "Import lowest level of detail only", 2),
+                   ('DISTANCE', "Distance", "Import level of detail visible at LOD distance", 3)),
+            default='ALL')
+    lod_distance : bpy.props.FloatProperty(
+            name="LOD Distance",
+            description="Viewing distance used to select the level of detail",
+            default=0.0, min=0.0)
+    use_proxies : bpy.props.BoolProperty(
+            name="Bounding Box Proxies",
+            description="Only create boxes for meshes, load them later with 'Load N3 Proxy Meshes'",
+            default=False)
+    use_instancing : bpy.props.BoolProperty(
+            name="Instance Shared Meshes",
+            description="Load meshes used by several files once and place collection instances",
+            default=True)
+    use_background : bpy.props.BoolProperty(
+            name="Background Import",
+            description="Keeps the UI responsive and shows progress, ESC cancels",
+            default=False)
 
     def execute(self, context):
-        options = n3.Options
+        from . import n3
+        from . import import_n3
+        from . import import_nvx2
+
+        options = n3.Options()
         options.ignore_version = self.ignore_version
         options.create_armatures = self.create_armatures
         options.create_materials = self.create_materials
         options.import_meshes = self.import_meshes
         options.reuse_materials = self.reuse_materials
         options.use_image_search = self.use_image_search
+        options.texture_budget = self.texture_budget
+        options.use_proxies = self.use_proxies
+        options.lod_policy = self.lod_policy
+        options.lod_distance = self.lod_distance
 
         options.n3filepath = self.filepath
 
+        filepaths = [self.filepath]
+        if self.files:
+            dirname = os.path.dirname(self.filepath)
+            filepaths = [os.path.join(dirname, file.name) for file in self.files]
+
+        if self.use_background:
+            # Objects are linked to the scene once the job is done
+            import_collection = import_nvx2.ImportCollection("n3_import")
+            # A single bounded pool reads the meshes and textures of all files
+            executor = import_n3.make_prefetch_executor()
+            tasks = [import_n3.load_background_task(replace(options, n3filepath=path),
+                                                    import_collection.collection, executor)
+                     for path in filepaths]
+            return self.start_background(context, tasks, import_collection.link, [executor])
+
+        # Multiple file import, objects are linked to the scene once at the end
+        if len(filepaths) > 1:
+            if self.use_instancing and not self.use_proxies:
+                return import_n3.load_batch(context, self, options, filepaths)
+            ret = {'CANCELLED'}
+            import_collection = import_nvx2.ImportCollection("n3_import")
+            for path in filepaths:
+                if import_n3.load(context, self, replace(options, n3filepath=path),
+                                  import_collection.collection) == {'FINISHED'}:
+                    ret = {'FINISHED'}
+            self.report({'INFO'}, import_collection.link(context))
+            return ret
+
+        # Single file import
         return import_n3.load(context, self, options)
 
 
+class LoadN3Proxies(bpy.types.Operator):
+    """Load the nvx2 meshes of the selected n3 proxies"""
+    bl_idname = "import_scene.n3_load_proxies"
+    bl_label = "Load N3 Proxy Meshes"
+    bl_options = {'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return any("n3_mesh_ressource_id" in obj for obj in context.selected_objects)
+
+    def execute(self, context):
+        from . import import_n3
+
+        ret = {'CANCELLED'}
+        for obj in context.selected_objects:
+            if "n3_mesh_ressource_id" in obj:
+                if import_n3.load_proxy(context, self, obj) == {'FINISHED'}:
+                    ret = {'FINISHED'}
+        return ret
+
+
+class ReloadNVX2(bpy.types.Operator):
+    """Reload meshes whose nvx2 file changed since it was imported"""
+    bl_idname = "import_scene.nvx2_reload"
+    bl_label = "Reload Changed NVX2 Meshes"
+    bl_options = {'UNDO'}
+
+    def execute(self, context):
+        from . import import_nvx2
+
+        import_nvx2.reload_changed_files()
+        return {'FINISHED'}
+
+
+class WatchNVX2(bpy.types.Operator):
+    """Toggle watching imported nvx2 files and reloading them when changed"""
+    bl_idname = "import_scene.nvx2_watch"
+    bl_label = "Watch NVX2 Files"
+
+    def execute(self, context):
+        from . import import_nvx2
+
+        if bpy.app.timers.is_registered(import_nvx2.watch_timer):
+            bpy.app.timers.unregister(import_nvx2.watch_timer)
+            self.report({'INFO'}, "Stopped watching nvx2 files")
+        else:
+            bpy.app.timers.register(import_nvx2.watch_timer, persistent=True)
+            self.report({'INFO'}, "Watching nvx2 files for changes")
+        return {'FINISHED'}
+
+
+def get_catalog():
+    """Open the project catalog, stored in blender's user config directory."""
+    from . import catalog
+
+    catalog_dir = bpy.utils.user_resource('CONFIG', path="nvx2loader", create=True)
+    return catalog.Catalog(os.path.join(catalog_dir, "catalog.sqlite"))
+
+
+# Results for the last search text, only shown (not queried) when drawing
+catalog_search = {"text": None, "results": []}
+
+
+def update_catalog_search(scene, context):
+    """Query the catalog when the search text changes, see VIEW3D_PT_nebula_catalog."""
+    results = []
+    if scene.nebula_catalog_search:
+        project_catalog = get_catalog()
+        try:
+            results = project_catalog.search(scene.nebula_catalog_search,
+                                             VIEW3D_PT_nebula_catalog.max_results)
+        finally:
+            project_catalog.close()
+    catalog_search["text"] = scene.nebula_catalog_search
+    catalog_search["results"] = results
+
+
+class ScanNebulaCatalog(bpy.types.Operator):
+    """Index all nvx2, n3 and nax files of the project, only changed files are read"""
+    bl_idname = "import_scene.nebula_catalog_scan"
+    bl_label = "Scan Project"
+
+    @classmethod
+    def poll(cls, context):
+        return os.path.isdir(bpy.path.abspath(context.scene.nebula_catalog_root))
+
+    def execute(self, context):
+        project_catalog = get_catalog()
+        try:
+            num_scanned, num_removed = \
+                project_catalog.scan(bpy.path.abspath(context.scene.nebula_catalog_root))
+            num_errors = len(project_catalog.get_errors())
+        finally:
+            project_catalog.close()
+        update_catalog_search(context.scene, context)
+        self.report({'INFO'}, "Indexed " + str(num_scanned) + " files, removed " +
+                    str(num_removed) + ", " + str(num_errors) + " unreadable")
+        return {'FINISHED'}
+
+
+class VIEW3D_PT_nebula_catalog(bpy.types.Panel):
+    """Search the project catalog"""
+    bl_label = "Nebula Catalog"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = "Nebula"
+
+    max_results = 50
+
+    def draw(self, context):
+        layout = self.layout
+        scene = context.scene
+        layout.prop(scene, "nebula_catalog_root")
+        layout.operator(ScanNebulaCatalog.bl_idname)
+        layout.prop(scene, "nebula_catalog_search", icon='VIEWZOOM')
+        if not scene.nebula_catalog_search:
+            return
+        if catalog_search["text"] != scene.nebula_catalog_search:
+            # e.g. after loading a blend file, queries only run on updates
+            layout.label(text="Edit the search or scan to show results")
+            return
+
+        results = catalog_search["results"]
+        import_ops = {'nvx2': ImportNVX2.bl_idname, 'n3': ImportN3.bl_idname}
+
+        col = layout.column(align=True)
+        col.operator_context = 'EXEC_DEFAULT'
+        for result in results:
+            row = col.row(align=True)
+            row.label(text=result.kind + ": " + result.name)
+            if result.file_type in import_ops:
+                op = row.operator(import_ops[result.file_type], text="", icon='IMPORT')
+                op.filepath = result.path
+        if not results:
+            col.label(text="Nothing found")
+
+
 def menu_func_import(self, context):
     """Add menu functions for importing nebula files."""
     self.layout.operator(ImportNVX2.bl_idname, text="Nebula mesh (.nvx2)")
-    #self.layout.operator(ImportNAX.bl_idname, text="Nebula animation (.nax2, .nax3)")
+    self.layout.operator(ImportNAX.bl_idname, text="Nebula animation (.nax2, .nax3)")
     self.layout.operator(ImportN3.bl_idname, text="Nebula model (.n3)")
 
 
+def menu_func_export(self, context):
+    """Add menu functions for exporting nebula files."""
+    self.layout.operator(ExportNVX2.bl_idname, text="Nebula mesh (.nvx2)")
+
+
+def menu_func_object(self, context):
+    """Add menu functions for loading proxies and reloading meshes."""
+    self.layout.operator(LoadN3Proxies.bl_idname)
+    self.layout.operator(ReloadNVX2.bl_idname)
+    self.layout.operator(WatchNVX2.bl_idname)
+
+
 def register():
     """Register all operators and menu entries."""
     bpy.utils.register_class(ImportNVX2)
-    #bpy.utils.register_class(ImportNAX)
+    bpy.utils.register_class(ExportNVX2)
+    bpy.utils.register_class(ImportNAX)
     bpy.utils.register_class(ImportN3)
+    bpy.utils.register_class(LoadN3Proxies)
+    bpy.utils.register_class(ReloadNVX2)
+    bpy.utils.register_class(WatchNVX2)
+    bpy.utils.register_class(ScanNebulaCatalog)
+    bpy.utils.register_class(VIEW3D_PT_nebula_catalog)
+
+    bpy.types.Scene.nebula_catalog_root = bpy.props.StringProperty(
+            name="Project Root",
+            description="Root directory of the Nebula project to index",
+            subtype='DIR_PATH')
+    bpy.types.Scene.nebula_catalog_search = bpy.props.StringProperty(
+            name="Search",
+            description="Search node names, resource ids, clip names and file paths",
+            options={'TEXTEDIT_UPDATE'},
+            update=update_catalog_search)
 
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
+    bpy.types.TOPBAR_MT_file_export.append(menu_func_export)
+    bpy.types.VIEW3D_MT_object.append(menu_func_object)
+
+    print("nvx2loader enabled in " +
+          format((time.perf_counter() - enable_start) * 1000.0, ".1f") + " ms")
 
 
 def unregister():
     """Unregister all operators and menu entries."""
+    bpy.types.VIEW3D_MT_object.remove(menu_func_object)
+    bpy.types.TOPBAR_MT_file_export.remove(menu_func_export)
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
 
+    # Only loaded (and possibly watching) if it was used
+    import_nvx2 = sys.modules.get(__name__ + ".import_nvx2")
+    if import_nvx2 and bpy.app.timers.is_registered(import_nvx2.watch_timer):
+        bpy.app.timers.unregister(import_nvx2.watch_timer)
+    del bpy.types.Scene.nebula_catalog_search
+    del bpy.types.Scene.nebula_catalog_root
+
+    bpy.utils.unregister_class(VIEW3D_PT_nebula_catalog)
+    bpy.utils.unregister_class(ScanNebulaCatalog)
+    bpy.utils.unregister_class(WatchNVX2)
+    bpy.utils.unregister_class(ReloadNVX2)
+    bpy.utils.unregister_class(LoadN3Proxies)
     bpy.utils.unregister_class(ImportN3)
-    #bpy.utils.unregister_class(ImportNAX)
+    bpy.utils.unregister_class(ImportNAX)
+    bpy.utils.unregister_class(ExportNVX2)
     bpy.utils.unregister_class(ImportNVX2)
 
 
@@ -0,0 +1,171 @@
+"""Run imports in the background without blocking blender's UI"""
+
+import concurrent.futures
+import threading
+import time
+
+
+class ReportCollector:
+    """Stand-in for an operator, collects reports from worker threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reports = []
+
+
+    def report(self, rep_type, rep_msg):
+        """Store a report, can be called from any thread."""
+        with self.lock:
+            self.reports.append((rep_type, rep_msg))
+
+
+    def flush(self, operator):
+        """Send all stored reports from the operator (main thread only)."""
+        with self.lock:
+            reports, self.reports = self.reports, []
+        for rep_type, rep_msg in reports:
+            operator.report(rep_type, rep_msg)
+
+
+class ImportJob:
+    """Read files on a thread pool, create blender data on the main thread.
+
+    Each task is a pair (read, create). read(reporter) runs on a worker thread
+    and must not touch blender data. create(context, reporter, result) runs on
+    the main thread and returns a generator, which is advanced in time slices.
+    Pools the tasks share for reading, e.g. for prefetching, can be passed as
+    shared_executors, they are shut down with the job.
+    """
+
+    def __init__(self, tasks, max_workers=None, shared_executors=()):
+        self.reporter = ReportCollector()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.shared_executors = list(shared_executors)
+        self.pending = [(self.executor.submit(read, self.reporter), create)
+                        for read, create in tasks]
+        self.num_tasks = len(tasks)
+        self.num_done = 0
+        self.num_created = 0
+        self.current = None
+
+
+    def step(self, context, time_budget):
+        """Advance the job for at most time_budget seconds, returns True when done."""
+        deadline = time.perf_counter() + time_budget
+        while time.perf_counter() < deadline:
+            if not self.current:
+                if not self.pending:
+                    break
+                # Keep the order of the tasks, wait for the next one to be read
+                future, create = self.pending[0]
+                if not future.done():
+                    return False
+                self.pending.pop(0)
+                try:
+                    self.current = create(context, self.reporter, future.result())
+                except Exception as e:  # Don't let a single file stop the whole job
+                    self.reporter.report({'ERROR'}, str(e) or type(e).__name__)
+                    self.num_done += 1
+                    continue
+            try:
+                next(self.current)
+                self.num_created += 1
+            except StopIteration:
+                self.current = None
+                self.num_done += 1
+            except Exception as e:  # Keep what was created so far, go on with the next task
+                self.reporter.report({'ERROR'}, str(e) or type(e).__name__)
+                self.current = None
+                self.num_done += 1
+        if self.is_done():
+            self.executor.shutdown(wait=False)
+            for executor in self.shared_executors:
+                executor.shutdown(wait=False)
+            return True
+        return False
+
+
+    def is_done(self):
+        """All tasks read and created."""
+        return not self.pending and not self.current
+
+
+    def cancel(self):
+        """Stop reading, already created blender data is kept."""
+        self.pending = []
+        if self.current:
+            # Runs the generator's cleanup, e.g. stops its prefetching
+            self.current.close()
+        self.current = None
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for executor in self.shared_executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class BackgroundImport:
+    """Mixin for import operators, runs an ImportJob from a modal timer."""
+
+    # Seconds per timer event spent creating blender data
+    time_budget = 0.05
+
+    def start_background(self, context, tasks, finish=None, shared_executors=()):
+        """Start the import job, return value is meant to be returned from execute().
+
+        finish(context) is called once the job is done or cancelled, it may
+        return a summary to report. shared_executors are passed to ImportJob.
+        """
+        self._job = ImportJob(tasks, shared_executors=shared_executors)
+        self._finish = finish
+        self._start_time = time.perf_counter()
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0, self._job.num_tasks)
+        return {'RUNNING_MODAL'}
+
+
+    def finish_background(self, context):
+        """Remove timer and progress bar, call the finish function."""
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+        if self._finish:
+            summary = self._finish(context)
+            if summary:
+                self.report({'INFO'}, summary)
+
+
+    def modal(self, context, event):
+        """Advance the import job on timer events, cancel on ESC."""
+        if event.type == 'ESC':
+            self._job.cancel()
+            self._job.reporter.flush(self)
+            self.finish_background(context)
+            self.report({'WARNING'}, "Import cancelled.")
+            # Already created data is kept, finish to get a single undo step for it
+            return {'FINISHED'}
+
+        if event.type == 'TIMER':
+            try:
+                done = self._job.step(context, self.time_budget)
+            except Exception as e:
+                # Always remove the timer and progress and link what was created
+                self._job.cancel()
+                self._job.reporter.flush(self)
+                self.finish_background(context)
+                self.report({'ERROR'}, "Import failed: " + (str(e) or type(e).__name__))
+                return {'FINISHED'}
+            self._job.reporter.flush(self)
+            context.window_manager.progress_update(self._job.num_done)
+            context.workspace.status_text_set(
+                "Importing file " + str(min(self._job.num_done + 1, self._job.num_tasks)) +
+                " of " + str(self._job.num_tasks) + ", processed " +
+                str(self._job.num_created) + " items (ESC to cancel)")
+            if done:
+                self.finish_background(context)
+                self.report({'INFO'}, "Import finished in " +
+                            "{:.2f}".format(time.perf_counter() - self._start_time) + "s")
+                return {'FINISHED'}
+
+        return {'PASS_THROUGH'}
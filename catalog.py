@@ -0,0 +1,236 @@
+"""Index the nvx2, n3 and nax files of a Nebula project in a SQLite database"""
+
+import collections
+import concurrent.futures
+import os
+import sqlite3
+import struct
+
+from . import background
+from . import n3
+from . import nax2
+from . import nax3
+from . import nvx2
+
+
+FILE_TYPES = {'.nvx2': 'nvx2', '.n3': 'n3', '.nax2': 'nax2', '.nax3': 'nax3'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, type TEXT,
+                                  mtime_ns INTEGER, size INTEGER, error TEXT);
+CREATE TABLE IF NOT EXISTS nvx2 (path TEXT PRIMARY KEY, num_vertices INTEGER,
+                                 num_groups INTEGER, vertex_components INTEGER);
+CREATE TABLE IF NOT EXISTS n3_nodes (path TEXT, node_name TEXT, node_type TEXT);
+CREATE TABLE IF NOT EXISTS n3_resources (path TEXT, node_name TEXT,
+                                         kind TEXT, resource_id TEXT);
+CREATE TABLE IF NOT EXISTS nax_clips (path TEXT, clip_name TEXT, num_keys INTEGER);
+CREATE INDEX IF NOT EXISTS n3_nodes_path ON n3_nodes (path);
+CREATE INDEX IF NOT EXISTS n3_resources_path ON n3_resources (path);
+CREATE INDEX IF NOT EXISTS n3_resources_id ON n3_resources (resource_id);
+CREATE INDEX IF NOT EXISTS nax_clips_path ON nax_clips (path);
+"""
+
+# Tables holding per file data, cleared before a file is re-indexed
+DATA_TABLES = ('nvx2', 'n3_nodes', 'n3_resources', 'nax_clips')
+
+# Result of scanning a single file, rows per data table
+ScanResult = collections.namedtuple('ScanResult', 'path \
+                                                   file_type \
+                                                   mtime_ns \
+                                                   size \
+                                                   error \
+                                                   rows')
+
+SearchResult = collections.namedtuple('SearchResult', 'path \
+                                                       file_type \
+                                                       kind \
+                                                       name')
+
+
+def scan_nvx2(filepath):
+    """Read the header of an nvx2 file."""
+    with open(filepath, mode='rb') as f:
+        header, _ = nvx2.read_header(f)
+    return {'nvx2': [(filepath, header.num_vertices, header.num_groups,
+                      header.vertex_components)]}
+
+
+def scan_n3(filepath):
+    """Read node names and referenced resources of an n3 file."""
+    reporter = background.ReportCollector()
+    # Quiet, all tags but the resources are skipped
+    parser = n3.Parser(reporter, n3.Options(), skip_payload=True, keep_resources=True)
+    if not parser.parse_file(filepath):
+        raise ValueError("; ".join(rep_msg for _, rep_msg in reporter.reports))
+
+    nodes = []
+    resources = []
+    for node in parser.n3node_list:
+        nodes.append((filepath, node.node_name, node.node_type))
+        node_resources = [('mesh', node.mesh_ressource_id),
+                          ('anim', node.anim_ressource_id),
+                          ('variation', node.variation_ressource_id)]
+        node_resources.extend(('texture', tex_name)
+                              for tex_name in node.shader_textures.values())
+        resources.extend((filepath, node.node_name, kind, res_id)
+                         for kind, res_id in node_resources if res_id)
+    return {'n3_nodes': nodes, 'n3_resources': resources}
+
+
+def scan_nax2(filepath):
+    """Read the groups of a nax2 file, these don't have names."""
+    with open(filepath, mode='rb') as f:
+        header = nax2.Header._make(struct.unpack('<4s2i', f.read(12)))
+        groups = [nax2.Group._make(struct.unpack(nax2.GROUP_FMT, f.read(nax2.GROUP_SIZE)))
+                  for i in range(header.num_groups)]
+    return {'nax_clips': [(filepath, 'group_' + str(i), g.num_keys)
+                          for i, g in enumerate(groups)]}
+
+
+def scan_nax3(filepath):
+    """Read the clip names and key counts of a nax3 file."""
+    with open(filepath, mode='rb') as f:
+        _, _, clip_table = nax3.build_clip_table(f)
+    return {'nax_clips': [(filepath, clip_name, entry.clip.num_keys)
+                          for clip_name, entry in clip_table.items()]}
+
+
+SCANNERS = {'nvx2': scan_nvx2, 'n3': scan_n3, 'nax2': scan_nax2, 'nax3': scan_nax3}
+
+
+def scan_file(filepath, file_type, mtime_ns, size):
+    """Scan a single file, runs on a worker thread."""
+    try:
+        rows = SCANNERS[file_type](filepath)
+        error = None
+    except (OSError, ValueError, struct.error) as e:
+        rows = {}
+        error = str(e) or type(e).__name__
+    return ScanResult(filepath, file_type, mtime_ns, size, error, rows)
+
+
+def find_files(root):
+    """Yield (path, file type, mtime_ns, size) of all indexable files below root."""
+    dirs = [root]
+    while dirs:
+        try:
+            entries = list(os.scandir(dirs.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+                continue
+            file_type = FILE_TYPES.get(os.path.splitext(entry.name)[1].lower())
+            if file_type:
+                stat = entry.stat()
+                yield entry.path, file_type, stat.st_mtime_ns, stat.st_size
+
+
+class Catalog:
+    """SQLite index of a Nebula project, must only be used from a single thread."""
+
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(SCHEMA)
+
+
+    def close(self):
+        """Close the database."""
+        self.db.close()
+
+
+    def scan(self, root, max_workers=None):
+        """Index all files below root, only files changed since the last scan are read.
+
+        Returns the number of (re-)indexed and removed files.
+        """
+        root = os.path.abspath(root)
+        known = {path: (mtime_ns, size) for path, mtime_ns, size in
+                 self.db.execute("SELECT path, mtime_ns, size FROM files "
+                                 "WHERE path LIKE ? ESCAPE '\\'",
+                                 (self.escape(os.path.join(root, '')) + '%',))}
+
+        changed = []
+        for path, file_type, mtime_ns, size in find_files(root):
+            if known.pop(path, None) != (mtime_ns, size):
+                changed.append((path, file_type, mtime_ns, size))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(lambda args: scan_file(*args), changed))
+
+        # Files still in known have been deleted
+        with self.db:
+            for path in known:
+                self.remove_file(path)
+            for result in results:
+                self.remove_file(result.path)
+                self.db.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                                (result.path, result.file_type, result.mtime_ns,
+                                 result.size, result.error))
+                for table, rows in result.rows.items():
+                    if rows:
+                        placeholders = ", ".join("?" * len(rows[0]))
+                        self.db.executemany("INSERT INTO " + table +
+                                            " VALUES (" + placeholders + ")", rows)
+        return len(results), len(known)
+
+
+    def remove_file(self, path):
+        """Remove a file and its data from the index."""
+        self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+        for table in DATA_TABLES:
+            self.db.execute("DELETE FROM " + table + " WHERE path = ?", (path,))
+
+
+    @staticmethod
+    def escape(text):
+        """Escape wildcards for LIKE patterns."""
+        return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+    def search(self, text, limit=100):
+        """Find files, nodes, resources and clips containing text."""
+        pattern = '%' + self.escape(text) + '%'
+        query = """
+            SELECT path, type, 'file', path FROM files WHERE path LIKE :p ESCAPE '\\'
+            UNION ALL
+            SELECT path, 'n3', 'node', node_name FROM n3_nodes
+                WHERE node_name LIKE :p ESCAPE '\\'
+            UNION ALL
+            SELECT DISTINCT path, 'n3', kind, resource_id FROM n3_resources
+                WHERE resource_id LIKE :p ESCAPE '\\'
+            UNION ALL
+            SELECT nax_clips.path, files.type, 'clip', clip_name FROM nax_clips
+                JOIN files ON files.path = nax_clips.path
+                WHERE clip_name LIKE :p ESCAPE '\\'
+            LIMIT :limit"""
+        return [SearchResult._make(row)
+                for row in self.db.execute(query, {'p': pattern, 'limit': limit})]
+
+
+    def find_users(self, resource_id, kind=None):
+        """Return the n3 files referencing a resource, e.g. a mesh or texture.
+
+        Resource ids are matched by suffix, so both 'msh:foo/bar.nvx2' and
+        'bar.nvx2' will find the models using that mesh.
+        """
+        query = ("SELECT DISTINCT path FROM n3_resources "
+                 "WHERE resource_id LIKE ? ESCAPE '\\'")
+        params = ['%' + self.escape(resource_id)]
+        if kind:
+            query += " AND kind = ?"
+            params.append(kind)
+        return [row[0] for row in self.db.execute(query, params)]
+
+
+    def get_nvx2_info(self, path):
+        """Return (num_vertices, num_groups, vertex_components) of an indexed nvx2 file."""
+        return self.db.execute("SELECT num_vertices, num_groups, vertex_components "
+                               "FROM nvx2 WHERE path = ?", (path,)).fetchone()
+
+
+    def get_errors(self):
+        """Return (path, error) of all files which could not be read."""
+        return self.db.execute("SELECT path, error FROM files "
+                               "WHERE error IS NOT NULL").fetchall()
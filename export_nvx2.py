@@ -0,0 +1,222 @@
+"""Library to export nvx2 model files"""
+
+import numpy as np
+
+from . import import_n3
+from . import nvx2
+from . import vertex_cache
+
+
+def get_group_joints(blen_object):
+    """Map vertex group indices to joint indices, -1 for groups which aren't joints.
+
+    Joints are the bones of the armature (with the joint index stored on
+    import, see import_n3.get_joint_bones()) or, without an armature, groups
+    named 'nvx2_<joint index>'.
+    """
+    bone_indices = {}
+    armature_object = blen_object.find_armature()
+    if armature_object:
+        bone_indices = {bone.name: joint_idx for joint_idx, bone
+                        in import_n3.get_joint_bones(armature_object).items()}
+
+    group_joints = np.full(len(blen_object.vertex_groups), -1, dtype=np.int32)
+    for vg in blen_object.vertex_groups:
+        if vg.name in bone_indices:
+            group_joints[vg.index] = bone_indices[vg.name]
+        elif vg.name.startswith("nvx2_") and vg.name[5:].isdigit():
+            group_joints[vg.index] = int(vg.name[5:])
+    return group_joints
+
+
+def get_vertex_weights(blen_mesh, group_joints):
+    """Return the 4 strongest (normalized) joint weights and their joint indices per vertex."""
+    num_vertices = len(blen_mesh.vertices)
+    weights = np.zeros((num_vertices, 4), dtype=np.float32)
+    joints = np.zeros((num_vertices, 4), dtype=np.int32)
+    # There is no bulk access to vertex group weights, this is the only per vertex loop
+    vertex_groups = np.array([(v.index, g.group, g.weight)
+                              for v in blen_mesh.vertices for g in v.groups],
+                             dtype=np.float64).reshape(-1, 3)
+    vg_vertices = vertex_groups[:, 0].astype(np.int64)
+    vg_groups = vertex_groups[:, 1].astype(np.int64)
+    vg_weights = vertex_groups[:, 2]
+    # Only groups mapped to joints
+    is_joint = vg_groups < len(group_joints)
+    is_joint[is_joint] = group_joints[vg_groups[is_joint]] >= 0
+    is_joint &= vg_weights > 0.0
+    vg_vertices = vg_vertices[is_joint]
+    vg_joints = group_joints[vg_groups[is_joint]]
+    vg_weights = vg_weights[is_joint]
+    if not len(vg_vertices):
+        return weights, joints
+
+    # Sort by vertex, strongest weights first, and keep the first 4 per vertex
+    order = np.lexsort((-vg_weights, vg_vertices))
+    vg_vertices = vg_vertices[order]
+    starts = np.searchsorted(vg_vertices, vg_vertices, side='left')
+    rank = np.arange(len(vg_vertices)) - starts
+    keep = rank < 4
+    weights[vg_vertices[keep], rank[keep]] = vg_weights[order][keep]
+    joints[vg_vertices[keep], rank[keep]] = vg_joints[order][keep]
+
+    weight_sums = weights.sum(axis=1, keepdims=True)
+    np.divide(weights, weight_sums, out=weights, where=weight_sums > 0.0)
+    return weights, joints
+
+
+def get_corner_normals(blen_mesh):
+    """Return the (split) normal of each loop."""
+    normals = np.empty(len(blen_mesh.loops) * 3, dtype=np.float32)
+    if hasattr(blen_mesh, "corner_normals"):
+        blen_mesh.corner_normals.foreach_get('vector', normals)
+    else:
+        # Blender < 4.1
+        blen_mesh.calc_normals_split()
+        blen_mesh.loops.foreach_get('normal', normals)
+    return normals.reshape(-1, 3)
+
+
+def get_object_vertices(blen_object, depsgraph, names, nvx2version):
+    """Pack the vertices of a (triangulated) object.
+
+    Vertices are split where loops differ in any exported component.
+    Returns the packed vertices and faces indexing them.
+    """
+    eval_object = blen_object.evaluated_get(depsgraph)
+    blen_mesh = eval_object.to_mesh()
+    try:
+        blen_mesh.calc_loop_triangles()
+        num_vertices = len(blen_mesh.vertices)
+        num_loops = len(blen_mesh.loops)
+
+        tri_loops = np.empty(len(blen_mesh.loop_triangles) * 3, dtype=np.int32)
+        blen_mesh.loop_triangles.foreach_get('loops', tri_loops)
+        loop_vertices = np.empty(num_loops, dtype=np.int32)
+        blen_mesh.loops.foreach_get('vertex_index', loop_vertices)
+
+        # Export in world space, so multiple objects can share a file
+        matrix = np.array(blen_object.matrix_world, dtype=np.float32)
+        coords = np.empty(num_vertices * 3, dtype=np.float32)
+        blen_mesh.vertices.foreach_get('co', coords)
+        coords = coords.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+
+        weights = joints = None
+        loop_components = {}
+        for name in names:
+            if name == 'Coord':
+                loop_components[name] = coords[loop_vertices]
+            elif name.startswith('Normal'):
+                normal_matrix = np.linalg.inv(matrix[:3, :3]).T
+                normals = get_corner_normals(blen_mesh) @ normal_matrix.T
+                lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+                np.divide(normals, lengths, out=normals, where=lengths > 0.0)
+                loop_components[name] = normals
+            elif name.startswith('Uv'):
+                uv_idx = int(name[2])
+                uvs = np.zeros(num_loops * 2, dtype=np.float32)
+                if uv_idx < len(blen_mesh.uv_layers):
+                    blen_mesh.uv_layers[uv_idx].data.foreach_get('uv', uvs)
+                loop_components[name] = uvs.reshape(-1, 2)
+            elif name.startswith('Color'):
+                blen_colors = blen_mesh.color_attributes.active_color
+                if blen_colors:
+                    colors = np.empty(len(blen_colors.data) * 4, dtype=np.float32)
+                    blen_colors.data.foreach_get('color', colors)
+                    colors = colors.reshape(-1, 4)
+                    if blen_colors.domain == 'POINT':
+                        colors = colors[loop_vertices]
+                else:
+                    colors = np.ones((num_loops, 4), dtype=np.float32)
+                loop_components[name] = colors
+            elif name.startswith('Weights') or name.startswith('JIndices'):
+                if weights is None:
+                    weights, joints = get_vertex_weights(blen_mesh,
+                                                         get_group_joints(blen_object))
+                if name.startswith('Weights'):
+                    loop_components[name] = weights[loop_vertices]
+                else:
+                    loop_components[name] = joints[loop_vertices]
+    finally:
+        eval_object.to_mesh_clear()
+
+    # Pack all loops, then merge loops with identical (packed) vertex data
+    _, loop_data = nvx2.pack_vertices(loop_components, nvx2version)
+    loop_bytes = loop_data.view(np.dtype((np.void, loop_data.dtype.itemsize)))
+    _, first_idx, loop_vertex_idx = np.unique(loop_bytes, return_index=True,
+                                              return_inverse=True)
+    # Keep vertices in the order they appear in the mesh
+    order = np.argsort(first_idx)
+    new_idx = np.empty_like(order)
+    new_idx[order] = np.arange(len(order))
+    vertices = loop_data[first_idx[order]]
+    faces = new_idx[loop_vertex_idx.ravel()][tri_loops].reshape(-1, 3)
+    return vertices, faces
+
+
+def get_export_names(blen_objects, options: nvx2.ExportOptions):
+    """Get the vertex components to export, the same for all objects."""
+    num_uvlayers = 0
+    if options.export_uvs:
+        num_uvlayers = max((len(obj.data.uv_layers) for obj in blen_objects), default=0)
+    has_colors = options.export_colors and \
+        any(obj.data.color_attributes.active_color for obj in blen_objects)
+    has_weights = options.export_weights and \
+        any(obj.vertex_groups for obj in blen_objects)
+    return nvx2.get_export_components(options.nvx2version, options.use_compact,
+                                      options.export_normals, num_uvlayers,
+                                      has_colors, has_weights)
+
+
+def save(context, operator, options: nvx2.ExportOptions):
+    """Called by the user interface or another script."""
+    if options.use_selection:
+        blen_objects = context.selected_objects
+    else:
+        blen_objects = context.scene.objects
+    # One group per object
+    blen_objects = sorted((obj for obj in blen_objects if obj.type == 'MESH'),
+                          key=lambda obj: obj.name)
+    if not blen_objects:
+        operator.report({'ERROR'}, "No meshes to export.")
+        return {'CANCELLED'}
+
+    depsgraph = context.evaluated_depsgraph_get()
+    names = get_export_names(blen_objects, options)
+
+    all_vertices = []
+    all_faces = []
+    group_ranges = []
+    num_vertices = 0
+    num_faces = 0
+    for obj in blen_objects:
+        vertices, faces = get_object_vertices(obj, depsgraph, names, options.nvx2version)
+        all_vertices.append(vertices)
+        all_faces.append(faces + num_vertices)
+        group_ranges.append((num_vertices, len(vertices), num_faces, len(faces)))
+        num_vertices += len(vertices)
+        num_faces += len(faces)
+
+    vertices = np.concatenate(all_vertices)
+    faces = np.concatenate(all_faces)
+    if options.optimize_vertex_cache:
+        faces, vertex_order, _, acmr_before, acmr_after = \
+            vertex_cache.optimize_groups(faces, len(vertices), group_ranges)
+        vertices = vertices[vertex_order]
+        operator.report({'INFO'}, "Vertex cache ACMR " + format(acmr_before, ".3f") +
+                        " -> " + format(acmr_after, ".3f"))
+
+    vertex_components = nvx2.get_vertex_components(names, options.nvx2version)
+    try:
+        nvx2.write_file(options.nvx2filepath, vertex_components, vertices, faces, group_ranges,
+                        options.byteorder)
+    except ValueError as e:
+        operator.report({'ERROR'}, str(e))
+        return {'CANCELLED'}
+    except PermissionError:
+        operator.report({'ERROR'}, "Insufficient permissions to write file.")
+        return {'CANCELLED'}
+
+    print("Exported " + str(len(blen_objects)) + " objects, " + str(num_vertices) +
+          " vertices, " + str(num_faces) + " triangles")
+    return {'FINISHED'}
@@ -0,0 +1,126 @@
+"""Summarize nvx2 and n3 files as JSON without decoding their payload
+
+Can be run without blender:
+    python fileinfo.py [--tags] [--jobs N] PATH [PATH ...]
+Directories are searched recursively, one JSON object is printed per file.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import struct
+import sys
+
+if __package__:
+    from . import n3
+    from . import nvx2
+else:
+    # Run as a script, the add-on's __init__ needs blender
+    import n3
+    import nvx2
+
+
+class ErrorCollector:
+    """Stand-in for an operator, keeps errors reported by n3.Parser."""
+
+    def __init__(self):
+        self.errors = []
+
+
+    def report(self, rep_type, rep_msg):
+        """Store error reports, ignore everything else."""
+        if 'ERROR' in rep_type:
+            self.errors.append(rep_msg)
+
+
+def get_nvx2_info(filepath, nvx2version=0):
+    """Read only header and group table of an nvx2 file."""
+    with open(filepath, mode='rb') as f:
+        header, groups = nvx2.read_header(f)
+
+    vertex_size = header.vertex_width * 4
+    if nvx2version == 0:
+        nvx2version = nvx2.detect_version(header.vertex_components, vertex_size)
+    layout = nvx2.get_vertex_layout(header.vertex_components, nvx2version)
+    layout_size = struct.calcsize(nvx2.make_vertexformat(header.vertex_components,
+                                                         nvx2version))
+    return {"path": filepath,
+            "type": "nvx2",
+            "version": nvx2version,
+            "big_endian": nvx2.get_byteorder(header.magic) == '>',
+            "num_groups": header.num_groups,
+            "num_vertices": header.num_vertices,
+            "num_triangles": header.num_triangles,
+            "num_edges": header.num_edges,
+            "vertex_size": vertex_size,
+            "vertex_components": header.vertex_components,
+            "layout": [{"component": name, "offset": offset, "format": fmt}
+                       for name, offset, fmt in layout],
+            "layout_valid": layout_size == vertex_size,
+            "groups": [g._asdict() for g in groups]}
+
+
+def get_n3_info(filepath, include_tags=False):
+    """Read the node structure of an n3 file, skipping all tag values."""
+    collector = ErrorCollector()
+    parser = n3.Parser(collector, n3.Options(), skip_payload=True)
+    if not parser.parse_file(filepath):
+        raise ValueError("; ".join(collector.errors))
+
+    info = {"path": filepath,
+            "type": "n3",
+            "version": parser.n3version,
+            "model_type": parser.n3modeltype,
+            "model_name": parser.n3modelname,
+            "num_tags": len(parser.n3tags),
+            "nodes": [{"name": node.node_name,
+                       "type": node.node_type,
+                       "parent": node.node_parent.node_name if node.node_parent else None}
+                      for node in parser.n3node_list]}
+    if include_tags:
+        info["tags"] = [t._asdict() for t in parser.n3tags]
+    return info
+
+
+def get_info(filepath, include_tags=False):
+    """Summarize a single file, errors are returned as part of the summary."""
+    try:
+        if os.path.splitext(filepath)[1].lower() == '.n3':
+            return get_n3_info(filepath, include_tags)
+        return get_nvx2_info(filepath)
+    except (OSError, ValueError, struct.error) as e:
+        return {"path": filepath, "error": str(e) or type(e).__name__}
+
+
+def find_files(paths):
+    """Yield all nvx2 and n3 files in paths, directories are searched recursively."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() in ('.nvx2', '.n3'):
+                    yield os.path.join(dirpath, filename)
+
+
+def main(argv=None):
+    """Command line entry point, prints one JSON object per line."""
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument("paths", nargs="+", help="nvx2/n3 files or directories")
+    argparser.add_argument("--tags", action="store_true",
+                           help="List offset and size of each n3 tag")
+    argparser.add_argument("--jobs", type=int, default=None,
+                           help="Number of worker threads")
+    args = argparser.parse_args(argv)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for info in executor.map(lambda path: get_info(path, args.tags),
+                                 find_files(args.paths)):
+            sys.stdout.write(json.dumps(info) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,29 @@
 """Library to import n3 data files"""
 
+import concurrent.futures
 import os
 import pathlib
+from dataclasses import dataclass, field, replace
 import bpy
 import bpy_extras.image_utils
 import mathutils
+import numpy as np
 
+from . import background
 from . import n3
 from . import nvx2
 from . import import_nvx2
+from . import texture_cache
+
+
+# Bone custom property holding the n3 joint index, see create_armature()
+JOINT_IDX_PROPERTY = "n3_joint_idx"
+
+# Images loaded by all n3 imports, unloaded when over the texture budget
+image_cache = texture_cache.TextureCache()
+
+# Threads reading meshes and textures ahead of creating them
+PREFETCH_MAX_WORKERS = min(8, os.cpu_count() or 1)
 
 
 def find_dir(start_dir, dirname_to_search_for):
@@ -24,9 +39,115 @@ def find_dir(start_dir, dirname_to_search_for):
     return ""
 
 
+def quaternions_to_matrices(quats):
+    """Convert an array of (x, y, z, w) quaternions to 3x3 rotation matrices."""
+    norms = np.linalg.norm(quats, axis=1, keepdims=True)
+    # Treat (0, 0, 0, 0) as no rotation
+    quats = np.where(norms > 0.0, quats / np.where(norms > 0.0, norms, 1.0), [0.0, 0.0, 0.0, 1.0])
+    x, y, z, w = quats.T
+    mats = np.empty((len(quats), 3, 3))
+    mats[:, 0, 0] = 1.0 - 2.0 * (y*y + z*z)
+    mats[:, 0, 1] = 2.0 * (x*y - z*w)
+    mats[:, 0, 2] = 2.0 * (x*z + y*w)
+    mats[:, 1, 0] = 2.0 * (x*y + z*w)
+    mats[:, 1, 1] = 1.0 - 2.0 * (x*x + z*z)
+    mats[:, 1, 2] = 2.0 * (y*z - x*w)
+    mats[:, 2, 0] = 2.0 * (x*z - y*w)
+    mats[:, 2, 1] = 2.0 * (y*z + x*w)
+    mats[:, 2, 2] = 1.0 - 2.0 * (x*x + y*y)
+    return mats
+
+
+def compute_joint_matrices(n3joints):
+    """Compute the world matrices of all joints.
+
+    Returns joint names, parent indices (into the returned arrays, -1 means no
+    parent) and the world matrices, sorted by joint index.
+    """
+    # Joints are stored packed, see n3.Joints
+    joint_ids = np.array(n3joints.indices, dtype=np.int64)
+    order = np.argsort(joint_ids, kind='stable')
+    joint_ids = joint_ids[order]
+    joint_names = [n3joints.names[i] for i in order]
+    transforms = np.array(n3joints.transforms, dtype=np.float64).reshape(-1, 3, 4)[order]
+    translations = transforms[:, 0, :3]
+    rotations = transforms[:, 1, :4]
+    scales = transforms[:, 2, :3]
+
+    # Parent indices refer to joint indices, map them to array positions
+    parent_ids = np.array(n3joints.parents, dtype=np.int64)[order]
+    parents = np.searchsorted(joint_ids, parent_ids)
+    parents[parent_ids < 0] = -1
+
+    # Local matrices = translation * rotation * scale
+    num_joints = len(n3joints)
+    local_mats = np.zeros((num_joints, 4, 4))
+    local_mats[:, :3, :3] = quaternions_to_matrices(rotations) * scales[:, None, :]
+    local_mats[:, :3, 3] = translations
+    local_mats[:, 3, 3] = 1.0
+
+    # Depth of each joint in the hierarchy
+    depth = np.zeros(num_joints, dtype=int)
+    has_parent = parents >= 0
+    for _ in range(num_joints):
+        new_depth = np.where(has_parent, depth[parents] + 1, 0)
+        if np.array_equal(new_depth, depth):
+            break
+        depth = new_depth
+
+    # Compose world matrices level by level, all joints of a level at once
+    world_mats = local_mats.copy()
+    for level in range(1, depth.max(initial=0) + 1):
+        level_idx = np.flatnonzero(depth == level)
+        world_mats[level_idx] = world_mats[parents[level_idx]] @ local_mats[level_idx]
+
+    return joint_names, parents, world_mats
+
+
+def compute_node_matrix(n3node):
+    """Compute the world matrix of an n3 node from its and its parents' transforms."""
+    node_mat = np.identity(4)
+    while n3node:
+        local_mat = np.identity(4)
+        local_mat[:3, :3] = quaternions_to_matrices(np.array([n3node.rotation[:4]],
+                                                             dtype=np.float64))[0]
+        local_mat[:3, :3] *= np.array(n3node.scale[:3])
+        local_mat[:3, 3] = n3node.position[:3]
+        node_mat = local_mat @ node_mat
+        n3node = n3node.node_parent
+    return node_mat
+
+
+def compute_bone_rolls(bone_axes, rot_mats):
+    """Compute blender bone rolls, see mat3_vec_to_roll() in blender."""
+    x, y, z = bone_axes.T
+    # Rotation matrices for roll = 0, see vec_roll_to_mat3_normalized()
+    theta = 1.0 + y
+    theta_alt = x*x + z*z
+    is_safe = (theta > 1.0e-5) | (theta_alt > 1.0e-13)
+    is_small = theta <= 1.0e-5
+    theta[is_small] = theta_alt[is_small] * 0.5 + theta_alt[is_small]**2 * 0.125
+    theta[~is_safe] = 1.0
+    roll0_mats = np.zeros((len(bone_axes), 3, 3))
+    roll0_mats[:, 0, 0] = 1.0 - x*x / theta
+    roll0_mats[:, 1, 0] = -x
+    roll0_mats[:, 2, 0] = -x*z / theta
+    roll0_mats[:, 0, 1] = x
+    roll0_mats[:, 1, 1] = y
+    roll0_mats[:, 2, 1] = z
+    roll0_mats[:, 0, 2] = -x*z / theta
+    roll0_mats[:, 1, 2] = -z
+    roll0_mats[:, 2, 2] = 1.0 - z*z / theta
+    # Bone pointing down -Y
+    roll0_mats[~is_safe] = np.diag([-1.0, -1.0, 1.0])
+
+    roll_mats = np.transpose(roll0_mats, (0, 2, 1)) @ rot_mats
+    return np.arctan2(roll_mats[:, 0, 2], roll_mats[:, 2, 2])
+
+
 def create_armature(am_name, n3joints, context, collection):
     """Create an armature from a list of n3 node definitions."""
-    # n3joints = list of (joint_idx, parent_idx, translation, rotation, scale, name)
+    # n3joints = n3.Joints, (joint_idx, parent_idx, translation, rotation, scale, name)
     # indices start at 0
     # parent_idx = -1 means no parent
 
@@ -34,43 +155,116 @@ def create_armature(am_name, n3joints, context, collection):
     ob = bpy.data.objects.new(am_name, am)
     collection.objects.link(ob)
 
-    """
-    context.view_layer.objects.active = ob
-    bpy.ops.object.mode_set(mode='EDIT')
+    if not n3joints:
+        return ob
+
+    joint_names, parents, world_mats = compute_joint_matrices(n3joints)
+    num_joints = len(joint_names)
+
+    # Bones point along the joints' y axis
+    rot_mats = world_mats[:, :3, :3]
+    rot_mats = rot_mats / np.linalg.norm(rot_mats, axis=1, keepdims=True)
+    bone_axes = rot_mats[:, :, 1]
+    heads = world_mats[:, :3, 3]
+    # Bone length is the longest distance to a child, use parent's for leaves
+    lengths = np.zeros(num_joints)
+    has_parent = parents >= 0
+    child_dist = np.linalg.norm(heads[has_parent] - heads[parents[has_parent]], axis=1)
+    np.maximum.at(lengths, parents[has_parent], child_dist)
+    valid_dist = child_dist[child_dist > 1.0e-4]
+    default_length = np.median(valid_dist) if len(valid_dist) else 0.1
+    is_leaf = lengths < 1.0e-4
+    lengths[is_leaf & has_parent] = lengths[parents[is_leaf & has_parent]]
+    lengths[lengths < 1.0e-4] = default_length
+    tails = heads + bone_axes * lengths[:, None]
+    rolls = compute_bone_rolls(bone_axes, rot_mats)
+
+    # Edit mode needs the object in the view layer, the import collection
+    # isn't linked to the scene yet, so link it to the scene while building
+    is_linked = ob.name in context.view_layer.objects
+    if not is_linked:
+        context.scene.collection.objects.link(ob)
+    try:
+        # Create all bones in a single edit mode session
+        context.view_layer.objects.active = ob
+        bpy.ops.object.mode_set(mode='EDIT')
+
+        edit_bones = [am.edit_bones.new(name) for name in joint_names]
+        for bone, parent_idx in zip(edit_bones, parents):
+            if parent_idx >= 0:
+                bone.parent = edit_bones[parent_idx]
+        am.edit_bones.foreach_set('head', heads.astype(np.float32).ravel())
+        am.edit_bones.foreach_set('tail', tails.astype(np.float32).ravel())
+        am.edit_bones.foreach_set('roll', rolls.astype(np.float32))
+        # Blender may rename bones, edit bones are gone after edit mode
+        bone_names = [bone.name for bone in edit_bones]
+
+        bpy.ops.object.mode_set(mode='OBJECT')
+    finally:
+        if not is_linked:
+            context.view_layer.objects.active = None
+            context.scene.collection.objects.unlink(ob)
+
+    # Armature.bones is in hierarchy order, keep the joint order on the bones
+    for joint_idx, bone_name in enumerate(bone_names):
+        am.bones[bone_name][JOINT_IDX_PROPERTY] = joint_idx
+    return ob
 
-    created_bones = {}
-    for joint_idx, joint_parent_idx, translation, rotation, scale, joint_name in n3joints:
-        bone = am.edit_bones.new(joint_name)
 
-        created_bones[joint_idx] = bone
-        if joint_parent_idx >= 0:
-            bone.parent = created_bones[joint_parent_idx]
+def get_joint_bones(armature_object):
+    """Map joint indices to the bones of an armature.
 
-            bone.head = bone.parent.tail + mathutils.Vector(translation[:3])
-        else:
-            bone.parent = None
+    Armatures from create_armature() store the joint index on each bone, for
+    other armatures the bones are taken in their (hierarchy) order.
+    """
+    bones = armature_object.data.bones
+    if all(JOINT_IDX_PROPERTY in bone for bone in bones):
+        return {bone[JOINT_IDX_PROPERTY]: bone for bone in bones}
+    return dict(enumerate(bones))
 
-        bone.tail = bone.head + mathutils.Vector(translation[:3])
 
-    am.edit_bones.update()
-    context.evaluated_depsgraph_get().update()
+def find_image_file(n3_texture_res, options: n3.Options):
+    """Return the path of the texture file next to the n3 file or in the project, or ""."""
+    img_dir, img_name = os.path.split(n3_texture_res[4:])
+    n3_dir, _ = os.path.split(options.n3filepath)
+    possible_paths_list = [os.path.join(n3_dir, img_name + '.dds')]
+    project_tex_dir = find_dir(n3_dir, "textures")
+    if project_tex_dir:
+        possible_paths_list.append(os.path.normpath(os.path.join(project_tex_dir, img_dir,
+                                                                 img_name + '.dds')))
+    for possible_path in possible_paths_list:
+        if os.path.isfile(possible_path):
+            return possible_path
+    return ""
 
-    bpy.ops.object.mode_set(mode='OBJECT')
-    ob.update_from_editmode()
-    """
-    return ob
 
+def create_image(n3_texture_res, options: n3.Options, img_file=None):
+    """Helper function to load image files into blender images.
 
-def create_image(n3_texture_res, options: n3.Options):
-    """Helper function to load image files into blender images."""
+    img_file is the result of find_image_file(), if already known.
+    """
     img_path = n3_texture_res[4:]
     img_dir, img_name = os.path.split(img_path)
 
     possible_paths_list = []
 
-    # Attempt to find existing blender image
-    if options.reuse_images and img_name in bpy.data.images:
-        return bpy.data.images[img_name]
+    # Attempt to find existing blender image, loaded from the same file first
+    if img_file is None:
+        img_file = find_image_file(n3_texture_res, options)
+    if options.reuse_images:
+        img = image_cache.get(img_file) if img_file else None
+        if img:
+            return img
+        if img_name in bpy.data.images:
+            img = bpy.data.images[img_name]
+            # Count it against the budget as well
+            image_cache.add(img, os.path.normpath(bpy.path.abspath(img.filepath))
+                            if img.filepath else "")
+            return img
+
+    img = None
+    if img_file:
+        img = bpy_extras.image_utils.load_image(img_file, place_holder=False)
 
     # Case 1: Texture is in same directory as the n3file
     n3_path = options.n3filepath
@@ -92,19 +286,19 @@ def create_image(n3_texture_res, options: n3.Options):
 
     # Attempt to load one of the images in path list
     # One is enough!
-    img = None
     for pp in possible_paths_list:
+        if img:
+            break
         img = bpy_extras.image_utils.load_image(img_name + '.dds',
                                                 pp,
                                                 recursive=options.use_image_search,
                                                 place_holder=False,
                                                 ncase_cmp=True)
-        if img:
-            break
 
     # Create dummy image, if none was found
     if img:
         img.name = img_name
+        image_cache.add(img, img_file or os.path.normpath(bpy.path.abspath(img.filepath)))
     else:
         print('WARNING: Could not load image ' + img_name)
         img = bpy.data.images.new(img_name, 512, 512)
@@ -112,8 +306,12 @@ def create_image(n3_texture_res, options: n3.Options):
     return img
 
 
-def create_material(material_name, texture_list, options: n3.Options):
-    """Create a blender material and attach it to blender object."""
+def create_material(material_name, texture_list, options: n3.Options, image_files=None):
+    """Create a blender material and attach it to blender object.
+
+    image_files optionally maps texture resource ids to already resolved files.
+    """
+    image_files = image_files or {}
     # Try to re-use existing material with the same name
     if options.reuse_materials and material_name in bpy.data.materials:
         return bpy.data.materials[material_name]
@@ -144,7 +342,7 @@ def create_material(material_name, texture_list, options: n3.Options):
     node_diff_tex.location = (-2000, 763)
     texture = texture_list['DiffMap0']
     if texture:
-        node_diff_tex.image = create_image(texture, options)
+        node_diff_tex.image = create_image(texture, options, image_files.get(texture))
         node_diff_tex.image.colorspace_settings.name = 'sRGB'
     # Connect to shader
     links.new(node_shader.inputs['Alpha'], node_diff_tex.outputs['Alpha'])
@@ -157,7 +355,7 @@ def create_material(material_name, texture_list, options: n3.Options):
     node_spec_tex.location = (-1373, 371)
     texture = texture_list['SpecMap0']
     if texture:
-        node_spec_tex.image = create_image(texture, options)
+        node_spec_tex.image = create_image(texture, options, image_files.get(texture))
         node_spec_tex.image.colorspace_settings.name = 'Non-Color'
     # Connect to shader
     links.new(node_shader.inputs[13], node_spec_tex.outputs['Color'])
@@ -175,15 +373,22 @@ def create_material(material_name, texture_list, options: n3.Options):
     node_bump_tex.location = (-940, -429)
     texture = texture_list['BumpMap0']
     if texture:
-        node_bump_tex.image = create_image(texture, options)
+        node_bump_tex.image = create_image(texture, options, image_files.get(texture))
         node_bump_tex.image.colorspace_settings.name = 'Non-Color'
     links.new(node_bump.inputs['Height'], node_bump_tex.outputs['Color'])
 
     return blen_material
 
 
-def import_nvx2_mesh(context, operator, n3_mesh_res, options: n3.Options):
-    """Create a blender object from an nvx2 mesh file."""
+def find_character_node(n3node):
+    """Return the closest node (including itself) holding a skeleton."""
+    while n3node and not n3node.joints:
+        n3node = n3node.node_parent
+    return n3node
+
+
+def get_mesh_paths(n3_mesh_res, options: n3.Options):
+    """Return the possible paths of an nvx2 mesh resource."""
     nvx2_path = n3_mesh_res[4:]
     nvx2_dir, nvx2_name = os.path.split(nvx2_path)
 
@@ -206,50 +411,500 @@ def import_nvx2_mesh(context, operator, n3_mesh_res, options: n3.Options):
     if os.path.isdir(possible_path):
         possible_path = os.path.join(possible_path, nvx2_name)
         possible_paths_list.append(possible_path)
+    return possible_paths_list
+
+
+def find_mesh_file(n3_mesh_res, options: n3.Options):
+    """Return the path of an existing nvx2 file for a mesh resource, or ""."""
+    for possible_path in get_mesh_paths(n3_mesh_res, options):
+        if os.path.isfile(possible_path):
+            return os.path.normpath(possible_path)
+    return ""
+
+
+class ResourcePrefetcher:
+    """Resolve and decode the meshes and textures of an n3 file on a thread pool.
+
+    Resources are requested while the file is parsed, so reading nvx2 files
+    overlaps with parsing and with creating blender data for earlier nodes.
+    Only files are read here, blender data is created on the main thread.
+    A pool can be shared by the prefetchers of several files, it is shut down
+    by its owner then.
+    """
+
+    def __init__(self, options: n3.Options, executor=None):
+        self.options = options
+        self.owns_executor = executor is None
+        if executor is None:
+            executor = make_prefetch_executor()
+        self.executor = executor
+        self.meshes = {}  # mesh resource id => future of (path, mesh data)
+        self.images = {}  # texture resource id => future of path
+
+
+    def request(self, tag_4cc, resource_id):
+        """Start loading a resource, can be used as n3.Parser resource_callback."""
+        if tag_4cc == 'MESH':
+            if self.options.import_meshes and resource_id not in self.meshes:
+                self.meshes[resource_id] = self.executor.submit(self.read_mesh, resource_id)
+        elif tag_4cc == 'STXT':
+            if self.options.create_materials and resource_id not in self.images:
+                self.images[resource_id] = self.executor.submit(find_image_file,
+                                                                resource_id, self.options)
+
+
+    def request_node(self, n3node):
+        """Start loading the mesh and textures of a node, if not done already."""
+        if n3node.mesh_ressource_id:
+            self.request('MESH', n3node.mesh_ressource_id)
+        for tex_name in n3node.shader_textures.values():
+            self.request('STXT', tex_name)
+
+
+    def read_mesh(self, n3_mesh_res):
+        """Read an nvx2 file, runs on a worker thread."""
+        mesh_filepath = find_mesh_file(n3_mesh_res, self.options)
+        if not mesh_filepath:
+            return None
+        # Each file is decoded on a single thread, files are read in parallel
+        return mesh_filepath, nvx2.read_file(mesh_filepath, nvx2.Options().nvx2version,
+                                             num_threads=1)
+
+
+    def get_mesh(self, n3_mesh_res):
+        """Return (path, mesh data) of a requested mesh, waits until it is read.
+
+        Returns None for unknown or unreadable meshes, loading them the
+        regular way reports the error.
+        """
+        future = self.meshes.get(n3_mesh_res)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except (OSError, ValueError):
+            return None
+
+
+    def get_image_files(self, texture_list):
+        """Return the resolved files of the requested textures in texture_list."""
+        return {tex_name: self.images[tex_name].result()
+                for tex_name in texture_list.values() if tex_name in self.images}
+
+
+    def shutdown(self):
+        """Stop reading, pending requests are dropped."""
+        if self.owns_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            return
+        for future in list(self.meshes.values()) + list(self.images.values()):
+            future.cancel()
+
+
+def make_prefetch_executor():
+    """Thread pool for ResourcePrefetcher, can be shared by several files."""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_MAX_WORKERS)
+
+
+def import_nvx2_mesh(context, operator, n3_mesh_res, options: n3.Options,
+                     joint_names=None, skin_fragments=None, armature_object=None,
+                     parent_object=None, groups=None, collection=None, prefetched=None):
+    """Create a blender object from an nvx2 mesh file.
+
+    prefetched is (path, mesh data) from ResourcePrefetcher.get_mesh(), if any.
+    """
+    def make_options(filepath):
+        nvx2options = nvx2.Options()
+        nvx2options.nvx2filepath = filepath
+        nvx2options.joint_names = joint_names or []
+        nvx2options.skin_fragments = skin_fragments or {}
+        nvx2options.armature_object = armature_object
+        nvx2options.parent_object = parent_object
+        nvx2options.groups = groups or []
+        return nvx2options
+
+    blen_object = None
+    if prefetched:
+        mesh_filepath, mesh_data = prefetched
+        import_nvx2.load(context, operator, make_options(mesh_filepath), collection, mesh_data)
+        return blen_object
 
     # Attempt to load one of the nvx2 meshes in path list
     # One is enough!
-    blen_object = None
-    for pp in possible_paths_list:
-        nvx2options = nvx2.Options()
-        nvx2options.nvx2filepath = pp
-        if import_nvx2.load(context, operator, nvx2options) == {'FINISHED'}:
+    for pp in get_mesh_paths(n3_mesh_res, options):
+        if import_nvx2.load(context, operator, make_options(pp), collection) == {'FINISHED'}:
             return blen_object
 
     return blen_object
 
 
-def load(context, operator, options: n3.Options):
-    """Called by the user interface or another script."""
-    n3parser = n3.Parser(operator, options)
-    n3parser.parse_file(options.n3filepath)
-    operator.report({'INFO'}, "Parsing Complete. Output written to console.")
+def create_proxy(n3node, collection, options: n3.Options):
+    """Create a box from the bounding box of a shape node, standing in for its mesh."""
+    center, extents = n3node.bounding_box
+    # Box corners, extents are half the box size
+    corners = np.array([[x, y, z] for x in (-1.0, 1.0) for y in (-1.0, 1.0) for z in (-1.0, 1.0)])
+    corners = corners * np.array(extents[:3]) + np.array(center[:3])
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+
+    blen_mesh = bpy.data.meshes.new(n3node.node_name + "_proxy")
+    blen_mesh.from_pydata(corners.tolist(), [], faces)
+    ob = bpy.data.objects.new(n3node.node_name + "_proxy", blen_mesh)
+    ob.display_type = 'WIRE'
+    ob.matrix_world = mathutils.Matrix(compute_node_matrix(n3node).tolist())
+    # Store everything needed to load the actual mesh later
+    ob["n3_filepath"] = options.n3filepath
+    ob["n3_mesh_ressource_id"] = n3node.mesh_ressource_id
+    ob["n3_primitive_group_idx"] = n3node.primitive_group_idx
+    collection.objects.link(ob)
+    return ob
+
+
+def load_proxy(context, operator, proxy_object):
+    """Load the nvx2 mesh for a proxy created by create_proxy()."""
+    options = n3.Options()
+    options.n3filepath = proxy_object["n3_filepath"]
+    if proxy_object.get("n3_proxy_loaded"):
+        return {'CANCELLED'}
+
+    import_nvx2_mesh(context,
+                     operator,
+                     proxy_object["n3_mesh_ressource_id"],
+                     options,
+                     parent_object=proxy_object,
+                     groups=[proxy_object["n3_primitive_group_idx"]])
+    proxy_object["n3_proxy_loaded"] = True
+    return {'FINISHED'}
+
+
+def filter_lod_nodes(n3node_list, options: n3.Options):
+    """Remove all nodes in LOD branches not matching the LOD policy.
+
+    LOD branches are nodes with a min or max distance, siblings form a
+    LOD group from which the branches to keep are selected.
+    """
+    if options.lod_policy == 'ALL':
+        return n3node_list
+
+    # Group LOD nodes by parent
+    lod_groups = {}
+    for n3node in n3node_list:
+        if n3node.min_distance >= 0.0 or n3node.max_distance >= 0.0:
+            lod_groups.setdefault(id(n3node.node_parent), []).append(n3node)
+
+    skipped_nodes = set()
+    for lod_nodes in lod_groups.values():
+        min_distances = [max(n.min_distance, 0.0) for n in lod_nodes]
+        max_distances = [n.max_distance if n.max_distance >= 0.0 else float('inf')
+                         for n in lod_nodes]
+        if options.lod_policy == 'HIGHEST':
+            keep = [min_distances.index(min(min_distances))]
+        elif options.lod_policy == 'LOWEST':
+            keep = [min_distances.index(max(min_distances))]
+        else:
+            keep = [i for i, (dmin, dmax) in enumerate(zip(min_distances, max_distances))
+                    if dmin <= options.lod_distance < dmax]
+        skipped_nodes.update(id(n) for i, n in enumerate(lod_nodes) if i not in keep)
+
+    # Nodes are listed before their children
+    skipped_branches = set()
+    filtered_node_list = []
+    for n3node in n3node_list:
+        if id(n3node) in skipped_nodes or id(n3node.node_parent) in skipped_branches:
+            skipped_branches.add(id(n3node))
+        else:
+            filtered_node_list.append(n3node)
+    print("LOD policy '" + options.lod_policy + "': skipped " +
+          str(len(skipped_branches)) + " of " + str(len(n3node_list)) + " nodes")
+    return filtered_node_list
+
+
+def create_nodes(context, operator, n3parser, options: n3.Options, collection=None,
+                 prefetcher=None):
+    """Create blender data for all parsed n3 nodes.
 
+    Objects are linked to collection, the scene's collection if None. Meshes
+    and textures are taken from prefetcher (a ResourcePrefetcher) if passed.
+    This is a generator, yielding after each node.
+    """
     # Loop through nodes and create stuff
     # TODO: This is actually a tree structure, need to adjust for it
     #       after everything is halfway working (will also fix material names)
-    scene = context.scene
-    collection = scene.collection
-    for n3node in n3parser.n3node_list:
+    if collection is None:
+        collection = context.scene.collection
+    blen_armatures = {}
+    image_cache.budget = options.texture_budget * 1024 * 1024
+    n3nodes = filter_lod_nodes(n3parser.n3node_list, options)
+    if prefetcher and not options.use_proxies:
+        # Everything requested while parsing is already loading
+        for n3node in n3nodes:
+            prefetcher.request_node(n3node)
+    for n3node in n3nodes:
+        blen_object = None
+        # Create armature
+        if options.create_armatures and n3node.joints:
+            blen_armatures[n3node.node_name] = \
+                create_armature(n3node.node_name+"_armature",
+                                n3node.joints,
+                                context,
+                                collection)
+        # Create proxies only, don't touch any nvx2 or texture files
+        if options.use_proxies:
+            if n3node.mesh_ressource_id and n3node.bounding_box:
+                create_proxy(n3node, collection, options)
+            yield n3node
+            continue
         # Create mesh
         if options.import_meshes and n3node.mesh_ressource_id:
             mesh_filepath = n3node.mesh_ressource_id
+            # Skinned meshes, joint indices are relative to the skin fragments
+            joint_names = None
+            armature_object = None
+            character_node = find_character_node(n3node)
+            if character_node:
+                joint_names = character_node.joints.get_sorted_names()
+                armature_object = blen_armatures.get(character_node.node_name)
+            # Only the groups drawn by this node, a skin uses one per fragment
+            if n3node.skin_fragments:
+                groups = list(n3node.skin_fragments)
+            else:
+                groups = [n3node.primitive_group_idx]
+            prefetched = prefetcher.get_mesh(mesh_filepath) if prefetcher else None
             blen_object = import_nvx2_mesh(context,
                                            operator,
                                            mesh_filepath,
-                                           options)
+                                           options,
+                                           joint_names,
+                                           n3node.skin_fragments,
+                                           armature_object,
+                                           groups=groups,
+                                           collection=collection,
+                                           prefetched=prefetched)
         # Create material
         if options.create_materials and n3node.shader_textures:
+            image_files = None
+            if prefetcher:
+                image_files = prefetcher.get_image_files(n3node.shader_textures)
             blen_material = create_material(n3node.node_name,
                                             n3node.shader_textures,
-                                            options)
+                                            options,
+                                            image_files)
             if blen_object:
                 blen_object.data.materials.append(blen_material)
-        # Create armature
-        if options.create_armatures and n3node.joints:
-            create_armature(n3node.node_name+"_armature",
-                            n3node.joints,
-                            context,
-                            collection)
+        yield n3node
+
+
+def get_resource_callback(prefetcher, options: n3.Options):
+    """Request resources while parsing, unless they might be skipped later."""
+    if options.use_proxies or options.lod_policy != 'ALL':
+        # Requested after filtering, see create_nodes()
+        return None
+    return prefetcher.request
+
+
+def load(context, operator, options: n3.Options, collection=None):
+    """Called by the user interface or another script.
 
+    Without a collection, everything is created in a new collection which is
+    linked to the scene at the end.
+    """
+    prefetcher = ResourcePrefetcher(options)
+    try:
+        n3parser = n3.Parser(operator, options,
+                             resource_callback=get_resource_callback(prefetcher, options))
+        n3parser.parse_file(options.n3filepath)
+        operator.report({'INFO'}, "Parsing Complete. Output written to console.")
+
+        import_collection = None
+        if collection is None:
+            n3name = os.path.splitext(os.path.basename(options.n3filepath))[0]
+            import_collection = import_nvx2.ImportCollection(n3name)
+            collection = import_collection.collection
+        for _ in create_nodes(context, operator, n3parser, options, collection, prefetcher):
+            pass
+    finally:
+        prefetcher.shutdown()
+
+    if import_collection:
+        operator.report({'INFO'}, import_collection.link(context))
+    return {'FINISHED'}
+
+
+def load_background_task(options: n3.Options, collection=None, executor=None):
+    """Split load() into read and create steps for background.ImportJob.
+
+    Meshes and textures are read on executor, which is shared by all tasks of
+    a job (see make_prefetch_executor() and background.ImportJob).
+    """
+    def read(reporter):
+        # Created once the task is started, not when it is queued
+        prefetcher = ResourcePrefetcher(options, executor)
+        n3parser = n3.Parser(reporter, options,
+                             resource_callback=get_resource_callback(prefetcher, options))
+        if not n3parser.parse_file(options.n3filepath):
+            prefetcher.shutdown()
+            return None
+        reporter.report({'INFO'}, "Parsing Complete. Output written to console.")
+        return n3parser, prefetcher
+
+    def create(context, reporter, result):
+        if result:
+            n3parser, prefetcher = result
+            try:
+                yield from create_nodes(context, reporter, n3parser, options, collection,
+                                        prefetcher)
+            finally:
+                prefetcher.shutdown()
+
+    return read, create
+
+
+@dataclass
+class BatchGraph:
+    """Resources referenced by a batch of n3 files, each listed once."""
+    # nvx2 path -> indices of the used groups
+    meshes: dict = field(default_factory=dict)
+    # texture key -> (n3 options, node name) of the first node using it
+    materials: dict = field(default_factory=dict)
+    # (nvx2 path, group index, texture key) -> n3 nodes placing it
+    prototypes: dict = field(default_factory=dict)
+    # Parsers of files with skeletons, these are imported without instancing
+    skinned: list = field(default_factory=list)
+    # Mesh resource ids without a file
+    missing: set = field(default_factory=set)
+
+
+def parse_batch(reporter, n3filepaths, options: n3.Options):
+    """Parse n3 files on a thread pool, returns the parsers of all readable files."""
+    def parse(n3filepath):
+        n3parser = n3.Parser(reporter, replace(options, n3filepath=n3filepath))
+        if not n3parser.parse_file(n3filepath):
+            return None
+        return n3parser
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        return [n3parser for n3parser in executor.map(parse, n3filepaths) if n3parser]
+
+
+def build_batch_graph(n3parsers, options: n3.Options):
+    """Collect the meshes and materials used by all files, resolved and deduplicated."""
+    graph = BatchGraph()
+    for n3parser in n3parsers:
+        n3nodes = list(filter_lod_nodes(n3parser.n3node_list, options))
+        if options.create_armatures and any(n3node.joints for n3node in n3nodes):
+            graph.skinned.append(n3parser)
+            continue
+        for n3node in n3nodes:
+            if not options.import_meshes or not n3node.mesh_ressource_id:
+                continue
+            mesh_filepath = find_mesh_file(n3node.mesh_ressource_id, n3parser.options)
+            if not mesh_filepath:
+                graph.missing.add(n3node.mesh_ressource_id)
+                continue
+            texture_key = ()
+            if options.create_materials:
+                texture_key = tuple(sorted(n3node.shader_textures.items()))
+                if texture_key:
+                    graph.materials.setdefault(texture_key,
+                                               (n3parser.options, n3node.node_name))
+            group_idx = n3node.primitive_group_idx
+            graph.meshes.setdefault(mesh_filepath, set()).add(group_idx)
+            graph.prototypes.setdefault((mesh_filepath, group_idx, texture_key),
+                                        []).append(n3node)
+    return graph
+
+
+def create_batch_meshes(operator, graph: BatchGraph):
+    """Read every nvx2 file once and create a mesh for each used group.
+
+    Files are read on a thread pool, the meshes of a file are created as soon
+    as it is read.
+    """
+    def read(mesh_filepath):
+        nvx2options = nvx2.Options()
+        nvx2options.nvx2filepath = mesh_filepath
+        # Files are read in parallel, each on a single thread
+        nvx2options.num_threads = 1
+        return nvx2options, import_nvx2.read_file_reported(reporter, nvx2options)
+
+    reporter = background.ReportCollector()
+    blen_meshes = {}
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for (nvx2options, mesh_data), (mesh_filepath, group_indices) in \
+                zip(executor.map(read, graph.meshes), graph.meshes.items()):
+            if not mesh_data:
+                continue
+            for group_idx in sorted(group_indices):
+                if group_idx >= len(mesh_data.groups):
+                    reporter.report({'WARNING'}, "No group " + str(group_idx) + " in '" +
+                                    mesh_filepath + "'")
+                    continue
+                blen_mesh, _ = import_nvx2.build_group_mesh(mesh_data, group_idx, nvx2options)
+                if blen_mesh:
+                    import_nvx2.store_source(blen_mesh, nvx2options, group_idx)
+                    blen_meshes[(mesh_filepath, group_idx)] = blen_mesh
+    reporter.flush(operator)
+    return blen_meshes
+
+
+def load_batch(context, operator, options: n3.Options, n3filepaths):
+    """Import many n3 files at once, meshes placed more than once are instanced.
+
+    Each nvx2 group, material and texture is created once for the whole batch.
+    Meshes with more than one placement become collections which aren't part
+    of the scene, every placement is an empty instancing that collection.
+    """
+    reporter = background.ReportCollector()
+    n3parsers = parse_batch(reporter, n3filepaths, options)
+    reporter.flush(operator)
+    graph = build_batch_graph(n3parsers, options)
+    for mesh_res in sorted(graph.missing):
+        print("WARNING: Could not find mesh " + mesh_res)
+
+    image_cache.budget = options.texture_budget * 1024 * 1024
+    blen_materials = {texture_key: create_material(node_name, dict(texture_key), n3options)
+                      for texture_key, (n3options, node_name) in graph.materials.items()}
+    blen_meshes = create_batch_meshes(operator, graph)
+
+    import_collection = import_nvx2.ImportCollection("n3_batch")
+    collection = import_collection.collection
+    num_instances = 0
+    for (mesh_filepath, group_idx, texture_key), n3nodes in graph.prototypes.items():
+        blen_mesh = blen_meshes.get((mesh_filepath, group_idx))
+        if not blen_mesh:
+            continue
+        name = os.path.splitext(os.path.basename(mesh_filepath))[0] + "_" + str(group_idx)
+        if texture_key and not blen_mesh.materials:
+            blen_mesh.materials.append(None)
+        blen_object = bpy.data.objects.new(name, blen_mesh)
+        if texture_key:
+            # The mesh may be shared by prototypes with different materials
+            blen_object.material_slots[0].link = 'OBJECT'
+            blen_object.material_slots[0].material = blen_materials[texture_key]
+
+        if len(n3nodes) == 1:
+            blen_object.matrix_world = mathutils.Matrix(compute_node_matrix(n3nodes[0]).tolist())
+            collection.objects.link(blen_object)
+            continue
+        instance_collection = bpy.data.collections.new(name)
+        instance_collection.objects.link(blen_object)
+        for n3node in n3nodes:
+            instance = bpy.data.objects.new(n3node.node_name, None)
+            instance.instance_type = 'COLLECTION'
+            instance.instance_collection = instance_collection
+            instance.matrix_world = mathutils.Matrix(compute_node_matrix(n3node).tolist())
+            collection.objects.link(instance)
+            num_instances += 1
+
+    # Characters need their own armatures, import them one by one
+    for n3parser in graph.skinned:
+        for _ in create_nodes(context, operator, n3parser, n3parser.options, collection):
+            pass
+
+    operator.report({'INFO'}, "Imported " + str(len(n3parsers)) + " files: " +
+                    str(len(blen_meshes)) + " unique meshes, " +
+                    str(len(blen_materials)) + " materials, " +
+                    str(len(graph.prototypes)) + " prototypes, " +
+                    str(num_instances) + " instances, " +
+                    str(len(graph.skinned)) + " characters")
+    operator.report({'INFO'}, import_collection.link(context))
     return {'FINISHED'}
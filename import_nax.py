@@ -1,43 +1,312 @@
 """TODO: DOC"""
 
-# import os
+import collections
+import os
 import struct
 
 import bpy
+import numpy as np
 
+from . import import_n3
 from . import nax2
 from . import nax3
 
 
-default_options = {"target_object" : None}
+default_options = {"target_object" : None,
+                   "clip_names" : None,
+                   "reduce_keys" : True,
+                   "reduce_tolerance" : 0.0001}
 
 
-def create_anims(context, nax_groups, nax_keys, nax_curves):
-    """TODO: DOC"""
-    scene = bpy.context.scene
-    for obj in scene:
-        pass
+# A clip ready to be turned into an action. curves is a list of
+# (joint index, nax3.CurveType, frames, keys, use_step) with the reduced keys,
+# markers a list of (name, key index)
+AnimClip = collections.namedtuple('AnimClip', 'name \
+                                               frames_per_key \
+                                               curves \
+                                               markers')
+
+# Pose bone property for each curve type and the key components it uses,
+# nax quaternions are (x, y, z, w), blender's (w, x, y, z)
+CURVE_CHANNELS = {nax3.CurveType.Translation: ('location', (0, 1, 2)),
+                  nax3.CurveType.Rotation: ('rotation_quaternion', (3, 0, 1, 2)),
+                  nax3.CurveType.Scale: ('scale', (0, 1, 2))}
+
+# Curves of a joint in nax2 files, in this order
+NAX2_CURVE_TYPES = (nax3.CurveType.Translation, nax3.CurveType.Rotation, nax3.CurveType.Scale)
+
+
+# Clip tables of already opened nax3 files
+# filepath => ((mtime, size), header, key_offset, clip_table)
+nax3_clip_tables = {}
+
+
+def read_keys(f, num_keys, byteorder='<'):
+    """Read the key block of a nax file into a (num_keys, 4) float array."""
+    keys = np.frombuffer(f.read(num_keys * 16), dtype=byteorder + 'f4').reshape(-1, 4)
+    # Swap big endian keys in one go
+    return keys.astype(np.float32, copy=False)
+
+
+def get_curve_keys(nax_keys, first_key_idx, num_keys, key_stride):
+    """Gather the keys of a single curve, keys are interleaved by key_stride."""
+    return nax_keys[first_key_idx + np.arange(num_keys) * key_stride]
+
+
+def make_quaternions_continuous(keys):
+    """Flip quaternions to the hemisphere of their predecessor.
+
+    q and -q are the same rotation, but blender interpolates each component
+    on its own, between q and -q that turns the long way around.
+    """
+    dots = np.sum(keys[1:] * keys[:-1], axis=1)
+    # Every flip also flips all following keys
+    signs = np.cumprod(np.where(dots < 0.0, -1.0, 1.0))
+    keys = keys.copy()
+    keys[1:] *= signs[:, None].astype(keys.dtype)
+    return keys
+
+
+def nlerp_keys(q0, q1, t):
+    """Normalized linear interpolation between two arrays of quaternions.
+
+    This is what blender plays back from linearly interpolated
+    rotation_quaternion f-curves.
+    """
+    q = q0 + (q1 - q0) * t[:, None]
+    lengths = np.linalg.norm(q, axis=1, keepdims=True)
+    return np.divide(q, lengths, out=np.zeros_like(q), where=lengths > 0.0)
+
+
+def key_error(a, b, is_rotation=False):
+    """Return the max. component error per key."""
+    err = np.max(np.abs(a - b), axis=1)
+    if is_rotation:
+        # q and -q are the same rotation
+        err = np.minimum(err, np.max(np.abs(a + b), axis=1))
+    return err
+
+
+def reduce_curve_keys(keys, tolerance, is_rotation=False, use_step=False):
+    """Remove keys which can be reproduced by interpolation.
+
+    Returns the frame indices and values of the remaining keys.
+    """
+    frames = np.arange(len(keys))
+    if len(keys) < 2:
+        return frames, keys
+
+    if is_rotation:
+        # Compared with what blender plays back, normalized quaternions
+        lengths = np.linalg.norm(keys, axis=1, keepdims=True)
+        keys = make_quaternions_continuous(
+            np.divide(keys, lengths, out=np.zeros_like(keys), where=lengths > 0.0))
+    # Constant curve, a single key is enough
+    if np.all(key_error(keys, keys[:1], is_rotation) <= tolerance):
+        return frames[:1], keys[:1]
+    # Only constant step curves can be reduced (for now)
+    if use_step or len(keys) < 3:
+        return frames, keys
+
+    # Every pass tries to remove every other of the remaining inner keys. This
+    # way the spans between the neighbours of the candidates don't overlap and
+    # each candidate can be checked independently against the original keys.
+    keep = np.ones(len(keys), dtype=bool)
+    changed = True
+    while changed:
+        changed = False
+        for parity in (0, 1):
+            kept = np.flatnonzero(keep)
+            candidates = kept[1+parity:-1:2]
+            if not len(candidates):
+                continue
+            pos = np.searchsorted(kept, candidates)
+            left = kept[pos-1]
+            right = kept[pos+1]
+            # Assign all original frames to the span they are in
+            span = np.searchsorted(right, frames, side='right')
+            in_span = span < len(candidates)
+            in_span[in_span] &= left[span[in_span]] < frames[in_span]
+            span = span[in_span]
+            span_frames = frames[in_span]
+            # Interpolate between span start and end
+            t = (span_frames - left[span]) / (right[span] - left[span])
+            if is_rotation:
+                interpolated = nlerp_keys(keys[left[span]], keys[right[span]], t)
+            else:
+                interpolated = keys[left[span]] + \
+                    (keys[right[span]] - keys[left[span]]) * t[:, None]
+            err = key_error(interpolated, keys[span_frames], is_rotation)
+            span_err = np.zeros(len(candidates))
+            np.maximum.at(span_err, span, err)
+            removable = candidates[span_err <= tolerance]
+            if len(removable):
+                keep[removable] = False
+                changed = True
+
+    return frames[keep], keys[keep]
+
+
+def reduce_clip_keys(clip_curves, tolerance):
+    """Reduce the keys of all curves in a clip.
+
+    clip_curves is a list of (keys, is_rotation, use_step), returns the list
+    of reduced (frames, keys) and the number of removed keys.
+    """
+    reduced_curves = []
+    num_removed = 0
+    for keys, is_rotation, use_step in clip_curves:
+        frames, reduced_keys = reduce_curve_keys(keys, tolerance, is_rotation, use_step)
+        num_removed += len(keys) - len(reduced_keys)
+        reduced_curves.append((frames, reduced_keys))
+    return reduced_curves, num_removed
+
+
+def reduce_keys(operator, options, curve_keys, clip_names):
+    """Optional reduction stage between reading and creating animations.
+
+    curve_keys is a per clip list of (keys, is_rotation, use_step), returns a per
+    clip list of (frames, keys) for each curve.
+    """
+    if not options["reduce_keys"]:
+        return [[(np.arange(len(keys)), keys) for keys, _, _ in per_clip_keys]
+                for per_clip_keys in curve_keys]
+
+    reduced_keys = []
+    total_removed = 0
+    for clip_name, per_clip_keys in zip(clip_names, curve_keys):
+        reduced_curves, num_removed = reduce_clip_keys(per_clip_keys,
+                                                       options["reduce_tolerance"])
+        num_keys = sum(len(keys) for keys, _, _ in per_clip_keys)
+        print("Clip '" + clip_name + "': removed " + str(num_removed) +
+              " of " + str(num_keys) + " keys")
+        reduced_keys.append(reduced_curves)
+        total_removed += num_removed
+    operator.report({'INFO'}, "Removed " + str(total_removed) + " redundant keys")
+    return reduced_keys
+
 
+def get_rest_transforms(joint_bones):
+    """Map joint indices to the rest translation and rotation relative to the parent bone."""
+    rest_transforms = {}
+    for joint_idx, bone in joint_bones.items():
+        matrix = bone.matrix_local
+        if bone.parent:
+            matrix = bone.parent.matrix_local.inverted() @ matrix
+        translation, rotation, _ = matrix.decompose()
+        rest_transforms[joint_idx] = (np.array(translation), rotation)
+    return rest_transforms
 
-def load_nax2(context, filepath):
+
+def quaternion_multiply(q0, q1):
+    """Multiply a (w, x, y, z) quaternion with an array of them."""
+    w0, x0, y0, z0 = q0
+    w1, x1, y1, z1 = q1.T
+    return np.stack((w0*w1 - x0*x1 - y0*y1 - z0*z1,
+                     w0*x1 + x0*w1 + y0*z1 - z0*y1,
+                     w0*y1 - x0*z1 + y0*w1 + z0*x1,
+                     w0*z1 + x0*y1 - y0*x1 + z0*w1), axis=1)
+
+
+def to_pose_values(curve_type, keys, rest_translation, rest_rotation):
+    """Convert parent relative joint keys to values relative to the bone's rest pose.
+
+    Bones have the joints' orientation and no scale, so each channel can be
+    converted on its own and reduced keys stay valid.
+    """
+    _, components = CURVE_CHANNELS[curve_type]
+    values = keys[:, components].astype(np.float64)
+    if curve_type == nax3.CurveType.Translation:
+        inv_rotation = np.array(rest_rotation.to_matrix().transposed())
+        values = (values - rest_translation) @ inv_rotation.T
+    elif curve_type == nax3.CurveType.Rotation:
+        # Keys which weren't reduced may still flip signs
+        values = make_quaternions_continuous(
+            quaternion_multiply(np.array(rest_rotation.conjugated()), values))
+    return values
+
+
+def create_action(clip: AnimClip, joint_bones, rest_transforms):
+    """Create an action with an f-curve per key component of every curve."""
+    action = bpy.data.actions.new(clip.name)
+    action.use_fake_user = True
+    for joint_idx, curve_type, frames, keys, use_step in clip.curves:
+        bone_name = joint_bones[joint_idx].name
+        channel, _ = CURVE_CHANNELS[curve_type]
+        data_path = 'pose.bones["' + bpy.utils.escape_identifier(bone_name) + '"].' + channel
+        values = to_pose_values(curve_type, keys, *rest_transforms[joint_idx])
+        key_frames = 1.0 + frames * clip.frames_per_key
+        # Keys were reduced against per component linear interpolation (normalized
+        # for rotations) or steps, which is what blender plays back
+        interpolation = np.full(len(frames), 0 if use_step else 1, dtype=np.int32)
+        for component_idx in range(values.shape[1]):
+            fcurve = action.fcurves.new(data_path, index=component_idx,
+                                        action_group=bone_name)
+            fcurve.keyframe_points.add(len(frames))
+            fcurve.keyframe_points.foreach_set(
+                'co', np.column_stack((key_frames, values[:, component_idx])).ravel())
+            # Enum values: 'CONSTANT' = 0, 'LINEAR' = 1
+            fcurve.keyframe_points.foreach_set('interpolation', interpolation)
+            fcurve.update()
+    for marker_name, key_idx in clip.markers:
+        marker = action.pose_markers.new(marker_name)
+        marker.frame = int(round(1.0 + key_idx * clip.frames_per_key))
+    return action
+
+
+def create_anims(context, operator, options, anim_clips):
+    """Create an action for each clip, the first one is assigned to the target.
+
+    Curves are mapped to bones by joint index, see import_n3.get_joint_bones().
+    """
+    armature_object = options["target_object"]
+    if not armature_object or armature_object.type != 'ARMATURE':
+        operator.report({'ERROR'}, "Select an armature to import animations to.")
+        return {'CANCELLED'}
+
+    joint_bones = import_n3.get_joint_bones(armature_object)
+    rest_transforms = get_rest_transforms(joint_bones)
+    actions = []
+    for clip in anim_clips:
+        missing_joints = {c[0] for c in clip.curves} - joint_bones.keys()
+        if missing_joints:
+            operator.report({'WARNING'}, "Clip '" + clip.name + "' animates " +
+                            str(len(missing_joints)) + " joints without a bone.")
+            clip = clip._replace(curves=[c for c in clip.curves if c[0] in joint_bones])
+        actions.append(create_action(clip, joint_bones, rest_transforms))
+    if not actions:
+        operator.report({'WARNING'}, "No clips to import.")
+        return {'CANCELLED'}
+
+    for pose_bone in armature_object.pose.bones:
+        pose_bone.rotation_mode = 'QUATERNION'
+    armature_object.animation_data_create().action = actions[0]
+    operator.report({'INFO'}, "Imported " + str(len(actions)) + " clips")
+    return {'FINISHED'}
+
+
+def get_frames_per_key(seconds_per_key, fps):
+    """Frames between two keys, one if the file has no timing."""
+    if seconds_per_key <= 0.0:
+        return 1.0
+    return seconds_per_key * fps
+
+
+def load_nax2(context, operator, options, filepath):
     """TODO: DOC"""
     with open(filepath, mode='rb') as f:
         # Read header
         header = nax2.Header._make(struct.unpack('<4s2i', f.read(12)))
         # Read groups
-        sfmt = '<4i2f1i512s'
-        ssize = struct.calcsize(sfmt)
-        nax2_groups = [nax2.Group._make(struct.unpack(sfmt, f.read(ssize)))
+        nax2_groups = [nax2.Group._make(struct.unpack(nax2.GROUP_FMT, f.read(nax2.GROUP_SIZE)))
                        for i in range(header.num_groups)]
         # Read curves, num_curves = (nc = nc+g.num_curves for g in nax2_groups)
-        sfmt = '<3i4f'
-        ssize = struct.calcsize(sfmt)
         nax2_curves = []
         for g in nax2_groups:
             per_group_curves = []
             nax2_curves.append(per_group_curves)
             for i in range(g.num_curves):
-                cdata = struct.unpack(sfmt, f.read(ssize))
+                cdata = struct.unpack(nax2.CURVE_FMT, f.read(nax2.CURVE_SIZE))
                 curve = nax2.Curve(ipol_type=cdata[0],
                                    first_key_idx=cdata[1],
                                    curve_type=i % 3,
@@ -45,58 +314,131 @@ def load_nax2(context, filepath):
                                    static_key=(tuple(cdata[3:])))
                 per_group_curves.append(curve)
         # Read keys
-        sfmt = '<4f'
-        ssize = 16
-        nax2_keys = [struct.unpack(sfmt, f.read(ssize))
-                     for i in range(header.num_keys)]
+        nax2_keys = read_keys(f, header.num_keys)
 
-        create_anims(context, nax2_groups, nax2_curves, [], nax2_keys)
-    return {'FINISHED'}
+    # Gather per curve keys, first_key_idx is absolute in nax2 files
+    nax2_curve_keys = []
+    for g, per_group_curves in zip(nax2_groups, nax2_curves):
+        per_group_keys = []
+        for c in per_group_curves:
+            if c.is_static:
+                keys = np.array([c.static_key], dtype=np.float32)
+            else:
+                keys = get_curve_keys(nax2_keys, c.first_key_idx, g.num_keys, g.key_stride)
+            per_group_keys.append((keys,
+                                   c.ipol_type == nax2.IpolType.Quat,
+                                   c.ipol_type == nax2.IpolType.Step))
+        nax2_curve_keys.append(per_group_keys)
+
+    group_names = ['group_' + str(i) for i in range(len(nax2_groups))]
+    nax2_reduced_keys = reduce_keys(operator, options, nax2_curve_keys, group_names)
+
+    fps = context.scene.render.fps / context.scene.render.fps_base
+    anim_clips = []
+    for group_name, g, per_group_keys, reduced_curves in \
+            zip(group_names, nax2_groups, nax2_curve_keys, nax2_reduced_keys):
+        # Each joint has a translation, rotation and scale curve
+        curves = [(curve_idx // 3, NAX2_CURVE_TYPES[curve_idx % 3], frames, keys, use_step)
+                  for curve_idx, ((_, _, use_step), (frames, keys))
+                  in enumerate(zip(per_group_keys, reduced_curves))]
+        anim_clips.append(AnimClip(group_name, get_frames_per_key(g.key_time, fps),
+                                   curves, []))
+    return create_anims(context, operator, options, anim_clips)
+
+
+def get_nax3_clip_table(f, filepath):
+    """Return the (cached) clip table of a nax3 file."""
+    stat = os.stat(filepath)
+    file_id = (stat.st_mtime_ns, stat.st_size)
+    cached = nax3_clip_tables.get(filepath)
+    if cached and cached[0] == file_id:
+        return cached[1:]
+
+    header, key_offset, clip_table = nax3.build_clip_table(f)
+    nax3_clip_tables[filepath] = (file_id, header, key_offset, clip_table)
+    return header, key_offset, clip_table
+
+
+def read_nax3_clip(f, key_offset, entry, byteorder='<'):
+    """Read events, curves and keys of a single clip from a nax3 file."""
+    event_fmt = nax3.with_byteorder(nax3.EVENT_FMT, byteorder)
+    curve_fmt = nax3.with_byteorder(nax3.CURVE_FMT, byteorder)
+    f.seek(entry.event_offset)
+    events = [nax3.Event._make(struct.unpack(event_fmt, f.read(nax3.EVENT_SIZE)))
+              for i in range(entry.clip.num_events)]
+    f.seek(entry.curve_offset)
+    curves = [nax3.CurveRaw._make(struct.unpack(curve_fmt, f.read(nax3.CURVE_SIZE)))
+              for i in range(entry.clip.num_curves)]
+    # Only read the keys in this clip's key range
+    f.seek(key_offset + entry.key_first * 16)
+    keys = read_keys(f, entry.key_count, byteorder)
+    return events, curves, keys
 
 
-def load_nax3(context, filepath):
+def load_nax3(context, operator, options, filepath):
     """TODO: DOC"""
-    # nax 3 is: header, list of (clip, event list, curve list), list of keys
+    clip_names = options["clip_names"]
     with open(filepath, mode='rb') as f:
-        # Read header
-        header = nax3.Header._make(struct.unpack('<4s2i', f.read(12)))
-        # Read Clips, events and curves
+        header, key_offset, clip_table = get_nax3_clip_table(f, filepath)
+        byteorder = nax3.get_byteorder(header.magic)
+        # Load all clips or only the requested ones
+        if clip_names is None:
+            clip_names = list(clip_table.keys())
+        else:
+            for clip_name in clip_names:
+                if clip_name not in clip_table:
+                    operator.report({'WARNING'}, "Clip '" + clip_name + "' not found.")
+            clip_names = [cn for cn in clip_names if cn in clip_table]
+
         nax3_clips = []
-        cl_fmt = '<5H2B1H64s'
-        cl_size = struct.calcsize(cl_fmt)
         nax3_events = []
-        ev_fmt = '<47s15s1H'
-        ev_size = struct.calcsize(ev_fmt)
         nax3_curves = []
-        cv_fmt = '<1i3B1B4f'
-        cv_size = struct.calcsize(cv_fmt)
-        for cl_idx in range(header.num_clips):
-            # Read clip data
-            clip = nax3.Clip._make(struct.unpack(cl_fmt, f.read(cl_size)))
-            nax3_clips.append(clip)
-            # Read events
-            per_clip_events = \
-                [nax3.Event._make(struct.unpack(ev_fmt, f.read(ev_size)))
-                 for i in range(clip.num_events)]
+        nax3_clip_keys = []
+        for clip_name in clip_names:
+            entry = clip_table[clip_name]
+            per_clip_events, per_clip_curves, per_clip_keys = \
+                read_nax3_clip(f, key_offset, entry, byteorder)
+            nax3_clips.append(entry.clip)
             nax3_events.append(per_clip_events)
-            # Read curves
-            per_clip_curves = \
-                [nax3.CurveRaw._make(struct.unpack(cv_fmt, f.read(cv_size)))
-                 for i in range(clip.num_curves)]
             nax3_curves.append(per_clip_curves)
-        # Read keys
-        k_fmt = '<4f'
-        k_size = 16
-        nax2_keys = [struct.unpack(k_fmt, f.read(k_size))
-                     for i in range(header.num_keys)]
+            nax3_clip_keys.append(per_clip_keys)
 
-        create_anims(context, nax3_clips, nax3_curves, nax3_events, nax2_keys)
-    return {'FINISHED'}
+    # Gather per curve keys, first_key_idx is relative to the clip's start key
+    nax3_curve_keys = []
+    for clip, per_clip_curves, clip_keys in zip(nax3_clips, nax3_curves, nax3_clip_keys):
+        per_clip_keys = []
+        for c in per_clip_curves:
+            if c.is_static:
+                keys = np.array([(c.key_x, c.key_y, c.key_z, c.key_w)], dtype=np.float32)
+            else:
+                keys = get_curve_keys(clip_keys,
+                                      c.first_key_idx,
+                                      clip.num_keys,
+                                      clip.key_stride)
+            per_clip_keys.append((keys, c.curve_type == nax3.CurveType.Rotation, False))
+        nax3_curve_keys.append(per_clip_keys)
 
+    nax3_reduced_keys = reduce_keys(operator, options, nax3_curve_keys, clip_names)
+
+    fps = context.scene.render.fps / context.scene.render.fps_base
+    anim_clips = []
+    for clip_name, clip, per_clip_curves, per_clip_events, reduced_curves in \
+            zip(clip_names, nax3_clips, nax3_curves, nax3_events, nax3_reduced_keys):
+        # Each joint has a translation, rotation and scale curve
+        curves = [(curve_idx // 3, nax3.CurveType(c.curve_type), frames, keys, False)
+                  for curve_idx, (c, (frames, keys))
+                  in enumerate(zip(per_clip_curves, reduced_curves))
+                  if c.is_active and c.curve_type in CURVE_CHANNELS]
+        markers = [(e.event_name.split(b'\0', 1)[0].decode('ascii', 'replace'), e.key_index)
+                   for e in per_clip_events]
+        anim_clips.append(AnimClip(clip_name,
+                                   get_frames_per_key(clip.key_duration / 1000.0, fps),
+                                   curves, markers))
+    return create_anims(context, operator, options, anim_clips)
 
-def load(context, options, filepath=''):
-    """Called by the user interface or another script."""
-    # only nax2, nax3 seems to be unimplemented
-    load_nax2(context, filepath)
 
-    return {'CANCELLED'}
+def load(context, operator, options, filepath=''):
+    """Called by the user interface or another script."""
+    if os.path.splitext(filepath)[1].lower() == '.nax3':
+        return load_nax3(context, operator, options, filepath)
+    return load_nax2(context, operator, options, filepath)
@@ -1,225 +1,280 @@
 """Library to import nvx2 model files"""
 
 import os
-import struct
+import time
 
 import bpy
-from bpy_extras.io_utils import unpack_list
+import numpy as np
 
 from . import nvx2
 
 
-def fps2float(n):
-    """Convert fixed point short into a float"""
-    return float(n) / 8191.0
-
-
-def fpb2float(n):
-    """Convert fixed point byte into a float"""
-    return float(n) / 255.0
-
+class ImportCollection:
+    """Collects the objects of an import outside the scene, linked in one go.
+
+    Every object linked to a collection of the scene makes blender resync
+    the view layers and depsgraph relations, for big imports this adds up.
+    """
+
+    def __init__(self, name):
+        self.collection = bpy.data.collections.new(name)
+        self.start_time = time.perf_counter()
+
+
+    def link(self, context):
+        """Link the collection to the scene (or remove it if empty), returns a summary."""
+        num_objects = len(self.collection.all_objects)
+        if not num_objects:
+            bpy.data.collections.remove(self.collection)
+            return "Nothing imported"
+
+        create_time = time.perf_counter() - self.start_time
+        context.scene.collection.children.link(self.collection)
+        context.view_layer.update()
+        link_time = time.perf_counter() - self.start_time - create_time
+        return ("Imported " + str(num_objects) + " objects in " +
+                "{:.2f}".format(create_time + link_time) + "s, linked to the scene once in " +
+                "{:.2f}".format(link_time) + "s instead of " + str(num_objects) +
+                " scene updates")
+
+
+def find_close_pairs(positions, distance):
+    """Return index arrays (i, j), i < j, of all positions closer than distance.
+
+    Positions are sorted into a grid of cells of that size, only positions in
+    the same or neighbouring cells are compared. Returns None if the grid
+    would be too large to index.
+    """
+    cells = np.floor(positions / distance).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    # One empty cell on each side for the neighbour lookups
+    dims = cells.max(axis=0) + 2
+    if float(np.prod(dims.astype(np.float64))) >= 2.0**62:
+        return None
+    strides = np.array([dims[1] * dims[2], dims[2], 1], dtype=np.int64)
+    keys = cells @ strides
+    # Work in key order, lookups of sorted keys are much faster
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    positions = positions[order]
+
+    pairs_i = []
+    pairs_j = []
+    point_idx = np.arange(len(positions))
+    # The same cell and half of the neighbours, the other half finds the same pairs
+    offsets = [offset for offset in np.ndindex(3, 3, 3) if offset >= (1, 1, 1)]
+    for offset in offsets:
+        neighbour_keys = keys + (np.array(offset, dtype=np.int64) - 1) @ strides
+        start = np.searchsorted(keys, neighbour_keys, side='left')
+        counts = np.searchsorted(keys, neighbour_keys, side='right') - start
+        if not counts.any():
+            continue
+        i = np.repeat(point_idx, counts)
+        run_start = np.repeat(np.cumsum(counts) - counts, counts)
+        j = np.repeat(start, counts) + np.arange(len(i)) - run_start
+        if offset == (1, 1, 1):
+            # Within a cell each pair is found twice
+            is_pair = i < j
+            i = i[is_pair]
+            j = j[is_pair]
+        is_close = np.sum((positions[i] - positions[j])**2, axis=1) < distance * distance
+        pairs_i.append(order[i[is_close]])
+        pairs_j.append(order[j[is_close]])
+    if not pairs_i:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pairs_i = np.concatenate(pairs_i)
+    pairs_j = np.concatenate(pairs_j)
+    return np.minimum(pairs_i, pairs_j), np.maximum(pairs_i, pairs_j)
+
+
+def weld_vertices(nvx2_vertices, weld_distance=0.0):
+    """Merge vertices with the same position.
+
+    Returns the welded positions and a map from old to new vertex indices.
+    Positions are compared exactly or, if weld_distance > 0, every vertex is
+    merged into the first (kept) vertex closer than weld_distance, if any.
+    """
+    # Adding 0.0 turns -0.0 into 0.0
+    _, first_idx, inverse = np.unique(nvx2_vertices + 0.0, axis=0,
+                                      return_index=True, return_inverse=True)
+    # Keep vertices in order of their first occurrence
+    order = np.argsort(first_idx)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    vertex_remap = rank[inverse.reshape(-1)]
+    positions = nvx2_vertices[first_idx[order]]
+
+    close_pairs = None
+    if weld_distance > 0.0 and len(positions) > 1 and np.all(np.isfinite(positions)):
+        close_pairs = find_close_pairs(positions.astype(np.float64), weld_distance)
+    if close_pairs is not None and len(close_pairs[0]):
+        # Greedy in vertex order, merged vertices can't be merge targets.
+        # Only pairs are visited, not every vertex
+        pairs_i, pairs_j = close_pairs
+        pair_order = np.lexsort((pairs_i, pairs_j))
+        target = list(range(len(positions)))
+        for i, j in zip(pairs_i[pair_order].tolist(), pairs_j[pair_order].tolist()):
+            if target[j] == j and target[i] == i:
+                target[j] = i
+        target = np.array(target)
+        is_kept = target == np.arange(len(positions))
+        new_idx = np.cumsum(is_kept) - 1
+        vertex_remap = new_idx[target][vertex_remap]
+        positions = positions[is_kept]
+    return positions, vertex_remap.astype(np.int32)
+
+
+def create_weights(blen_object, nvx2_weights, nvx2_weight_idx,
+                   joint_names=None, joint_palette=None, vertex_offset=0,
+                   vertex_remap=None):
+    """Adds vertex groups to an blender object.
+
+    Joint indices are mapped through the skin fragment's joint palette (if
+    any) to skeleton joints, one vertex group is created per joint.
+    """
+    if nvx2_weights is None or nvx2_weight_idx is None:
+        return
 
-def make_vertexformat(vertex_components, nvx2version=3):
-    """Build the struct format string to read vertices"""
-    vertex_fmt = '<'
-    if nvx2version == 2:
-        # nvx2 files for Nebula 2
-        for vcmask, vcdata in nvx2.VertexComponentsN2.items():
-            if vcmask & vertex_components:
-                vertex_fmt += vcdata.format
-    else:
-        # DEFAULT: nvx2 files for Nebula 3
-        for vcmask, vcdata in nvx2.VertexComponentsN3.items():
-            if vcmask & vertex_components:
-                vertex_fmt += vcdata.format
-    return vertex_fmt
-
-
-def detect_version(vertex_components, vertex_width):
-    """Attempt to detect nvx2 version from vertex components and vertex width."""
-    versions = [3, 2]
-    for v in versions:
-        vertex_fmt = make_vertexformat(vertex_components, v)
-        if struct.calcsize(vertex_fmt) == vertex_width:
-            return v
-    # Always default to 3
-    return 3
-
-
-def unpack_vertexdata(vertices, vertex_components, nvx2version=3):
-    """TODO:Doc."""
-    vert_coords = []
-    vert_uvs = [[], [], [], []]
-    vert_weights = []
-    vert_weight_idx = []
-    vert_colors = []
-    offset = 0
-
-    # Data sources depends on nvx2 version
-    vcmask_data = None
-    vcdata = None
-    if nvx2version == 2:
-        vcmask_data = nvx2.VertexComponentMaskN2
-        vcdata = nvx2.VertexComponentsN2
-    else:
-        # Default to N3
-        vcmask_data = nvx2.VertexComponentMaskN3
-        vcdata = nvx2.VertexComponentsN3
-
-    # Start unpacking data
-    vcmask = vcmask_data.Coord
-    if vcmask & vertex_components:
-        vert_coords = [(v[offset+0], v[offset+1], v[offset+2]) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Normal
-    if vcmask & vertex_components:
-        # Ignoring normals for now
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.NormalUB4N
-    if vcmask & vertex_components:
-        # Ignoring normals for now
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Uv0
-    if vcmask & vertex_components:
-        vert_uvs[0] = [(v[offset+0], v[offset+1]) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Uv0S2
-    if vcmask & vertex_components:
-        vert_uvs[0] = [(fps2float(v[offset+0]), 1-fps2float(v[offset+1]))
-                        for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Uv1
-    if vcmask & vertex_components:
-        vert_uvs[1] = [(v[offset+0], v[offset+1]) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Uv1S2
-    if vcmask & vertex_components:
-        vert_uvs[1] = [(fps2float(v[offset+0]), 1-fps2float(v[offset+1]))
-                        for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Uv2
-    if vcmask & vertex_components:
-        vert_uvs[2] = [(v[offset+0], v[offset+1]) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Uv2S2
-    if vcmask & vertex_components:
-        vert_uvs[2] = [(fps2float(v[offset+0]), 1-fps2float(v[offset+1]))
-                        for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Uv3
-    if vcmask & vertex_components:
-        vert_uvs[3] = [(v[offset+0], v[offset+1]) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Uv3S2
-    if vcmask & vertex_components:
-        vert_uvs[3] = [(fps2float(v[offset+0]), 1-fps2float(v[offset+1])) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Color
-    if vcmask & vertex_components:
-        vert_colors = [(v[offset+0], v[offset+1], v[offset+2], v[offset+3]) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.ColorUB4N
-    if vcmask & vertex_components:
-        vert_colors = [(fpb2float(v[offset+0]),
-                        fpb2float(v[offset+1]),
-                        fpb2float(v[offset+2]),
-                        fpb2float(v[offset+3])) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Tangent
-    if vcmask & vertex_components:
-        # Ignoring tangents for now
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.TangentUB4N
-    if vcmask & vertex_components:
-        # Ignoring tangents for now
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Binormal
-    if vcmask & vertex_components:
-        # Ignoring binormal sign for now
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.BinormalUB4N
-    if vcmask & vertex_components:
-        # Ignoring binormal sign for now
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.Weights
-    if vcmask & vertex_components:
-        vert_weights = [(v[offset+0], v[offset+1], v[offset+2], v[offset+3]) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.WeightsUB4N
-    if vcmask & vertex_components:
-        vert_weights = [(fpb2float(v[offset+0]),
-                         fpb2float(v[offset+1]),
-                         fpb2float(v[offset+2]),
-                         fpb2float(v[offset+3])) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.JIndices
-    if vcmask & vertex_components:
-        vert_weight_idx = [(v[offset+0], v[offset+1], v[offset+2], v[offset+3]) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    vcmask = vcmask_data.JIndicesUB4
-    if vcmask & vertex_components:
-        vert_weight_idx = [(fpb2float(v[offset+0]),
-                            fpb2float(v[offset+1]),
-                            fpb2float(v[offset+2]),
-                            fpb2float(v[offset+3])) for v in vertices]
-        offset += vcdata[vcmask].count
-
-    return vert_coords, vert_uvs, vert_weights, vert_weight_idx, vert_colors
-
-
-def create_weights(blen_object, nvx2_weights, nvx2_weight_idx):
-    """Adds vertex groups to an blender object."""
-    if nvx2_weights and nvx2_weight_idx:
-        # Every vertex may have up to four weights
-        # TODO: Find out why the weight index is a float (which bone the weight belongs to)
-        #       Apparently, sorting the floats will match the int index (maybe)
-        created_groups = 0
-        for vert_id, (weight_list, index_list) in enumerate(zip(nvx2_weights, nvx2_weight_idx)):
-            for weight, weight_idx in zip(weight_list, index_list):
-                vgroup_name = "nvx2_"+str(weight_idx)
-                if vgroup_name in blen_object.vertex_groups:
-                    vgroup = blen_object.vertex_groups[vgroup_name]
-                else:
-                    vgroup = blen_object.vertex_groups.new(name=vgroup_name)
-                    created_groups += 1
-
-                vgroup.add([vert_id], weight, 'REPLACE')
-        print('created_groups='+str(created_groups))
-
-
-def create_mesh(nvx2_vertices, nvx2_faces, nvx2_uvlayers, nvx2_colors, options: nvx2.Options):
-    """Create a mesh for use with an blender object."""
-    blen_mesh = bpy.data.meshes.new('nvx2_mesh')
+    # Every vertex may have up to four weights
+    weights = np.asarray(nvx2_weights, dtype=np.float32)
+    joints = np.asarray(nvx2_weight_idx, dtype=np.int64)
+    used = weights > 0.0
+    if joint_palette:
+        joint_palette = np.asarray(joint_palette, dtype=np.int64)
+        used &= (joints >= 0) & (joints < len(joint_palette))
+        joints[used] = joint_palette[joints[used]]
+    vert_ids = np.arange(vertex_offset, vertex_offset + len(weights))
+    if vertex_remap is not None:
+        vert_ids = vertex_remap[vert_ids]
+    vert_ids = np.broadcast_to(vert_ids[:, None], weights.shape)[used]
+    joints = joints[used]
+    weights = weights[used]
+
+    # Vertices with the same joint and weight can be added in one go
+    order = np.lexsort((weights, joints))
+    vert_ids = vert_ids[order]
+    joints = joints[order]
+    weights = weights[order]
+    splits = np.flatnonzero((np.diff(joints) != 0) | (np.diff(weights) != 0)) + 1
+
+    created_groups = 0
+    for vids, joint, weight in zip(np.split(vert_ids, splits),
+                                   joints[np.r_[0, splits]],
+                                   weights[np.r_[0, splits]]):
+        if joint_names and joint < len(joint_names):
+            vgroup_name = joint_names[joint]
+        else:
+            vgroup_name = "nvx2_" + str(joint)
+        vgroup = blen_object.vertex_groups.get(vgroup_name)
+        if not vgroup:
+            vgroup = blen_object.vertex_groups.new(name=vgroup_name)
+            created_groups += 1
+        vgroup.add(vids.tolist(), float(weight), 'REPLACE')
+    print('created_groups='+str(created_groups))
+
+
+def match_loop_edges(loop_vertices, nvx2_edges, num_vertices):
+    """Match every loop to an edge from the nvx2 edge section.
+
+    Returns the unique edges and the edge index for every loop, or None if
+    the edge section doesn't contain all edges of the faces.
+    """
+    # Edges are unordered, use (min, max) as key
+    edge_keys = np.unique(np.min(nvx2_edges, axis=1).astype(np.int64) * num_vertices +
+                          np.max(nvx2_edges, axis=1))
+    # Loop i goes from its vertex to the next one in the face
+    face_vertices = loop_vertices.reshape(-1, 3)
+    next_vertices = np.roll(face_vertices, -1, axis=1).ravel()
+    loop_keys = np.minimum(loop_vertices, next_vertices).astype(np.int64) * num_vertices + \
+        np.maximum(loop_vertices, next_vertices)
+    loop_edge_index = np.searchsorted(edge_keys, loop_keys)
+    loop_edge_index[loop_edge_index >= len(edge_keys)] = 0
+    if not np.array_equal(edge_keys[loop_edge_index], loop_keys):
+        return None
+    # Drop edges not used by any face (i.e. from welded vertices)
+    used_edges, loop_edge_index = np.unique(loop_edge_index, return_inverse=True)
+    edge_keys = edge_keys[used_edges]
+    edges = np.stack((edge_keys // num_vertices, edge_keys % num_vertices), axis=1)
+    return edges.astype(np.int32), loop_edge_index.reshape(-1).astype(np.int32)
+
+
+def find_mesh_issues(nvx2_vertices, nvx2_faces, vertex_remap=None):
+    """Check mesh data for problems blender's validate() would fix.
+
+    Returns the number of faces with out of range indices, degenerate faces,
+    duplicate faces and vertices with NaN or inf positions.
+    """
+    num_vertices = len(vertex_remap) if vertex_remap is not None else len(nvx2_vertices)
+    in_range = np.all((nvx2_faces >= 0) & (nvx2_faces < num_vertices), axis=1)
+    faces = nvx2_faces[in_range]
+    if vertex_remap is not None:
+        faces = vertex_remap[faces]
+    is_degenerate = (faces[:, 0] == faces[:, 1]) | \
+                    (faces[:, 1] == faces[:, 2]) | \
+                    (faces[:, 2] == faces[:, 0])
+    # Faces using the same vertices are duplicates, regardless of order
+    sorted_faces = np.sort(faces[~is_degenerate], axis=1)
+    num_unique_faces = len(np.unique(sorted_faces, axis=0))
+    is_finite = np.all(np.isfinite(nvx2_vertices), axis=1)
+    return nvx2.MeshIssues(invalid_indices=int(np.count_nonzero(~in_range)),
+                           degenerate_faces=int(np.count_nonzero(is_degenerate)),
+                           duplicate_faces=len(sorted_faces) - num_unique_faces,
+                           invalid_positions=int(np.count_nonzero(~is_finite)))
+
+
+def report_mesh_issues(group_idx, mesh_issues):
+    """Print mesh issues found for a group, -1 for a mesh of all groups."""
+    if any(mesh_issues):
+        print(("All groups" if group_idx < 0 else "Group " + str(group_idx)) + ": " +
+              str(mesh_issues))
+
+
+def create_mesh(nvx2_vertices, nvx2_faces, nvx2_uvlayers, nvx2_colors, options: nvx2.Options,
+                nvx2_material_indices=None, vertex_remap=None, nvx2_edges=None,
+                mesh_issues=None, blen_mesh=None):
+    """Create a mesh for use with an blender object.
+
+    If vertices were welded, faces, edges, uvs and colors still refer to the
+    original vertices and are mapped with vertex_remap. Validation is skipped
+    if mesh_issues (from find_mesh_issues) says the mesh is clean. If an
+    (empty) blen_mesh is passed it will be filled instead of creating a new one.
+    """
+    if blen_mesh is None:
+        blen_mesh = bpy.data.meshes.new('nvx2_mesh')
+    num_faces = len(nvx2_faces)
     # Add vertices
     blen_mesh.vertices.add(len(nvx2_vertices))
-    blen_mesh.vertices.foreach_set('co', unpack_list(nvx2_vertices))
-    # Create loops
-    blen_mesh.loops.add(len(nvx2_faces) * 3)
-    blen_mesh.loops.foreach_set('vertex_index', unpack_list(nvx2_faces))
+    blen_mesh.vertices.foreach_set('co', nvx2_vertices.ravel())
+    # Create loops, per loop data is taken from the original vertices
+    loop_vertices = nvx2_faces.ravel()
+    num_data_vertices = len(vertex_remap) if vertex_remap is not None else len(nvx2_vertices)
+    # Out of range indices are left for validate() to remove, don't use them for lookups
+    in_range = (loop_vertices >= 0) & (loop_vertices < num_data_vertices)
+    all_in_range = np.all(in_range)
+    if not all_in_range:
+        loop_vertices = np.where(in_range, loop_vertices, 0)
+    blen_mesh.loops.add(num_faces * 3)
+    mesh_loop_vertices = nvx2_faces.ravel()
+    if vertex_remap is not None:
+        mesh_loop_vertices = np.where(in_range, vertex_remap[loop_vertices], len(nvx2_vertices))
+    blen_mesh.loops.foreach_set('vertex_index', mesh_loop_vertices)
+    # Create edges from the nvx2 edge section. If there is none (or it is
+    # incomplete) blender will calculate edges from the loops in update()
+    if nvx2_edges is not None and len(nvx2_edges) and len(mesh_loop_vertices) and \
+       all_in_range and np.all((nvx2_edges >= 0) & (nvx2_edges < num_data_vertices)):
+        mesh_edges = nvx2_edges
+        if vertex_remap is not None:
+            mesh_edges = vertex_remap[nvx2_edges]
+        loop_edges = match_loop_edges(mesh_loop_vertices, mesh_edges, len(nvx2_vertices))
+        if loop_edges:
+            edges, loop_edge_index = loop_edges
+            blen_mesh.edges.add(len(edges))
+            blen_mesh.edges.foreach_set('vertices', edges.ravel())
+            blen_mesh.loops.foreach_set('edge_index', loop_edge_index)
     # Create polygons
-    blen_mesh.polygons.add(len(nvx2_faces))
-    blen_mesh.polygons.foreach_set('loop_start', range(0, len(nvx2_faces) * 3, 3))
-    blen_mesh.polygons.foreach_set('loop_total', (3,) * len(nvx2_faces))
+    blen_mesh.polygons.add(num_faces)
+    blen_mesh.polygons.foreach_set('loop_start', np.arange(0, num_faces * 3, 3, dtype=np.int32))
+    blen_mesh.polygons.foreach_set('loop_total', np.full(num_faces, 3, dtype=np.int32))
     # Whole thing might still be empty. If so, there is nothing further to do
     if not blen_mesh.polygons:
         return
@@ -227,140 +282,285 @@ def create_mesh(nvx2_vertices, nvx2_faces, nvx2_uvlayers, nvx2_colors, options:
     num_blen_polygons = len(blen_mesh.polygons)
 
     if options.use_smooth:
-        blen_mesh.polygons.foreach_set('use_smooth', [True] * num_blen_polygons)
+        blen_mesh.polygons.foreach_set('use_smooth', np.ones(num_blen_polygons, dtype=bool))
+
+    if nvx2_material_indices is not None:
+        blen_mesh.polygons.foreach_set('material_index', nvx2_material_indices)
 
     # Add texture coordinates
     if options.create_uvs:
         for uv_idx, uv_data in enumerate(nvx2_uvlayers):
             # uv_data contains per-vertex uv coordinates
-            if uv_data:
-                face_uv_coords = [(uv_data[f[0]], uv_data[f[1]], uv_data[f[2]])
-                                  for f in nvx2_faces]
-                face_uv_coords = unpack_list(unpack_list(face_uv_coords))
+            if uv_data is not None:
                 uv_layer = blen_mesh.uv_layers.new(do_init=False)
                 uv_layer.name = "nvx2_uv"+str(uv_idx)
-                uv_layer.data.foreach_set('uv', face_uv_coords[:2*len(uv_layer.data)])
-
-    if options.create_colors and nvx2_colors:
-        blen_colors = blen_mesh.vertex_colors.new("nvx2_colors")
-        # Get all loops for each vertex
-        vert_loop_map = {}
-        for lp in blen_mesh.loops:
-            if lp.vertex_index in vert_loop_map:
-                vert_loop_map[lp.vertex_index].append(lp.index)
-            else:
-                vert_loop_map[lp.vertex_index] = [lp.index]
-        # Set color for each vertex (in every loop)
+                uv_layer.data.foreach_set('uv', uv_data[loop_vertices].ravel())
+
+    if options.create_colors and nvx2_colors is not None:
+        blen_colors = blen_mesh.vertex_colors.new(name="nvx2_colors")
         # BUGFIX: colors have dim 4 on some systems
         #         (should be 3 as per documentation)
         color_dim = len(blen_colors.data[0].color)
-        if color_dim > 3:
-            for vidx in vert_loop_map:
-                for lidx in vert_loop_map[vidx]:
-                    blen_colors.data[lidx].color = nvx2_colors[vidx][0:4]
-        else:  # Keep the right way separate for speed
-            for vidx in vert_loop_map:
-                for lidx in vert_loop_map[vidx]:
-                    blen_colors.data[lidx].color = nvx2_colors[vidx][0:3]
+        blen_colors.data.foreach_set('color', nvx2_colors[loop_vertices, :color_dim].ravel())
 
-    if options.use_mesh_validation:
+    if options.use_mesh_validation and (mesh_issues is None or any(mesh_issues)):
         blen_mesh.validate(verbose=False, clean_customdata=False)
 
     blen_mesh.update()
     return blen_mesh
 
 
-def load(context, operator, options: nvx2.Options):
-    """Called by the user interface or another script."""
+def link_object(blen_object, parent_empty, collection, options: nvx2.Options):
+    """Bind an object to armature and parent, then link it to the collection."""
+    # Bind to armature
+    if options.armature_object:
+        modifier = blen_object.modifiers.new('nvx2_armature', 'ARMATURE')
+        modifier.object = options.armature_object
+    # Link new object to scene/collection
+    if parent_empty:
+        blen_object.parent = parent_empty
+    else:
+        blen_object.parent = options.parent_object or options.armature_object
+    collection.objects.link(blen_object)
+
+
+def build_group_mesh(mesh_data, group_idx, options: nvx2.Options, blen_mesh=None):
+    """Create (or refill) the mesh for a single group.
+
+    A group_idx of -1 puts all groups into a single mesh, with one material
+    slot per group. Returns the mesh and the vertex map from welding (if any).
+    """
+    nvx2_groups = mesh_data.groups
+    nvx2_material_indices = None
+    if group_idx < 0:
+        # One mesh for the whole file, one material slot per group
+        grp_faces = mesh_data.faces
+        grp_edges = mesh_data.edges
+        grp_verts = mesh_data.vertices
+        grp_uvs = mesh_data.uvlayers
+        grp_colors = mesh_data.colors
+        nvx2_material_indices = np.zeros(len(grp_faces), dtype=np.int32)
+        for i, g in enumerate(nvx2_groups):
+            nvx2_material_indices[g.triangle_first:g.triangle_first+g.triangle_count] = i
+    else:
+        g = nvx2_groups[group_idx]
+        gvf = g.vertex_first
+        gvc = g.vertex_count
+        gtf = g.triangle_first
+        gtc = g.triangle_count
+        # Get vertex data for this object
+        grp_faces = mesh_data.faces[gtf:gtf+gtc] - gvf
+        grp_edges = mesh_data.edges[g.edge_first:g.edge_first+g.edge_count] - gvf
+        grp_verts = mesh_data.vertices[gvf:gvf+gvc]
+        grp_uvs = [uvl[gvf:gvf+gvc] if uvl is not None else None
+                   for uvl in mesh_data.uvlayers]
+        grp_colors = mesh_data.colors[gvf:gvf+gvc] if mesh_data.colors is not None else None
+
+    vertex_remap = None
+    if options.use_weld_vertices:
+        grp_verts, vertex_remap = weld_vertices(grp_verts, options.weld_distance)
+
+    mesh_issues = None
+    if options.use_mesh_validation:
+        # Checked on the faces of the whole mesh, for a single mesh duplicates
+        # may span groups and positions must only be counted once
+        mesh_issues = find_mesh_issues(grp_verts, grp_faces, vertex_remap)
+        report_mesh_issues(group_idx, mesh_issues)
+
+    mesh = create_mesh(grp_verts, grp_faces, grp_uvs, grp_colors, options,
+                       nvx2_material_indices, vertex_remap, grp_edges, mesh_issues, blen_mesh)
+    if mesh and group_idx < 0:
+        while len(mesh.materials) < len(nvx2_groups):
+            mesh.materials.append(None)
+        # Keep the group table to allow splitting the mesh later
+        mesh['nvx2_groups'] = [list(g) for g in nvx2_groups]
+    return mesh, vertex_remap
+
+
+def build_group_weights(blen_object, mesh_data, group_idx, options: nvx2.Options,
+                        vertex_remap=None):
+    """Create vertex weights for a single group (or all groups if group_idx is -1)."""
+    if not options.create_weights or \
+       mesh_data.weights is None or mesh_data.weight_indices is None:
+        return
+
+    if group_idx < 0:
+        groups = list(enumerate(mesh_data.groups))
+    else:
+        groups = [(group_idx, mesh_data.groups[group_idx])]
+    for i, g in groups:
+        gvf = g.vertex_first
+        create_weights(blen_object,
+                       mesh_data.weights[gvf:gvf+g.vertex_count],
+                       mesh_data.weight_indices[gvf:gvf+g.vertex_count],
+                       options.joint_names,
+                       options.skin_fragments.get(i),
+                       gvf if group_idx < 0 else 0,
+                       vertex_remap)
+
+
+def store_source(blen_mesh, options: nvx2.Options, group_idx):
+    """Remember where a mesh came from and how, for reloading it later."""
+    blen_mesh["nvx2_filepath"] = options.nvx2filepath
+    blen_mesh["nvx2_group_idx"] = group_idx
+    blen_mesh["nvx2_mtime"] = os.path.getmtime(options.nvx2filepath)
+    blen_mesh["nvx2_options"] = {"nvx2version": options.nvx2version,
+                                 "use_smooth": options.use_smooth,
+                                 "use_mesh_validation": options.use_mesh_validation,
+                                 "use_weld_vertices": options.use_weld_vertices,
+                                 "weld_distance": options.weld_distance,
+                                 "create_uvs": options.create_uvs,
+                                 "create_weights": options.create_weights,
+                                 "create_colors": options.create_colors}
+    if options.joint_names:
+        blen_mesh["nvx2_joint_names"] = list(options.joint_names)
+        blen_mesh["nvx2_skin_fragments"] = {str(k): list(v)
+                                            for k, v in options.skin_fragments.items()}
+
+
+def options_from_mesh(blen_mesh):
+    """Restore the options a mesh was imported with, see store_source()."""
+    options = nvx2.Options(**blen_mesh["nvx2_options"].to_dict())
+    options.nvx2filepath = blen_mesh["nvx2_filepath"]
+    if "nvx2_joint_names" in blen_mesh:
+        options.joint_names = list(blen_mesh["nvx2_joint_names"])
+        options.skin_fragments = {int(k): list(v)
+                                  for k, v in blen_mesh["nvx2_skin_fragments"].items()}
+    return options
+
+
+def create_objects(context, mesh_data, options: nvx2.Options, filename, collection=None):
+    """Create blender objects from decoded nvx2 data.
+
+    Objects are linked to collection, the scene's collection if None. This is
+    a generator, yielding after each created object.
+    """
+    if collection is None:
+        collection = context.scene.collection
+
+    parent_empty = None
+    if options.create_parent_empty:
+        parent_empty = bpy.data.objects.new(filename, None)
+        parent_empty.location = (0.0, 0.0, 0.0)
+        parent_empty.parent = options.parent_object or options.armature_object
+        collection.objects.link(parent_empty)
+
+    if options.use_single_mesh:
+        group_indices = [-1]
+    else:
+        group_indices = [i for i in range(len(mesh_data.groups))
+                         if not options.groups or i in options.groups]
+
+    # Create objects
+    for group_idx in group_indices:
+        mesh, vertex_remap = build_group_mesh(mesh_data, group_idx, options)
+        if mesh:
+            store_source(mesh, options, group_idx)
+        obj = bpy.data.objects.new(filename if group_idx < 0 else 'nvx2_object', mesh)
+        build_group_weights(obj, mesh_data, group_idx, options, vertex_remap)
+        link_object(obj, parent_empty, collection, options)
+        yield obj
+
+
+def reload_meshes(filepath, blen_meshes):
+    """Re-read an nvx2 file and update the meshes imported from it in place."""
+    options = options_from_mesh(blen_meshes[0])
+    mesh_data = nvx2.read_file(filepath, options.nvx2version, options.num_threads)
+    for blen_mesh in blen_meshes:
+        options = options_from_mesh(blen_mesh)
+        group_idx = blen_mesh["nvx2_group_idx"]
+        if group_idx >= len(mesh_data.groups):
+            print("Group " + str(group_idx) + " no longer in '" + filepath + "'")
+            continue
+        blen_mesh.clear_geometry()
+        _, vertex_remap = build_group_mesh(mesh_data, group_idx, options, blen_mesh)
+        for obj in bpy.data.objects:
+            if obj.data == blen_mesh:
+                build_group_weights(obj, mesh_data, group_idx, options, vertex_remap)
+        blen_mesh["nvx2_mtime"] = os.path.getmtime(filepath)
+        blen_mesh.update()
+    print("Reloaded " + str(len(blen_meshes)) + " meshes from '" + filepath + "'")
+
+
+def reload_changed_files():
+    """Reload all imported meshes whose nvx2 file changed since import."""
+    source_meshes = {}
+    for blen_mesh in bpy.data.meshes:
+        if "nvx2_filepath" in blen_mesh:
+            source_meshes.setdefault(blen_mesh["nvx2_filepath"], []).append(blen_mesh)
+
+    for filepath, blen_meshes in source_meshes.items():
+        try:
+            mtime = os.path.getmtime(filepath)
+        except OSError:
+            continue  # Might be written at the moment, try again later
+        if any(mtime != blen_mesh["nvx2_mtime"] for blen_mesh in blen_meshes):
+            try:
+                reload_meshes(filepath, blen_meshes)
+            except (OSError, ValueError) as e:
+                print("Reloading '" + filepath + "' failed: " + str(e))
+
+
+# Seconds between checks for changed files in watch mode
+watch_interval = 1.0
+
+
+def watch_timer():
+    """Timer function for bpy.app.timers, checks for changed files."""
+    reload_changed_files()
+    return watch_interval
+
+
+def read_file_reported(operator, options: nvx2.Options):
+    """Wrapper for nvx2.read_file(), sending errors to the operator."""
     filepath = options.nvx2filepath
     filename = os.path.splitext(os.path.split(filepath)[1])[0]
     try:
-        f = open(filepath, mode='rb')
+        mesh_data = nvx2.read_file(filepath, options.nvx2version, options.num_threads)
     except FileNotFoundError:
         operator.report({'ERROR'}, "File " + filename + " not found.")
         print("File not found: '" + filepath + "'")
-        return {'CANCELLED'}
+        return None
     except PermissionError:
         operator.report({'ERROR'}, "Insufficient permissions to access file.")
         print("Insufficient permissions to access file.")
+        return None
+    except ValueError as e:
+        operator.report({'ERROR'}, str(e))
+        print(str(e))
+        return None
+
+    if options.nvx2version == 0:
+        operator.report({'INFO'}, "Detected nvx2 version: " + str(mesh_data.version))
+    return mesh_data
+
+
+def load(context, operator, options: nvx2.Options, collection=None, mesh_data=None):
+    """Called by the user interface or another script.
+
+    mesh_data (from nvx2.read_file()) can be passed if the file was already read.
+    """
+    if mesh_data is None:
+        mesh_data = read_file_reported(operator, options)
+    if not mesh_data:
         return {'CANCELLED'}
 
-    with f:
-        scene = context.scene
-        collection = scene.collection
-
-        # Read header
-        nvx2_header = nvx2.Header._make(struct.unpack('<4s6i', f.read(28)))
-
-        # Read "groups" = objects
-        nvx2_groups = [nvx2.Group._make(struct.unpack('<6i', f.read(24)))
-                       for i in range(nvx2_header.num_groups)]
-        if not nvx2_groups:
-            operator.report({'ERROR'}, "File does not contain groups.")
-            print("File does not contain groups.")
-            return {'CANCELLED'}
-
-        # Attempt to auto detect nvx2 version from vertex format and width
-        # NOTE: This may fail!
-        if options.nvx2version == 0:
-            options.nvx2version = detect_version(nvx2_header.vertex_components,
-                                                 nvx2_header.vertex_width * 4)
-            operator.report({'INFO'}, "Detected nvx2 version: " + str(options.nvx2version))
-            print("Detected nvx2 version: 2" + str(options.nvx2version))
-
-        # Create a format string for struct.unpack() matching the
-        # vertex components from the header
-        vertex_fmt = make_vertexformat(nvx2_header.vertex_components, options.nvx2version)
-        # Check if something was returned
-        if not vertex_fmt:
-            operator.report({'ERROR'}, "Empty vertex format.")
-            print("Empty vertex format")
-            return {'CANCELLED'}
-
-        # Check validity of format string, should be same size as header vertex_width*4
-        vertex_fmt_size = struct.calcsize(vertex_fmt)
-        if vertex_fmt_size != nvx2_header.vertex_width * 4:
-            operator.report({'ERROR'}, "Invalid vertex format size.")
-            print("Invalid vertex format size " + str(vertex_fmt_size) +
-                  ", expected " + str(nvx2_header.vertex_width * 4))
-            return {'CANCELLED'}
-
-        # Read Vertex data (for ALL objects in the file)
-        vertex_data = [struct.unpack(vertex_fmt, f.read(vertex_fmt_size))
-                       for i in range(nvx2_header.num_vertices)]
-        nvx2_vertices, nvx2_uvlayers, nvx2_weights, nvx2_weight_idx, nvx2_colors = \
-            unpack_vertexdata(vertex_data, nvx2_header.vertex_components)
-
-        # Read faces (for ALL objects in the file)
-        nvx2_faces = [list(struct.unpack('<3H', f.read(6)))
-                        for i in range(nvx2_header.num_triangles)]
-
-        parent_empty = None
-        if options.create_parent_empty:
-            parent_empty = bpy.data.objects.new(filename, None)
-            parent_empty.location = (0.0, 0.0, 0.0)
-            collection.objects.link(parent_empty)
-
-        # Create objects
-        for i, g in enumerate(nvx2_groups):
-            gvf = g.vertex_first
-            gtf = g.triangle_first
-            gtc = g.triangle_count
-            # Get vertex data for this object
-            grp_faces = [[vid-gvf for vid in f] for f in nvx2_faces[gtf:gtf+gtc]]
-            grp_verts = nvx2_vertices[gvf:gvf+g.vertex_count]
-            grp_uvs = [uvl[gvf:gvf+g.vertex_count] for uvl in nvx2_uvlayers]
-            grp_colors = nvx2_colors[gvf:gvf+g.vertex_count]
-            # Create the blender objects
-            mesh = create_mesh(grp_verts, grp_faces, grp_uvs, grp_colors, options)
-            obj = bpy.data.objects.new('nvx2_object', mesh)
-            if options.create_weights and nvx2_weights and nvx2_weight_idx:
-                create_weights(obj,
-                               nvx2_weights[gvf:gvf+g.vertex_count],
-                               nvx2_weight_idx[gvf:gvf+g.vertex_count])
-            # Link new object to scene/collection
-            if parent_empty:
-                obj.parent = parent_empty
-            collection.objects.link(obj)
+    filename = os.path.splitext(os.path.split(options.nvx2filepath)[1])[0]
+    for _ in create_objects(context, mesh_data, options, filename, collection):
+        pass
 
     return {'FINISHED'}
+
+
+def load_background_task(options: nvx2.Options, collection=None):
+    """Split load() into read and create steps for background.ImportJob."""
+    filename = os.path.splitext(os.path.split(options.nvx2filepath)[1])[0]
+
+    def read(reporter):
+        return read_file_reported(reporter, options)
+
+    def create(context, reporter, mesh_data):
+        if mesh_data:
+            yield from create_objects(context, mesh_data, options, filename, collection)
+
+    return read, create
@@ -1,12 +1,45 @@
 """Library for Parsing Nebula n3 files"""
 
+import array
+import collections
 import struct
-from dataclasses import dataclass, field
+import sys
+import types
+from dataclasses import dataclass
 
 
 SUPPORTED_VERSIONS = {1, 2}
 
 
+# Payload layout of node tags, used to skip them without decoding:
+# s = string, b = byte, i = int, f = float, w = float2, v = float4,
+# A = int count followed by count 4 byte values, S = int count followed by count strings
+TAG_LAYOUTS = {'CASH': 'b', 'SHDR': 's',
+               'MESH': 's', 'PGRI': 'i',
+               'LBOX': 'vv', 'MNTP': 's', 'SSTA': 'ss',
+               'POSI': 'v', 'ROTN': 'v', 'SCAL': 'v', 'RPIV': 'v', 'SPIV': 'v',
+               'SVSP': 'b', 'SLKV': 'b', 'SMID': 'f', 'SMAD': 'f',
+               'MNMT': 's', 'MATE': 's', 'STXT': 'ss', 'SINT': 'si', 'SFLT': 'sf',
+               'SBOO': 'sb', 'SFV2': 'sw', 'SFV4': 'sv', 'SVEC': 'sv',
+               'STUS': 'iv', 'SSPI': 'iv',
+               'NSKF': 'i', 'SFRG': 'iA',
+               'ANIM': 's', 'NJNT': 'i', 'JONT': 'iivvvs', 'NJMS': 'i', 'JOMS': 'sA',
+               'VART': 's', 'NSKL': 'i', 'SKNL': 'sS'}
+
+TAG_LAYOUT_SIZES = {'b': 1, 'i': 4, 'f': 4, 'w': 8, 'v': 16}
+
+# Tags naming a single resource and the node attribute they are stored in
+RESOURCE_TAGS = {'MESH': 'mesh_ressource_id',
+                 'ANIM': 'anim_ressource_id',
+                 'VART': 'variation_ressource_id'}
+
+
+Tag = collections.namedtuple('Tag', 'tag_4cc \
+                                     offset \
+                                     size \
+                                     node_name')
+
+
 @dataclass
 class Options:
     """N3 options."""
@@ -15,64 +48,171 @@ class Options:
     create_materials: bool = True
     reuse_materials: bool = False
     reuse_images: bool = True
+    texture_budget: int = 0  # MB of decoded textures before unloading, 0 is unlimited
     use_image_search: bool = False
     import_meshes: bool = True
+    use_proxies: bool = False
+    lod_policy: str = 'ALL'  # 'ALL', 'HIGHEST', 'LOWEST' or 'DISTANCE'
+    lod_distance: float = 0.0
     n3filepath: str = ""
 
 
-@dataclass
+class Joints:
+    """Skeleton joints of a character node, packed into flat arrays.
+
+    Indexing and iterating yield (joint_idx, parent_idx, translation,
+    rotation, scale, name) tuples.
+    """
+    __slots__ = ('indices', 'parents', 'transforms', 'names')
+
+    def __init__(self):
+        self.indices = array.array('i')
+        self.parents = array.array('i')
+        self.transforms = array.array('f')  # translation, rotation, scale (4 floats each)
+        self.names = []
+
+
+    @classmethod
+    def empty(cls):
+        """Return a read-only instance without joints, appending to it fails."""
+        joints = cls()
+        joints.indices = joints.parents = joints.transforms = joints.names = ()
+        return joints
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def __getitem__(self, idx):
+        idx = range(len(self.names))[idx]
+        transform = self.transforms[idx*12:idx*12+12]
+        return (self.indices[idx], self.parents[idx],
+                tuple(transform[0:4]), tuple(transform[4:8]), tuple(transform[8:12]),
+                self.names[idx])
+
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self.names)))
+
+
+    def append(self, joint_idx, parent_idx, transform, name):
+        """Add a joint, transform is translation, rotation and scale as 12 floats."""
+        self.indices.append(joint_idx)
+        self.parents.append(parent_idx)
+        self.transforms.extend(transform)
+        self.names.append(name)
+
+
+    def get_sorted_names(self):
+        """Return the joint names sorted by joint index."""
+        return [self.names[i] for i in sorted(range(len(self.names)),
+                                              key=self.indices.__getitem__)]
+
+
+# Values of node attributes which haven't been set by a tag, shared by all
+# nodes. Containers are empty and read-only here, see Node.container().
+NODE_DEFAULTS = {'node_parent': None,
+                 'node_children': (),
+                 # transform node params
+                 'position': (0.0, 0.0, 0.0, 1.0),
+                 'rotation': (0.0, 0.0, 0.0, 0.0),
+                 'scale': (1.0, 1.0, 1.0, 1.0),
+                 'rotation_pivot': (),
+                 'scale_pivot': (),
+                 'view_in_space': False,
+                 'locked_to_viewer': False,
+                 'min_distance': -1.0,
+                 'max_distance': -1.0,
+                 # state node params
+                 'material_string': "",  # DEPRECATED
+                 'material_name': "",
+                 'shader_textures': types.MappingProxyType({}),
+                 'shader_parameters': types.MappingProxyType({}),
+                 # shape node params
+                 'mesh_ressource_id': "",
+                 'primitive_group_idx': 0,
+                 # character node params
+                 'anim_ressource_id': "",
+                 'variation_ressource_id': "",
+                 'num_joints': 0,
+                 'joints': Joints.empty(),
+                 'num_joint_masks': 0,
+                 'joint_masks': (),
+                 'num_skin_lists': 0,
+                 'skin_lists': (),
+                 # character skin node params
+                 'num_skin_fragments': 0,
+                 'skin_fragments': types.MappingProxyType({}),  # array of joint indices
+                 # data params
+                 'model_node_type': "",  # DEPRECATED
+                 'attributes': types.MappingProxyType({}),
+                 'bounding_box': (),
+                 # Unknown origin, possibly deprecated, using fourCC as suffix
+                 'unknown_cash': "",
+                 'unknown_shdr': ""}
+
+# Types of the containers, created when the first item is added
+NODE_CONTAINERS = {'node_children': list,
+                   'shader_textures': dict,
+                   'shader_parameters': dict,
+                   'joints': Joints,
+                   'joint_masks': list,
+                   'skin_lists': list,
+                   'skin_fragments': dict,
+                   'attributes': dict}
+
+
 class Node:
-    """Class holding node data."""
-    node_name: str
-    node_type: str
-    node_parent: object = None
-    node_children: list = field(default_factory=list)
-    # transform node params
-    position: list = field(default_factory=lambda: [0.0, 0.0, 0.0, 1.0])
-    rotation: list = field(default_factory=lambda: [0.0, 0.0, 0.0, 0.0])
-    scale: list = field(default_factory=lambda: [1.0, 1.0, 1.0, 1.0])
-    rotation_pivot: list = field(default_factory=list)
-    scale_pivot: list = field(default_factory=list)
-    view_in_space: bool = False
-    locked_to_viewer: bool = False
-    min_distance: float = -1.0
-    max_distance: float = -1.0
-    # state node params
-    material_string : str = ""  # DEPRECATED
-    material_name: str = ""
-    shader_textures: dict = field(default_factory=dict)
-    shader_parameters: dict = field(default_factory=dict)
-    # shape node params
-    mesh_ressource_id: str = ""
-    primitive_group_idx: int = 0
-    # character node params
-    anim_ressource_id: str = ""
-    variation_ressource_id: str = ""
-    num_joints: int = 0
-    joints: list = field(default_factory=list)
-    num_joint_masks: int = 0
-    joint_masks: list = field(default_factory=list)
-    num_skin_lists: int = 0
-    skin_lists: list = field(default_factory=list)
-    # character skin node params
-    num_skin_fragments: int = 0
-    skin_fragments: dict = field(default_factory=dict)
-    # data params
-    model_node_type: str = ""  # DEPRECATED
-    attributes: dict = field(default_factory=dict)
-    bounding_box: list = field(default_factory=list)
-    # Unknown origin, possibly deprecated, using fourCC as suffix
-    unknown_cash: str = ""
-    unknown_shdr: str = ""
+    """Class holding node data.
+
+    Only attributes set while parsing take up memory, all others return
+    their value from NODE_DEFAULTS.
+    """
+    __slots__ = ('node_name', 'node_type', *NODE_DEFAULTS)
+
+    def __init__(self, node_name: str, node_type: str, node_parent=None):
+        self.node_name = node_name
+        self.node_type = node_type
+        if node_parent is not None:
+            self.node_parent = node_parent
+
+
+    def __getattr__(self, name):
+        # Only called for slots which haven't been set
+        try:
+            return NODE_DEFAULTS[name]
+        except KeyError:
+            raise AttributeError("'Node' object has no attribute '" + name + "'") from None
+
+
+    def container(self, name):
+        """Return a container attribute for adding items, created on first use."""
+        value = getattr(self, name)
+        if value is NODE_DEFAULTS[name]:
+            value = NODE_CONTAINERS[name]()
+            setattr(self, name, value)
+        return value
 
 
 class Parser():
     """Parse an n3 file."""
 
-    def __init__(self, blen_operator, options):
+    def __init__(self, blen_operator, options, skip_payload=False, resource_callback=None,
+                 keep_resources=False, record_tags=False):
         self.filepath = ""
         self.operator = blen_operator  # for sending reports to blender UI
         self.options = options
+        # Only record node structure and tags, don't decode tag values
+        self.skip_payload = skip_payload
+        # Decode resource ids and textures anyway when skipping payloads
+        self.keep_resources = keep_resources
+        # Keep a Tag for each node data tag in n3tags, always done when
+        # skipping payloads (for inspecting files), imports don't need them
+        self.record_tags = record_tags or skip_payload
+        # Called with (tag fourCC, resource id) for each mesh and texture as
+        # soon as it is parsed, e.g. to start loading it
+        self.resource_callback = resource_callback
 
         self.byteorder = ""   # param for to_bytes()
         self.byteformat = ""  # oaram for struct.unpack()
@@ -83,6 +223,7 @@ class Parser():
         self.n3modelname = ""
         self.n3node_list = []  # collections.OrderedDict()
         self.n3attribues = {}
+        self.n3tags = []  # Tag for each node data tag, if record_tags
 
 
     def report(self, rep_type, rep_msg):
@@ -90,6 +231,12 @@ class Parser():
         self.operator.report(rep_type, rep_msg)
 
 
+    def log(self, msg):
+        """Print parsing progress, silent when skipping payloads."""
+        if not self.skip_payload:
+            print(msg)
+
+
     def read_n3_value(self, struct_format, num_bytes):
         """Read an n3 value, wrapper for struct.unpack()."""
         return struct.unpack(self.byteformat+struct_format, self.n3file.read(num_bytes))
@@ -108,7 +255,52 @@ class Parser():
     def read_n3_fourcc(self):
         """Read an n3 four character code."""
         four_cc = self.read_n3_value("I", 4)[0]
-        return four_cc.to_bytes(4, byteorder=self.byteorder).decode()
+        # Interned, the same few codes are used for all nodes and tags
+        return sys.intern(four_cc.to_bytes(4, byteorder=self.byteorder).decode())
+
+
+    def read_n3_array(self, typecode, count):
+        """Read count values into an array.array, e.g. joint indices."""
+        values = array.array(typecode)
+        values.frombytes(self.n3file.read(count * values.itemsize))
+        if (self.byteformat == '>') != (sys.byteorder == 'big'):
+            values.byteswap()
+        return values
+
+
+    def skip_tag_payload(self, tag_4cc: str):
+        """Skip the payload of a node tag without decoding it."""
+        layout = TAG_LAYOUTS.get(tag_4cc)
+        if layout is None:
+            # No valid fourCC found
+            return False
+        if tag_4cc == 'SKNL' and self.n3version == 2:
+            # See parse_tag_character()
+            layout += 'bs'
+
+        for code in layout:
+            if code == 's':
+                self.n3file.seek(self.read_n3_value("H", 2)[0], 1)
+            elif code == 'A':
+                self.n3file.seek(self.read_n3_value("i", 4)[0] * 4, 1)
+            elif code == 'S':
+                for _ in range(self.read_n3_value("i", 4)[0]):
+                    self.n3file.seek(self.read_n3_value("H", 2)[0], 1)
+            else:
+                self.n3file.seek(TAG_LAYOUT_SIZES[code], 1)
+        return True
+
+
+    def read_resource_tag(self, tag_4cc: str, node: Node):
+        """Read only resource ids and textures, quietly. Returns False for other tags."""
+        if tag_4cc in RESOURCE_TAGS:
+            setattr(node, RESOURCE_TAGS[tag_4cc], sys.intern(self.read_n3_string()))
+        elif tag_4cc == 'STXT':
+            tex_type = sys.intern(self.read_n3_string())
+            node.container('shader_textures')[tex_type] = sys.intern(self.read_n3_string())
+        else:
+            return False
+        return True
 
 
     def parse_tag_other(self, tag_4cc: str, node: Node):
@@ -119,7 +311,7 @@ class Parser():
             print("        UNKNOWN_TAG 'CASH'="+str(node.unknown_cash))
         elif tag_4cc =='SHDR':
             # seems to be single string, shader name
-            node.unknown_shdr = self.read_n3_string()
+            node.unknown_shdr = sys.intern(self.read_n3_string())
             print("        UNKNOWN_TAG 'SHDR'=" + str(node.unknown_shdr))
         else:
             # No valid fourCC found
@@ -136,8 +328,10 @@ class Parser():
         # ShapeNode::ParseDataTag() (code/render/models/shapenode.cc)
         if tag_4cc == 'MESH':
             # Mesh (ressourceID)
-            node.mesh_ressource_id = self.read_n3_string()
+            node.mesh_ressource_id = sys.intern(self.read_n3_string())
             print("        mesh_res_id="+node.mesh_ressource_id)
+            if self.resource_callback:
+                self.resource_callback(tag_4cc, node.mesh_ressource_id)
         elif tag_4cc =='PGRI':
             # Primitive group index
             node.primitive_group_idx = self.read_n3_value("i", 4)[0]
@@ -160,7 +354,7 @@ class Parser():
             center = self.read_n3_value("4f", 16)[:4]
             extends = self.read_n3_value("4f", 16)[:4]
 
-            node.bounding_box = [center, extends]
+            node.bounding_box = (center, extends)
             print("        model_bbox="+str(node.bounding_box))
         elif tag_4cc == 'MNTP':
             # DEPRECATED model node type
@@ -171,7 +365,7 @@ class Parser():
             n3key = self.read_n3_string()
             n3value = self.read_n3_string()
 
-            node.attributes[n3key] = n3value
+            node.container('attributes')[n3key] = n3value
             print("attribute: (" + n3key + ":" + n3value + ")")
         else:
             # No valid fourCC found
@@ -209,10 +403,10 @@ class Parser():
             node.locked_to_viewer = bool(val)
         elif tag_4cc == 'SMID':
             # Set Min Distance
-            node.min_distance = self.read_n3_value("f", 1)[0]
+            node.min_distance = self.read_n3_value("f", 4)[0]
         elif tag_4cc == 'SMAD':
             # Set max Distance
-            node.max_distance = self.read_n3_value("f", 1)[0]
+            node.max_distance = self.read_n3_value("f", 4)[0]
         else:
             # No valid fourCC found
             return False
@@ -231,65 +425,67 @@ class Parser():
             _ = self.read_n3_string()
         elif tag_4cc =='MATE':
             # Material name
-            node.material_name = self.read_n3_string()
+            node.material_name = sys.intern(self.read_n3_string())
         elif tag_4cc =='STXT':
             # Shader texture
-            tex_type = self.read_n3_string()
-            tex_name = self.read_n3_string()
+            tex_type = sys.intern(self.read_n3_string())
+            tex_name = sys.intern(self.read_n3_string())
 
-            node.shader_textures[tex_type] = tex_name
+            node.container('shader_textures')[tex_type] = tex_name
             print("        new_texture=" + str(node.shader_textures[tex_type]))
+            if self.resource_callback:
+                self.resource_callback(tag_4cc, tex_name)
         elif tag_4cc == 'SINT':
             # Shader int param
             pname = self.read_n3_string()
             pval = self.read_n3_value("i", 4)[0]
 
-            node.shader_parameters['pname'] = pval
+            node.container('shader_parameters')['pname'] = pval
             print("        new_shader_int=" + str((pname, pval)))
         elif tag_4cc == 'SFLT':
             # Shader float param
             pname = self.read_n3_string()
             pval = self.read_n3_value("f", 4)[0]
 
-            node.shader_parameters['pname'] = pval
+            node.container('shader_parameters')['pname'] = pval
             print("        new_shader_float=" + str((pname, pval)))
         elif tag_4cc == 'SBOO':
             # Shader bool param
             pname = self.read_n3_string()
             pval = self.read_n3_value("b", 1)[0]
 
-            node.shader_parameters['pname'] = pval
+            node.container('shader_parameters')['pname'] = pval
             print("        new_shader_bool=" + str((pname, pval)))
         elif tag_4cc == 'SFV2':
             # Shader 2-dim vector param
             pname = self.read_n3_string()
             pval = self.read_n3_value("2f", 8)[:2]
 
-            node.shader_parameters['pname'] = pval
+            node.container('shader_parameters')['pname'] = pval
             print("        new_shader_vector2=" + str((pname, pval)))
         elif tag_4cc == 'SFV4' or tag_4cc == 'SVEC':
             # Shader 4-dim vector param
             pname = self.read_n3_string()
             pval = self.read_n3_value("4f", 16)[:4]
 
-            node.shader_parameters['pname'] = pval
+            node.container('shader_parameters')['pname'] = pval
             print("        new_shader_vector4=" + str((pname, pval)))
         elif tag_4cc == 'STUS':
             # Indexed shader param (not implemented)
-            pidx = self.read_n3_value("i", 1)[0]
+            pidx = self.read_n3_value("i", 4)[0]
             pval = self.read_n3_value("4f", 16)[:4]
 
             pname = "MLPUVStretch" + str(pidx)
             print("        MLPUVStretch=" + str((pname, pval)))
-            node.shader_parameters['pname'] = pval
+            node.container('shader_parameters')['pname'] = pval
         elif tag_4cc == 'SSPI':
             # Indexed shader param (not implemented)
-            pidx = self.read_n3_value("i", 1)[0]
+            pidx = self.read_n3_value("i", 4)[0]
             pval = self.read_n3_value("4f", 16)[:4]
 
             pname = "MLPSpecIntensity" + str(pidx)
             print("        MLPSpecIntensity=" + str((pname, pval)))
-            node.shader_parameters['pname'] = pval
+            node.container('shader_parameters')['pname'] = pval
         else:
             # No valid fourCC found
             return False
@@ -314,9 +510,9 @@ class Parser():
             group_idx = self.read_n3_value("i", 4)[0]
             num_joints = self.read_n3_value("i", 4)[0]
 
-            new_skin_fragment = self.read_n3_value(str(num_joints)+"i", num_joints*4)[:num_joints]
-            node.skin_fragments[group_idx] = new_skin_fragment
-            print("        new_skin_fragment=" + str(new_skin_fragment))
+            new_skin_fragment = self.read_n3_array('i', num_joints)
+            node.container('skin_fragments')[group_idx] = new_skin_fragment
+            print("        new_skin_fragment=" + str(new_skin_fragment.tolist()))
         else:
             # No valid fourCC found
             return False
@@ -332,7 +528,7 @@ class Parser():
         # CharacterNode::ParseDataTag() (code/render/characters/characternode.cc)
         if tag_4cc == 'ANIM':
             # Animation
-            node.anim_ressource_id = self.read_n3_string()
+            node.anim_ressource_id = sys.intern(self.read_n3_string())
             print("        anim_res_id=" + node.anim_ressource_id)
         elif tag_4cc == 'NJNT':
             # Number of joints in skeleton
@@ -342,18 +538,13 @@ class Parser():
             print("        num_joints=" + str(node.num_joints))
         elif tag_4cc == 'JONT':
             # Joint
-            joint_idx        = self.read_n3_value('i', 4)[0]
-            parent_joint_idx = self.read_n3_value('i', 4)[0]
-            pose_translation = self.read_n3_value('4f', 16)[:4]
-            pose_rotation    = self.read_n3_value('4f', 16)[:4]
-            pose_scale       = self.read_n3_value('4f', 16)[:4]
-            joint_name       = self.read_n3_string()
-
-            new_joint = (joint_idx, parent_joint_idx,
-                        pose_translation, pose_rotation, pose_scale,
-                        joint_name)
-            node.joints.append(new_joint)
-            print("        new_joint=" + str(new_joint))
+            # joint index, parent joint index, pose translation, rotation and scale
+            joint_values = self.read_n3_value('2i12f', 56)
+            joint_name = sys.intern(self.read_n3_string())
+
+            joints = node.container('joints')
+            joints.append(joint_values[0], joint_values[1], joint_values[2:], joint_name)
+            print("        new_joint=" + str(joints[-1]))
         elif tag_4cc == 'NJMS':
             # Number of joint masks
             # Don't actually need this, it's originally used to allocate memory which
@@ -367,11 +558,11 @@ class Parser():
             mask_weights = self.read_n3_value(str(num_weights)+'f', 4*num_weights)[0]
 
             new_mask = (mask_name, mask_weights)
-            node.joint_masks.append(new_mask)
+            node.container('joint_masks').append(new_mask)
             print("        new_mask=" + str(new_mask))
         elif tag_4cc == 'VART':
             # Variation resource name
-            node.variation_ressource_id = self.read_n3_string()
+            node.variation_ressource_id = sys.intern(self.read_n3_string())
             print("        variation_ressource_id=" + node.variation_ressource_id)
         elif tag_4cc == 'NSKL':
             # Number of skin lists
@@ -398,7 +589,7 @@ class Parser():
                 print("        junk=" + junk)
 
             new_skinlist = (skinlist_name, skins)
-            node.skin_lists.append(new_skinlist)
+            node.container('skin_lists').append(new_skinlist)
             print("        new_skinlists=" + str(new_skinlist))
         else:
             # No valid fourCC found
@@ -443,25 +634,26 @@ class Parser():
             # - We'll use the FourCC to determine endianness of file (UGLY, but no choice)
             # - It'll be either "3BEN" od "NEB3"
             # See StreamModelLoader::SetupModelFromStream (code/render/models/streammodelloader.cc)
-            header_4cc = struct.unpack("<I", f.read(4))[0]
-            header_4cc_little = header_4cc.to_bytes(4, byteorder="little").decode()
-            header_4cc_big = header_4cc.to_bytes(4, byteorder="big").decode()
-
-            if header_4cc_little == "NEB3":
-                self.byteorder = "little"
-                self.byteformat = "<"
-            elif header_4cc_big == "NEB3":
+            # FourCCs are uints, written by a little endian platform they read
+            # "3BEN", by a big endian one "NEB3". Either way the uint (read
+            # in the file's byte order) holds the characters big endian.
+            header_4cc = f.read(4)
+            if header_4cc == b"3BEN":
                 self.byteorder = "big"
                 self.byteformat = "<"
+            elif header_4cc == b"NEB3":
+                self.byteorder = "big"
+                self.byteformat = ">"
             else:
-                self.report({'ERROR'}, "Invalid file, unknown fourCC '" + str(header_4cc) + "'")
+                self.report({'ERROR'}, "Invalid file, unknown fourCC '" +
+                            header_4cc.decode('ascii', 'replace') + "'")
                 return False  # {'CANCELLED'}
 
             # Parse file version
             header_version = self.read_n3_value("I", 4)[0]
-            print("n3 Version: " + str(header_version))
+            self.log("n3 Version: " + str(header_version))
             if header_version not in SUPPORTED_VERSIONS:
-                if self.options["ignore_version"]:
+                if self.options.ignore_version:
                     self.report({'WARNING'}, "Unsupported version '" + str(header_version) + "'")
                 else:
                     self.report({'ERROR'}, "Unsupported version '" + str(header_version) + "'")
@@ -471,10 +663,10 @@ class Parser():
 
             done = False
             current_node = None
-            current_node_idx = -1
             while not done:
+                tag_offset = f.tell()
                 tag_4cc = self.read_n3_fourcc()
-                print(tag_4cc)
+                self.log(tag_4cc)
 
                 # Model data blocks, see
                 # StreamModelLoader::SetupModelFromStream (/code/render/models/streammodelloader.cc)
@@ -482,8 +674,8 @@ class Parser():
                     # Start of model
                     self.n3modeltype = self.read_n3_fourcc()
                     self.n3modelname = self.read_n3_string()
-                    print("model_type_4cc: '" + str(self.n3modeltype) + "'")
-                    print("model_name: '" + self.n3modelname + "'")
+                    self.log("model_type_4cc: '" + str(self.n3modeltype) + "'")
+                    self.log("model_name: '" + self.n3modelname + "'")
                 elif tag_4cc == '<MDL':
                     # End of Model
                     done = True
@@ -495,32 +687,40 @@ class Parser():
 
                     # Create new node
                     new_node = Node(node_name, node_type_4cc, current_node)
-                    print("    new_node: " + new_node.node_type + " - " + new_node.node_name)
+                    self.log("    new_node: " + new_node.node_type + " - " + new_node.node_name)
                     if current_node:
-                        current_node.node_children.append(new_node)
+                        current_node.container('node_children').append(new_node)
 
                     self.n3node_list.append(new_node)
                     current_node = new_node
-                    current_node_idx += 1
                 elif tag_4cc == '<MND':
-                    # End of model node, get the previous one
-                    print("    end node '" + current_node.node_name + "'")
-                    current_node_idx -= 1
-                    if current_node_idx >= 0:
-                        current_node = self.n3node_list[current_node_idx]
-                        print("    return to node '" + current_node.node_name + "'")
-                    else:
-                        current_node = None
+                    # End of model node, return to its parent (not the
+                    # previous node, that may be in a sibling's subtree)
+                    if not current_node:
+                        self.report({'ERROR'}, "Unexpected end of node")
+                        return False # {'CANCELLED'}
+                    self.log("    end node '" + current_node.node_name + "'")
+                    current_node = current_node.node_parent
+                    if current_node:
+                        self.log("    return to node '" + current_node.node_name + "'")
                 elif tag_4cc == 'EOF_':
                     # End of file (might not be present, maybe version dependent)
                     done = True
                     current_node = None
                 else:
-                    # Try parsing node data
-                    if current_node and self.parse_node_tag(tag_4cc, current_node):
-                        pass
+                    # Try parsing (or skipping) node data
+                    if self.skip_payload:
+                        parsed = current_node and (
+                            (self.keep_resources and
+                             self.read_resource_tag(tag_4cc, current_node)) or
+                            self.skip_tag_payload(tag_4cc))
                     else:
+                        parsed = current_node and self.parse_node_tag(tag_4cc, current_node)
+                    if not parsed:
                         self.report({'ERROR'}, "Unknown tag '" + tag_4cc + "'")
                         return False # {'CANCELLED'}
+                    if self.record_tags:
+                        self.n3tags.append(Tag(tag_4cc, tag_offset, f.tell() - tag_offset - 4,
+                                               current_node.node_name))
 
         return True
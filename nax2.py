@@ -1,6 +1,22 @@
 """TODO: DOC"""
 
 import collections
+import struct
+from enum import IntEnum
+
+
+GROUP_FMT = '<4i2f1i512s'
+GROUP_SIZE = struct.calcsize(GROUP_FMT)
+CURVE_FMT = '<3i4f'
+CURVE_SIZE = struct.calcsize(CURVE_FMT)
+
+
+class IpolType(IntEnum):
+    """Interpolation type of a nax2 curve"""
+    NoIpol = 0
+    Step = 1
+    Linear = 2
+    Quat = 3
 
 Header = collections.namedtuple('Header', 'magic \
                                            num_groups \
@@ -1,6 +1,32 @@
 """TODO: DOC"""
 
 import collections
+import struct
+from enum import IntEnum
+
+
+# See doc_nax.txt, clips and events are 64 bytes, curves 24 bytes
+CLIP_FMT = '<5H2B1H50s'
+CLIP_SIZE = struct.calcsize(CLIP_FMT)
+EVENT_FMT = '<47s15s1H'
+EVENT_SIZE = struct.calcsize(EVENT_FMT)
+CURVE_FMT = '<1i3B1B4f'
+CURVE_SIZE = struct.calcsize(CURVE_FMT)
+assert CLIP_SIZE == 64 and EVENT_SIZE == 64 and CURVE_SIZE == 24
+
+# FourCC 'NAX3' as written on little and big endian platforms
+MAGIC = struct.pack('<I', int.from_bytes(b'NAX3', 'big'))
+MAGIC_BIG = b'NAX3'
+
+
+class CurveType(IntEnum):
+    """Type of a nax3 curve, see CoreAnimation::CurveType"""
+    Translation = 0
+    Scale = 1
+    Rotation = 2
+    Color = 3
+    Velocity = 4
+    Float4 = 5
 
 Header = collections.namedtuple('Header', 'magic \
                                            num_clips \
@@ -37,3 +63,54 @@ CurveRaw = collections.namedtuple('Curve', 'first_key_idx \
                                             key_y \
                                             key_z \
                                             key_w')
+
+
+ClipTableEntry = collections.namedtuple('ClipTableEntry', 'clip_idx \
+                                                           clip \
+                                                           event_offset \
+                                                           curve_offset \
+                                                           key_first \
+                                                           key_count')
+
+
+def get_byteorder(magic):
+    """Return the byte order ('<' or '>') of a file from its magic bytes."""
+    if magic == MAGIC_BIG:
+        return '>'
+    return '<'
+
+
+def with_byteorder(struct_format, byteorder):
+    """Replace the byte order of one of the formats above."""
+    return byteorder + struct_format[1:]
+
+
+def get_clip_name(clip):
+    """Return the name of a nax3 clip as string."""
+    return clip.clip_name.split(b'\0', 1)[0].decode('ascii', 'replace')
+
+
+def build_clip_table(f):
+    """Walk all clip headers once and record where each clip's data is."""
+    # nax 3 is: header, list of (clip, event list, curve list), list of keys
+    magic = f.read(4)
+    byteorder = get_byteorder(magic)
+    header = Header._make((magic,) + struct.unpack(byteorder + '2i', f.read(8)))
+    clip_fmt = with_byteorder(CLIP_FMT, byteorder)
+    clip_table = {}
+    for cl_idx in range(header.num_clips):
+        clip = Clip._make(struct.unpack(clip_fmt, f.read(CLIP_SIZE)))
+        # Skip events and curves, only remember where they are
+        event_offset = f.tell()
+        curve_offset = event_offset + clip.num_events * EVENT_SIZE
+        f.seek(curve_offset + clip.num_curves * CURVE_SIZE)
+        clip_table[get_clip_name(clip)] = \
+            ClipTableEntry(clip_idx=cl_idx,
+                           clip=clip,
+                           event_offset=event_offset,
+                           curve_offset=curve_offset,
+                           key_first=clip.startkey_idx,
+                           key_count=clip.num_keys * clip.key_stride)
+    # Key block follows the last clip
+    key_offset = f.tell()
+    return header, key_offset, clip_table
@@ -1,8 +1,13 @@
 """Library for Parsing Nebula nvx2 files"""
 
 import collections
+import concurrent.futures
+import os
+import struct
 from enum import IntEnum
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+import numpy as np
 
 
 @dataclass
@@ -10,12 +15,67 @@ class Options:
     """Nvx2 options."""
     use_smooth: bool = False
     use_mesh_validation: bool = True
+    use_single_mesh: bool = False
+    use_weld_vertices: bool = False
+    weld_distance: float = 0.0
     create_parent_empty: bool = True
     create_uvs: bool = True
     create_weights: bool = True
     create_colors: bool = False
     nvx2filepath: str = ""
     nvx2version: int = 3
+    # skinning data from n3 files
+    joint_names: list = field(default_factory=list)
+    skin_fragments: dict = field(default_factory=dict)
+    armature_object: object = None
+    # only import these groups, all if empty
+    groups: list = field(default_factory=list)
+    parent_object: object = None
+    # threads for decoding large files, 0 for one per cpu
+    num_threads: int = 1
+
+
+@dataclass
+class ExportOptions:
+    """Nvx2 export options."""
+    use_selection: bool = True
+    export_normals: bool = True
+    export_uvs: bool = True
+    export_colors: bool = False
+    export_weights: bool = True
+    # store uvs, normals, colors and weights as shorts/bytes (Nebula 3 only)
+    use_compact: bool = False
+    # reorder triangles and vertices for the GPU's vertex cache
+    optimize_vertex_cache: bool = False
+    nvx2filepath: str = ""
+    nvx2version: int = 3
+    # '<' for PC, '>' for big endian consoles
+    byteorder: str = '<'
+
+
+# FourCC 'NVX2' as written by nebula, a little endian uint
+MAGIC = struct.pack('<I', int.from_bytes(b'NVX2', 'big'))
+# Same, written on a big endian platform (PS3, Xbox 360)
+MAGIC_BIG = b'NVX2'
+
+# Compact (quantized) variants of float vertex components, Nebula 3 only
+COMPACT_COMPONENTS = {'Normal': 'NormalUB4N',
+                      'Uv0': 'Uv0S2',
+                      'Uv1': 'Uv1S2',
+                      'Uv2': 'Uv2S2',
+                      'Uv3': 'Uv3S2',
+                      'Color': 'ColorUB4N',
+                      'Tangent': 'TangentUB4N',
+                      'Binormal': 'BinormalUB4N',
+                      'Weights': 'WeightsUB4N',
+                      'JIndices': 'JIndicesUB4'}
+
+# Maximum number of vertices per file, faces are stored as ushort
+MAX_VERTICES = 65536
+
+# Chunks of vertices/indices decoded on multiple threads, see get_chunk_size()
+DECODE_CHUNK_ALIGN = 1024
+DECODE_MIN_CHUNK_SIZE = 4096
 
 
 Header = collections.namedtuple('Header', 'magic \
@@ -35,6 +95,24 @@ Group = collections.namedtuple('Group', 'vertex_first \
                                          edge_count')
 
 
+MeshData = collections.namedtuple('MeshData', 'header \
+                                               groups \
+                                               version \
+                                               vertices \
+                                               uvlayers \
+                                               weights \
+                                               weight_indices \
+                                               colors \
+                                               faces \
+                                               edges')
+
+
+MeshIssues = collections.namedtuple('MeshIssues', 'invalid_indices \
+                                                   degenerate_faces \
+                                                   duplicate_faces \
+                                                   invalid_positions')
+
+
 VertexComponentData = collections.namedtuple('VertexComponent', 'format count size')
 
 
@@ -114,3 +192,453 @@ VertexComponentsN2 = {VertexComponentMaskN2.Coord:     VertexComponentData('3f',
                       VertexComponentMaskN2.Weights:   VertexComponentData('4f', 4, 4),
                       VertexComponentMaskN2.JIndices:  VertexComponentData('4f', 4, 4),
                       VertexComponentMaskN2.Coord4:    VertexComponentData('4f', 4, 4)}
+
+
+def make_vertexformat(vertex_components, nvx2version=3, byteorder='<'):
+    """Build the struct format string to read vertices"""
+    vertex_fmt = byteorder
+    if nvx2version == 2:
+        # nvx2 files for Nebula 2
+        for vcmask, vcdata in VertexComponentsN2.items():
+            if vcmask & vertex_components:
+                vertex_fmt += vcdata.format
+    else:
+        # DEFAULT: nvx2 files for Nebula 3
+        for vcmask, vcdata in VertexComponentsN3.items():
+            if vcmask & vertex_components:
+                vertex_fmt += vcdata.format
+    return vertex_fmt
+
+
+def make_vertexdtype(vertex_components, nvx2version=3, byteorder='<'):
+    """Build a numpy dtype to read vertices, one named field per component.
+
+    Fields keep the file's byte order, numpy swaps them when converting.
+    """
+    if nvx2version == 2:
+        # nvx2 files for Nebula 2
+        vertex_components_data = VertexComponentsN2
+    else:
+        # DEFAULT: nvx2 files for Nebula 3
+        vertex_components_data = VertexComponentsN3
+    type_map = {'f': byteorder + 'f4', 'h': byteorder + 'i2', 'B': 'u1'}
+    return np.dtype([(vcmask.name, type_map[vcdata.format[-1]], int(vcdata.format[:-1]))
+                     for vcmask, vcdata in vertex_components_data.items()
+                     if vcmask & vertex_components])
+
+
+def detect_version(vertex_components, vertex_width):
+    """Attempt to detect nvx2 version from vertex components and vertex width."""
+    versions = [3, 2]
+    for v in versions:
+        vertex_fmt = make_vertexformat(vertex_components, v)
+        if struct.calcsize(vertex_fmt) == vertex_width:
+            return v
+    # Always default to 3
+    return 3
+
+
+def get_byteorder(magic):
+    """Return the byte order ('<' or '>') of a file from its magic bytes."""
+    if magic == MAGIC_BIG:
+        return '>'
+    return '<'
+
+
+def read_header(f):
+    """Read the header and group table of an nvx2 file, f must be at the start."""
+    magic = f.read(4)
+    byteorder = get_byteorder(magic)
+    header = Header._make((magic,) + struct.unpack(byteorder + '6i', f.read(24)))
+    groups = [Group._make(struct.unpack(byteorder + '6i', f.read(24)))
+              for i in range(header.num_groups)]
+    return header, groups
+
+
+def fps2float(n):
+    """Convert fixed point short (or an array of them) into a float"""
+    return n / 8191.0
+
+
+def fpb2float(n):
+    """Convert fixed point byte (or an array of them) into a float"""
+    return n / 255.0
+
+
+def unpack_vertexdata(vertices, vertex_components, nvx2version=3):
+    """Split a structured vertex array into float arrays.
+
+    Components not present in the file are returned as None.
+    """
+    vert_coords = None
+    vert_uvs = [None, None, None, None]
+    vert_weights = None
+    vert_weight_idx = None
+    vert_colors = None
+
+    # Fields are named after the vertex component masks
+    fields = vertices.dtype.names
+
+    if 'Coord' in fields:
+        vert_coords = vertices['Coord'].astype(np.float32)
+
+    # Ignoring normals, tangents and binormals for now
+
+    for uv_idx in range(4):
+        uv_name = 'Uv' + str(uv_idx)
+        if uv_name in fields:
+            vert_uvs[uv_idx] = vertices[uv_name].astype(np.float32)
+        elif uv_name + 'S2' in fields:
+            uvs = fps2float(vertices[uv_name + 'S2'].astype(np.float32))
+            uvs[:, 1] = 1.0 - uvs[:, 1]
+            vert_uvs[uv_idx] = uvs
+
+    if 'Color' in fields:
+        vert_colors = vertices['Color'].astype(np.float32)
+    elif 'ColorUB4N' in fields:
+        vert_colors = fpb2float(vertices['ColorUB4N'].astype(np.float32))
+
+    if 'Weights' in fields:
+        vert_weights = vertices['Weights'].astype(np.float32)
+    elif 'WeightsUB4N' in fields:
+        vert_weights = fpb2float(vertices['WeightsUB4N'].astype(np.float32))
+
+    if 'JIndices' in fields:
+        vert_weight_idx = np.rint(vertices['JIndices']).astype(np.int32)
+    elif 'JIndicesUB4' in fields:
+        # Joint indices are plain bytes, not normalized
+        vert_weight_idx = vertices['JIndicesUB4'].astype(np.int32)
+
+    return vert_coords, vert_uvs, vert_weights, vert_weight_idx, vert_colors
+
+
+def get_chunk_size(num_items, num_threads=1):
+    """Items per chunk to spread num_items evenly over num_threads threads.
+
+    Chunks are aligned to DECODE_CHUNK_ALIGN and never smaller than
+    DECODE_MIN_CHUNK_SIZE, smaller chunks cost more in overhead than they gain.
+    """
+    chunk_size = -(-num_items // max(num_threads, 1))
+    chunk_size = -(-chunk_size // DECODE_CHUNK_ALIGN) * DECODE_CHUNK_ALIGN
+    return max(chunk_size, DECODE_MIN_CHUNK_SIZE)
+
+
+def get_chunks(num_items, num_threads=1):
+    """Split range(num_items) into (start, stop) chunks, one per thread at most."""
+    chunk_size = get_chunk_size(num_items, num_threads)
+    return [(start, min(start + chunk_size, num_items))
+            for start in range(0, num_items, chunk_size)]
+
+
+def unpack_vertexdata_chunked(vertices, vertex_components, nvx2version=3, executor=None,
+                              num_threads=1):
+    """Same as unpack_vertexdata(), but decodes chunks of vertices on a thread pool.
+
+    All conversions are per vertex, so the result is identical.
+    """
+    chunks = get_chunks(len(vertices), num_threads)
+    if executor is None or len(chunks) <= 1:
+        return unpack_vertexdata(vertices, vertex_components, nvx2version)
+
+    def flatten(unpacked):
+        coords, uvs, weights, weight_idx, colors = unpacked
+        return [coords] + uvs + [weights, weight_idx, colors]
+
+    # Decode a single vertex to get shapes and types of the results
+    template = flatten(unpack_vertexdata(vertices[:1], vertex_components, nvx2version))
+    results = [None if t is None else np.empty((len(vertices),) + t.shape[1:], dtype=t.dtype)
+               for t in template]
+
+    def decode_chunk(chunk):
+        start, stop = chunk
+        decoded = flatten(unpack_vertexdata(vertices[start:stop], vertex_components,
+                                            nvx2version))
+        for result, values in zip(results, decoded):
+            if result is not None:
+                result[start:stop] = values
+
+    # list() to re-raise exceptions from the workers
+    list(executor.map(decode_chunk, chunks))
+    return results[0], results[1:5], results[5], results[6], results[7]
+
+
+def convert_indices(indices, executor=None, num_threads=1):
+    """Convert an (n, m) ushort index array to int32, in chunks on a thread pool."""
+    chunks = get_chunks(len(indices), num_threads)
+    if executor is None or len(chunks) <= 1:
+        return indices.astype(np.int32)
+
+    result = np.empty(indices.shape, dtype=np.int32)
+
+    def convert_chunk(chunk):
+        start, stop = chunk
+        result[start:stop] = indices[start:stop]
+
+    list(executor.map(convert_chunk, chunks))
+    return result
+
+
+def read_file(filepath, nvx2version=0, num_threads=1):
+    """Read and decode an nvx2 file without touching any blender data.
+
+    Large files are decoded on num_threads threads (0 for one per cpu), a
+    thread pool is only created if there is more than one chunk to decode.
+    Raises ValueError if the file contents can't be decoded.
+    """
+    with open(filepath, mode='rb') as f:
+        # Read header and "groups" = objects
+        nvx2_header, nvx2_groups = read_header(f)
+        if not nvx2_groups:
+            raise ValueError("File does not contain groups.")
+
+        if num_threads <= 0:
+            num_threads = os.cpu_count() or 1
+        num_chunks = len(get_chunks(max(nvx2_header.num_vertices, nvx2_header.num_triangles,
+                                        nvx2_header.num_edges), num_threads))
+        if num_threads > 1 and num_chunks > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_chunks) as executor:
+                return read_payload(f, nvx2_header, nvx2_groups, nvx2version, executor,
+                                    num_threads)
+        return read_payload(f, nvx2_header, nvx2_groups, nvx2version)
+
+
+def read_payload(f, nvx2_header, nvx2_groups, nvx2version=0, executor=None, num_threads=1):
+    """Decode vertices, faces and edges following the header, see read_file()."""
+    # Attempt to auto detect nvx2 version from vertex format and width
+    # NOTE: This may fail!
+    if nvx2version == 0:
+        nvx2version = detect_version(nvx2_header.vertex_components,
+                                     nvx2_header.vertex_width * 4)
+        print("Detected nvx2 version: " + str(nvx2version))
+
+    # Create a numpy dtype matching the vertex components from the header,
+    # big endian data is swapped in bulk when unpacking
+    byteorder = get_byteorder(nvx2_header.magic)
+    vertex_dtype = make_vertexdtype(nvx2_header.vertex_components, nvx2version,
+                                    byteorder)
+    # Check if something was returned
+    if not vertex_dtype.names:
+        raise ValueError("Empty vertex format.")
+
+    # Check validity of vertex format, should be same size as header vertex_width*4
+    vertex_fmt_size = vertex_dtype.itemsize
+    if vertex_fmt_size != nvx2_header.vertex_width * 4:
+        raise ValueError("Invalid vertex format size " + str(vertex_fmt_size) +
+                         ", expected " + str(nvx2_header.vertex_width * 4))
+
+    # Read Vertex data (for ALL objects in the file)
+    vertex_data = np.frombuffer(f.read(vertex_fmt_size * nvx2_header.num_vertices),
+                                dtype=vertex_dtype)
+    nvx2_vertices, nvx2_uvlayers, nvx2_weights, nvx2_weight_idx, nvx2_colors = \
+        unpack_vertexdata_chunked(vertex_data, nvx2_header.vertex_components, nvx2version,
+                                  executor, num_threads)
+
+    # Read faces (for ALL objects in the file)
+    nvx2_faces = convert_indices(np.frombuffer(f.read(6 * nvx2_header.num_triangles),
+                                               dtype=byteorder + 'u2').reshape(-1, 3),
+                                 executor, num_threads)
+
+    # Read edges (for ALL objects in the file)
+    # Each edge is (face index 0, face index 1, vertex index 0, vertex index 1)
+    nvx2_edges = convert_indices(np.frombuffer(f.read(8 * nvx2_header.num_edges),
+                                               dtype=byteorder + 'u2').reshape(-1, 4)[:, 2:],
+                                 executor, num_threads)
+    return MeshData(header=nvx2_header,
+                    groups=nvx2_groups,
+                    version=nvx2version,
+                    vertices=nvx2_vertices,
+                    uvlayers=nvx2_uvlayers,
+                    weights=nvx2_weights,
+                    weight_indices=nvx2_weight_idx,
+                    colors=nvx2_colors,
+                    faces=nvx2_faces,
+                    edges=nvx2_edges)
+
+
+def get_vertex_layout(vertex_components, nvx2version=3):
+    """Return (component name, byte offset, struct format) for each vertex component."""
+    if nvx2version == 2:
+        vertex_components_data = VertexComponentsN2
+    else:
+        vertex_components_data = VertexComponentsN3
+    layout = []
+    offset = 0
+    for vcmask, vcdata in vertex_components_data.items():
+        if vcmask & vertex_components:
+            layout.append((vcmask.name, offset, vcdata.format))
+            offset += struct.calcsize('<' + vcdata.format)
+    return layout
+
+
+def get_export_components(nvx2version=3, use_compact=False, has_normals=False,
+                          num_uvlayers=0, has_colors=False, has_weights=False):
+    """Return the vertex component names for the available vertex data."""
+    compact = use_compact and nvx2version != 2
+    names = ['Coord']
+    if has_normals:
+        names.append('NormalUB4N' if compact else 'Normal')
+    for uv_idx in range(min(num_uvlayers, 4)):
+        names.append('Uv' + str(uv_idx) + ('S2' if compact else ''))
+    if has_colors:
+        names.append('ColorUB4N' if compact else 'Color')
+    if has_weights:
+        names.extend(['WeightsUB4N', 'JIndicesUB4'] if compact else ['Weights', 'JIndices'])
+    return names
+
+
+def quantize_values(name, values):
+    """Convert float values for storage in a vertex component."""
+    if name.endswith('S2'):
+        # Fixed point shorts, v is flipped
+        values = values.copy()
+        values[:, 1] = 1.0 - values[:, 1]
+        return np.clip(np.rint(values * 8191.0), -32768, 32767)
+    if name in ('NormalUB4N', 'TangentUB4N', 'BinormalUB4N'):
+        return np.clip(np.rint((values * 0.5 + 0.5) * 255.0), 0, 255)
+    if name.endswith('UB4N'):
+        return np.clip(np.rint(values * 255.0), 0, 255)
+    if name == 'JIndicesUB4':
+        return np.clip(np.rint(values), 0, 255)
+    if name == 'JIndices':
+        return np.rint(values)
+    return values
+
+
+def dequantize_values(name, values):
+    """Convert stored vertex component values back to floats, see quantize_values()."""
+    values = values.astype(np.float32)
+    if name.endswith('S2'):
+        values = values / 8191.0
+        values[:, 1] = 1.0 - values[:, 1]
+    elif name in ('NormalUB4N', 'TangentUB4N', 'BinormalUB4N'):
+        values = values / 255.0 * 2.0 - 1.0
+    elif name.endswith('UB4N'):
+        values = values / 255.0
+    return values
+
+
+def get_vertex_components(names, nvx2version=3):
+    """Build the vertex component mask from component names."""
+    if nvx2version == 2:
+        vertex_component_masks = VertexComponentMaskN2
+    else:
+        vertex_component_masks = VertexComponentMaskN3
+    vertex_components = 0
+    for name in names:
+        vertex_components |= vertex_component_masks[name]
+    return vertex_components
+
+
+def pack_vertices(components, nvx2version=3):
+    """Pack per vertex float arrays into a structured vertex array.
+
+    components maps vertex component names (e.g. 'Coord', 'Uv0S2') to arrays
+    with one row per vertex. Compact components are quantized the same way
+    they are decoded on import. Returns the vertex component mask and the array.
+    """
+    vertex_components = get_vertex_components(components, nvx2version)
+    vertex_dtype = make_vertexdtype(vertex_components, nvx2version)
+    num_vertices = len(next(iter(components.values())))
+    vertices = np.zeros(num_vertices, dtype=vertex_dtype)
+    for name, values in components.items():
+        values = np.asarray(values, dtype=np.float32).reshape(num_vertices, -1)
+        field_values = vertices[name]
+        width = min(values.shape[1], field_values.shape[1])
+        field_values[:, :width] = quantize_values(name, values[:, :width])
+    return vertex_components, vertices
+
+
+def build_edges(faces):
+    """Build the edge list of a triangle list.
+
+    Each edge is (face index 0, face index 1, vertex index 0, vertex index 1),
+    border edges use 0xFFFF as second face index.
+    """
+    num_faces = len(faces)
+    directed = faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2)
+    edge_faces = np.repeat(np.arange(num_faces, dtype=np.int64), 3)
+    # Identical edges are next to each other after sorting
+    _, first_idx, edge_idx, edge_count = np.unique(np.sort(directed, axis=1), axis=0,
+                                                  return_index=True,
+                                                  return_inverse=True,
+                                                  return_counts=True)
+    edge_idx = edge_idx.ravel()
+    order = np.argsort(edge_idx, kind='stable')
+    starts = np.cumsum(edge_count) - edge_count
+    second_faces = np.full(len(edge_count), 0xFFFF, dtype=np.int64)
+    is_shared = edge_count > 1
+    second_faces[is_shared] = edge_faces[order[starts[is_shared] + 1]]
+    # Keep the order edges appear in the face list
+    edge_order = np.argsort(first_idx, kind='stable')
+    return np.column_stack((edge_faces[first_idx],
+                            second_faces,
+                            directed[first_idx]))[edge_order]
+
+
+def write_file(filepath, vertex_components, vertices, faces, group_ranges, byteorder='<'):
+    """Write an nvx2 file.
+
+    vertices is a structured array from pack_vertices(), faces an (n, 3) array
+    of vertex indices into it and group_ranges a list of
+    (vertex_first, vertex_count, triangle_first, triangle_count) tuples.
+    Edges are built for each group. byteorder '>' writes a file for big
+    endian platforms. Raises ValueError if the data doesn't fit the file
+    format.
+    """
+    if len(vertices) > MAX_VERTICES:
+        raise ValueError("Too many vertices " + str(len(vertices)) +
+                         ", maximum is " + str(MAX_VERTICES))
+    if vertices.dtype.itemsize % 4:
+        raise ValueError("Vertex size must be a multiple of 4")
+
+    groups = []
+    edges = []
+    edge_first = 0
+    for vertex_first, vertex_count, triangle_first, triangle_count in group_ranges:
+        grp_edges = build_edges(faces[triangle_first:triangle_first+triangle_count])
+        # Face indices in edges are absolute
+        shared = grp_edges[:, 1] != 0xFFFF
+        grp_edges[:, 0] += triangle_first
+        grp_edges[shared, 1] += triangle_first
+        edges.append(grp_edges)
+        groups.append(Group(vertex_first, vertex_count, triangle_first, triangle_count,
+                            edge_first, len(grp_edges)))
+        edge_first += len(grp_edges)
+    edges = np.concatenate(edges) if edges else np.zeros((0, 4), dtype=np.int64)
+    if len(faces) > 0xFFFF:
+        # Edges reference faces, these have to fit into an ushort too
+        edges = np.zeros((0, 4), dtype=np.int64)
+        groups = [g._replace(edge_first=0, edge_count=0) for g in groups]
+
+    with open(filepath, mode='wb') as f:
+        f.write(MAGIC_BIG if byteorder == '>' else MAGIC)
+        f.write(struct.pack(byteorder + '6i', len(groups), len(vertices),
+                            vertices.dtype.itemsize // 4, len(faces), len(edges),
+                            vertex_components))
+        f.write(np.array(groups, dtype=byteorder + 'i4').tobytes())
+        f.write(vertices.astype(vertices.dtype.newbyteorder(byteorder)).tobytes())
+        f.write(np.asarray(faces, dtype=byteorder + 'u2').tobytes())
+        f.write(edges.astype(byteorder + 'u2').tobytes())
+
+
+def write_mesh_data(filepath, mesh_data, options: ExportOptions):
+    """Write decoded nvx2 data (MeshData, as returned on import) back to a file."""
+    uvlayers = []
+    if options.export_uvs:
+        uvlayers = [uvl for uvl in mesh_data.uvlayers if uvl is not None][:4]
+    has_weights = options.export_weights and mesh_data.weights is not None and \
+        mesh_data.weight_indices is not None
+    has_colors = options.export_colors and mesh_data.colors is not None
+    names = get_export_components(options.nvx2version, options.use_compact, False,
+                                  len(uvlayers), has_colors, has_weights)
+    arrays = [mesh_data.vertices] + uvlayers
+    if has_colors:
+        arrays.append(mesh_data.colors)
+    if has_weights:
+        arrays.extend([mesh_data.weights, mesh_data.weight_indices])
+    vertex_components, vertices = pack_vertices(dict(zip(names, arrays)),
+                                                options.nvx2version)
+    group_ranges = [(g.vertex_first, g.vertex_count, g.triangle_first, g.triangle_count)
+                    for g in mesh_data.groups]
+    write_file(filepath, vertex_components, vertices, mesh_data.faces, group_ranges,
+               options.byteorder)
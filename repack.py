@@ -0,0 +1,205 @@
+"""Rewrite nvx2 files with quantized vertex components
+
+Can be run without blender:
+    python repack.py [--components uv,normal,color,weights] [--max-error E]
+                     [--optimize-cache] (--output DIR | --in-place) PATH [PATH ...]
+Directories are searched recursively and processed on all cores.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sys
+
+import numpy as np
+
+if __package__:
+    from . import nvx2
+    from . import vertex_cache
+else:
+    # Run as a script, the add-on's __init__ needs blender
+    import nvx2
+    import vertex_cache
+
+
+# Command line names for groups of quantizable components
+COMPONENT_GROUPS = {'uv': ('Uv0', 'Uv1', 'Uv2', 'Uv3'),
+                    'normal': ('Normal',),
+                    'tangent': ('Tangent', 'Binormal'),
+                    'color': ('Color',),
+                    'weights': ('Weights',),
+                    'jindices': ('JIndices',)}
+
+
+def repack_vertices(vertices, nvx2version, names, max_error=None):
+    """Quantize the float components in names.
+
+    Components whose quantization error would exceed max_error stay floats.
+    Returns the new vertex component mask, vertices and the max. error per
+    quantized component.
+    """
+    new_names = []
+    new_values = {}
+    errors = {}
+    for name in vertices.dtype.names:
+        compact_name = nvx2.COMPACT_COMPONENTS.get(name)
+        if compact_name and name in names and compact_name not in vertices.dtype.names:
+            values = vertices[name].astype(np.float32)
+            width = values.shape[1]
+            # e.g. normals are 3 floats, but 4 bytes when compact
+            compact_data = nvx2.VertexComponentsN3[nvx2.VertexComponentMaskN3[compact_name]]
+            values = np.pad(values, ((0, 0), (0, compact_data.count - width)))
+            quantized = nvx2.quantize_values(compact_name, values)
+            error = float(np.max(np.abs(nvx2.dequantize_values(compact_name, quantized) -
+                                        values)[:, :width], initial=0.0))
+            if max_error is None or error <= max_error:
+                new_names.append(compact_name)
+                new_values[compact_name] = quantized
+                errors[name] = error
+                continue
+        # Copy as is
+        new_names.append(name)
+        new_values[name] = vertices[name]
+
+    vertex_components = nvx2.get_vertex_components(new_names, nvx2version)
+    new_vertices = np.zeros(len(vertices),
+                            dtype=nvx2.make_vertexdtype(vertex_components, nvx2version))
+    for name, values in new_values.items():
+        width = new_vertices[name].shape[1]
+        new_vertices[name] = values[:, :width]
+    return vertex_components, new_vertices, errors
+
+
+def repack_file(filepath, outpath, names, max_error=None, optimize_cache=False):
+    """Repack a single nvx2 file, returns a summary dict."""
+    try:
+        with open(filepath, mode='rb') as f:
+            header, groups = nvx2.read_header(f)
+            nvx2version = nvx2.detect_version(header.vertex_components,
+                                              header.vertex_width * 4)
+            byteorder = nvx2.get_byteorder(header.magic)
+            vertex_dtype = nvx2.make_vertexdtype(header.vertex_components, nvx2version,
+                                                 byteorder)
+            if vertex_dtype.itemsize != header.vertex_width * 4:
+                raise ValueError("Unknown vertex format")
+            vertices = np.frombuffer(f.read(vertex_dtype.itemsize * header.num_vertices),
+                                     dtype=vertex_dtype)
+            faces = np.frombuffer(f.read(6 * header.num_triangles),
+                                  dtype=byteorder + 'u2').reshape(-1, 3)
+            edges = np.frombuffer(f.read(8 * header.num_edges),
+                                  dtype=byteorder + 'u2').reshape(-1, 4)
+            remainder = f.read()
+    except (OSError, ValueError) as e:
+        return {"path": filepath, "error": str(e) or type(e).__name__}
+
+    errors = {}
+    vertex_components = header.vertex_components
+    if nvx2version != 2:
+        # Nebula 2 has no compact vertex components
+        vertex_components, vertices, errors = \
+            repack_vertices(vertices, nvx2version, names, max_error)
+
+    acmr = None
+    if optimize_cache:
+        group_ranges = [(g.vertex_first, g.vertex_count, g.triangle_first, g.triangle_count)
+                        for g in groups]
+        faces, vertex_order, tri_order, acmr_before, acmr_after = \
+            vertex_cache.optimize_groups(faces, len(vertices), group_ranges)
+        vertices = vertices[vertex_order]
+        edges = vertex_cache.remap_edges(edges, vertex_order, tri_order)
+        acmr = (acmr_before, acmr_after)
+
+    # Keep the byte order of the original file
+    new_header = header._replace(vertex_width=vertices.dtype.itemsize // 4,
+                                 vertex_components=vertex_components)
+    data = b''.join((new_header.magic,
+                     np.array(new_header[1:], dtype=byteorder + 'i4').tobytes(),
+                     np.array(groups, dtype=byteorder + 'i4').reshape(-1, 6).tobytes(),
+                     vertices.astype(vertices.dtype.newbyteorder(byteorder)).tobytes(),
+                     faces.astype(byteorder + 'u2').tobytes(),
+                     edges.astype(byteorder + 'u2').tobytes(),
+                     remainder))
+    old_size = os.path.getsize(filepath)
+    try:
+        os.makedirs(os.path.dirname(outpath) or '.', exist_ok=True)
+        with open(outpath, mode='wb') as f:
+            f.write(data)
+    except OSError as e:
+        return {"path": filepath, "error": str(e)}
+    return {"path": filepath,
+            "old_size": old_size,
+            "new_size": len(data),
+            "max_error": errors,
+            "acmr": acmr}
+
+
+def find_files(paths):
+    """Yield (path, relative path) of nvx2 files, directories are searched recursively."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path, os.path.basename(path)
+            continue
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                if filename.lower().endswith('.nvx2'):
+                    filepath = os.path.join(dirpath, filename)
+                    yield filepath, os.path.relpath(filepath, path)
+
+
+def main(argv=None):
+    """Command line entry point."""
+    argparser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argparser.add_argument("paths", nargs="+", help="nvx2 files or directories")
+    argparser.add_argument("--components", default="uv,normal,color,weights",
+                           help="Comma separated, any of " + ",".join(COMPONENT_GROUPS))
+    argparser.add_argument("--max-error", type=float, default=None,
+                           help="Keep components as float if quantizing exceeds this error")
+    output = argparser.add_mutually_exclusive_group(required=True)
+    output.add_argument("--output", help="Directory for the repacked files")
+    output.add_argument("--in-place", action="store_true", help="Overwrite the files")
+    argparser.add_argument("--optimize-cache", action="store_true",
+                           help="Reorder triangles and vertices for the vertex cache")
+    argparser.add_argument("--jobs", type=int, default=None,
+                           help="Number of worker processes")
+    args = argparser.parse_args(argv)
+
+    names = set()
+    for group_name in args.components.split(","):
+        if group_name.strip() not in COMPONENT_GROUPS:
+            argparser.error("Unknown component '" + group_name + "'")
+        names.update(COMPONENT_GROUPS[group_name.strip()])
+
+    files = list(find_files(args.paths))
+    outpaths = [filepath if args.in_place else os.path.join(args.output, relpath)
+                for filepath, relpath in files]
+    total_old = 0
+    total_new = 0
+    num_errors = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(repack_file, filepath, outpath, names, args.max_error,
+                                   args.optimize_cache)
+                   for (filepath, _), outpath in zip(files, outpaths)]
+        for future in futures:
+            result = future.result()
+            if "error" in result:
+                num_errors += 1
+                print(result["path"] + ": " + result["error"])
+                continue
+            total_old += result["old_size"]
+            total_new += result["new_size"]
+            print(result["path"] + ": " + str(result["old_size"]) + " -> " +
+                  str(result["new_size"]) + " bytes, max error " +
+                  ", ".join(name + "=" + format(error, ".6f")
+                            for name, error in result["max_error"].items()) +
+                  (", ACMR " + format(result["acmr"][0], ".3f") + " -> " +
+                   format(result["acmr"][1], ".3f") if result["acmr"] else ""))
+
+    if total_old:
+        print("Total: " + str(total_old) + " -> " + str(total_new) + " bytes (" +
+              format(100.0 * (total_new - total_old) / total_old, "+.1f") + "%), " +
+              str(num_errors) + " errors")
+    return 1 if num_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""Tests for the n3 parser, run with pytest (no blender needed)"""
+
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import n3  # noqa: E402
+
+
+class Reporter:
+    """Stand-in for a blender operator."""
+
+    def __init__(self):
+        self.reports = []
+
+
+    def report(self, rep_type, rep_msg):
+        self.reports.append((rep_type, rep_msg))
+
+
+def fourcc(code):
+    """FourCC as written by a little endian platform."""
+    return struct.pack('<I', int.from_bytes(code.encode('ascii'), 'big'))
+
+
+def string(value):
+    return struct.pack('<H', len(value)) + value.encode('ascii')
+
+
+def begin_node(name):
+    return fourcc('>MND') + fourcc('trfn') + string(name)
+
+
+def end_node():
+    return fourcc('<MND')
+
+
+def write_n3(path, body):
+    with open(path, 'wb') as f:
+        f.write(fourcc('NEB3') + struct.pack('<I', 2) +
+                fourcc('>MDL') + fourcc('trfm') + string("model") +
+                body + fourcc('<MDL'))
+
+
+def test_nested_siblings_get_their_parent(tmp_path):
+    # root > A, root > B > {C, D}, root > E
+    body = (begin_node("root") +
+            begin_node("A") + end_node() +
+            begin_node("B") +
+            begin_node("C") + end_node() +
+            begin_node("D") + end_node() +
+            end_node() +
+            begin_node("E") + end_node() +
+            end_node())
+    filepath = str(tmp_path / "nested.n3")
+    write_n3(filepath, body)
+
+    for skip_payload in (False, True):
+        parser = n3.Parser(Reporter(), n3.Options(), skip_payload=skip_payload)
+        assert parser.parse_file(filepath)
+        parents = {node.node_name: node.node_parent.node_name if node.node_parent else None
+                   for node in parser.n3node_list}
+        assert parents == {"root": None, "A": "root", "B": "root",
+                           "C": "B", "D": "B", "E": "root"}
+        children = {node.node_name: [child.node_name for child in node.node_children]
+                    for node in parser.n3node_list}
+        assert children["root"] == ["A", "B", "E"]
+        assert children["B"] == ["C", "D"]
+
+
+def test_unbalanced_end_node_is_an_error(tmp_path):
+    filepath = str(tmp_path / "unbalanced.n3")
+    write_n3(filepath, begin_node("root") + end_node() + end_node())
+    reporter = Reporter()
+    assert not n3.Parser(reporter, n3.Options()).parse_file(filepath)
+    assert any('ERROR' in rep_type for rep_type, _ in reporter.reports)
+
+
+def test_keep_resources_when_skipping_payloads(tmp_path, capsys):
+    body = (begin_node("root") +
+            fourcc('MESH') + string("msh:characters/body.nvx2") +
+            fourcc('PGRI') + struct.pack('<i', 1) +
+            fourcc('STXT') + string("DiffMap0") + string("tex:characters/body") +
+            end_node())
+    filepath = str(tmp_path / "resources.n3")
+    write_n3(filepath, body)
+
+    parser = n3.Parser(Reporter(), n3.Options(), skip_payload=True, keep_resources=True)
+    assert parser.parse_file(filepath)
+    node = parser.n3node_list[0]
+    assert node.mesh_ressource_id == "msh:characters/body.nvx2"
+    assert node.primitive_group_idx == 0  # skipped
+    assert dict(node.shader_textures) == {"DiffMap0": "tex:characters/body"}
+    assert capsys.readouterr().out == ""
+
+
+def test_tags_are_only_recorded_when_requested(tmp_path):
+    body = (begin_node("root") +
+            fourcc('MESH') + string("msh:characters/body.nvx2") +
+            fourcc('PGRI') + struct.pack('<i', 1) +
+            end_node())
+    filepath = str(tmp_path / "tags.n3")
+    write_n3(filepath, body)
+
+    parser = n3.Parser(Reporter(), n3.Options())
+    assert parser.parse_file(filepath)
+    assert parser.n3tags == []
+
+    for kwargs in ({'record_tags': True}, {'skip_payload': True}):
+        parser = n3.Parser(Reporter(), n3.Options(), **kwargs)
+        assert parser.parse_file(filepath)
+        assert [(tag.tag_4cc, tag.node_name) for tag in parser.n3tags] == \
+            [('MESH', "root"), ('PGRI', "root")]
+
+
+def test_default_containers_are_not_shared():
+    first = n3.Node("first", 'trfn')
+    second = n3.Node("second", 'trfn')
+    with pytest.raises(AttributeError):
+        first.joints.append(0, -1, [0.0] * 12, "root")
+    first.container('joints').append(0, -1, [0.0] * 12, "root")
+    assert len(first.joints) == 1
+    assert len(second.joints) == 0
+    assert second.joints.get_sorted_names() == []
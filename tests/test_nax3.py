@@ -0,0 +1,73 @@
+"""Tests for the nax3 clip table, run with pytest (no blender needed)"""
+
+import io
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import nax3  # noqa: E402
+
+
+def make_clip(byteorder, name, num_curves, startkey_idx, num_keys, key_stride, num_events):
+    """Nax3Clip field by field as in doc_nax.txt, name padded to 50 chars."""
+    return (struct.pack(byteorder + '5H', num_curves, startkey_idx, num_keys, key_stride, 40) +
+            struct.pack(byteorder + '2B', 1, 2) +
+            struct.pack(byteorder + 'H', num_events) +
+            name.encode('ascii').ljust(50, b'\0'))
+
+
+def make_event(byteorder, name, key_index):
+    return (name.encode('ascii').ljust(47, b'\0') + b"cat".ljust(15, b'\0') +
+            struct.pack(byteorder + 'H', key_index))
+
+
+def make_curve(byteorder, first_key_idx):
+    return (struct.pack(byteorder + 'I', first_key_idx) + bytes((1, 0, 2, 0)) +
+            struct.pack(byteorder + '4f', 1.0, 2.0, 3.0, 4.0))
+
+
+@pytest.mark.parametrize("byteorder", ['<', '>'])
+def test_clip_table_offsets(byteorder):
+    assert nax3.CLIP_SIZE == 64
+    magic = nax3.MAGIC if byteorder == '<' else nax3.MAGIC_BIG
+    clips = [("walk", 2, 0, 3, 2, 1), ("run", 3, 6, 2, 3, 2)]
+    num_keys = 12
+    data = magic + struct.pack(byteorder + '2I', len(clips), num_keys)
+    expected = {}
+    for name, num_curves, startkey_idx, clip_keys, key_stride, num_events in clips:
+        data += make_clip(byteorder, name, num_curves, startkey_idx, clip_keys, key_stride,
+                          num_events)
+        event_offset = len(data)
+        data += b''.join(make_event(byteorder, name + "_event", i) for i in range(num_events))
+        curve_offset = len(data)
+        data += b''.join(make_curve(byteorder, i) for i in range(num_curves))
+        expected[name] = (event_offset, curve_offset, startkey_idx, clip_keys * key_stride)
+    key_offset = len(data)
+    data += struct.pack(byteorder + str(num_keys * 4) + 'f', *range(num_keys * 4))
+
+    header, table_key_offset, clip_table = nax3.build_clip_table(io.BytesIO(data))
+    assert header.num_clips == len(clips)
+    assert header.num_keys == num_keys
+    assert table_key_offset == key_offset
+    assert list(clip_table) == ["walk", "run"]
+    for name, (event_offset, curve_offset, key_first, key_count) in expected.items():
+        entry = clip_table[name]
+        assert (entry.event_offset, entry.curve_offset, entry.key_first, entry.key_count) == \
+            (event_offset, curve_offset, key_first, key_count)
+        assert entry.clip.pre_infinity_type == 1
+        assert entry.clip.post_infinity_type == 2
+
+    # Events and curves are found at the recorded offsets
+    entry = clip_table["run"]
+    event = nax3.Event._make(struct.unpack(nax3.with_byteorder(nax3.EVENT_FMT, byteorder),
+                                           data[entry.event_offset:
+                                                entry.event_offset + nax3.EVENT_SIZE]))
+    assert event.event_name.rstrip(b'\0') == b"run_event"
+    curve = nax3.CurveRaw._make(struct.unpack(nax3.with_byteorder(nax3.CURVE_FMT, byteorder),
+                                              data[entry.curve_offset:
+                                                   entry.curve_offset + nax3.CURVE_SIZE]))
+    assert (curve.curve_type, curve.key_w) == (2, 4.0)
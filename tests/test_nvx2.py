@@ -0,0 +1,63 @@
+"""Tests for nvx2 decoding, run with pytest (no blender needed)"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import nvx2  # noqa: E402
+
+
+@pytest.mark.parametrize("num_items, num_threads, chunks", [
+    (0, 4, []),
+    (1000, 4, [(0, 1000)]),
+    (60000, 1, [(0, 60000)]),
+    (60000, 4, [(0, 15360), (15360, 30720), (30720, 46080), (46080, 60000)]),
+    (10000, 8, [(0, 4096), (4096, 8192), (8192, 10000)]),
+])
+def test_get_chunks(num_items, num_threads, chunks):
+    assert nvx2.get_chunks(num_items, num_threads) == chunks
+
+
+@pytest.mark.parametrize("byteorder", ['<', '>'])
+def test_read_file_threads_identical(tmp_path, byteorder):
+    """Decoding on several threads gives the same arrays as on a single thread."""
+    rng = np.random.default_rng(7)
+    num_vertices = 60000
+    num_triangles = 100000
+    vertex_components, vertices = nvx2.pack_vertices({
+        'Coord': rng.uniform(-10.0, 10.0, (num_vertices, 3)),
+        'Uv0S2': rng.uniform(-1.0, 2.0, (num_vertices, 2)),
+        'Uv1': rng.uniform(0.0, 1.0, (num_vertices, 2)),
+        'ColorUB4N': rng.uniform(0.0, 1.0, (num_vertices, 4)),
+        'WeightsUB4N': rng.uniform(0.0, 1.0, (num_vertices, 4)),
+        'JIndicesUB4': rng.integers(0, 60, (num_vertices, 4)),
+    })
+    faces = rng.integers(0, num_vertices, (num_triangles, 3))
+    filepath = str(tmp_path / "mesh.nvx2")
+    nvx2.write_file(filepath, vertex_components, vertices, faces,
+                    [(0, num_vertices, 0, num_triangles)], byteorder)
+
+    # The vertices have to be split, otherwise the threaded path isn't tested
+    assert len(nvx2.get_chunks(num_vertices, 4)) > 1
+
+    single = nvx2.read_file(filepath, 3, num_threads=1)
+    threaded = nvx2.read_file(filepath, 3, num_threads=4)
+
+    def flatten(mesh_data):
+        return ([mesh_data.vertices] + list(mesh_data.uvlayers) +
+                [mesh_data.weights, mesh_data.weight_indices, mesh_data.colors,
+                 mesh_data.faces, mesh_data.edges])
+
+    for expected, actual in zip(flatten(single), flatten(threaded)):
+        if expected is None:
+            assert actual is None
+            continue
+        assert actual.dtype == expected.dtype
+        assert actual.tobytes() == expected.tobytes()
+    assert single.uvlayers[2] is None
+    assert single.faces.shape == (num_triangles, 3)
+    assert np.array_equal(single.faces, faces)
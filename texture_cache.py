@@ -0,0 +1,157 @@
+"""Keep track of the memory used by imported textures"""
+
+import collections
+import struct
+from dataclasses import dataclass
+
+
+@dataclass
+class CacheEntry:
+    """A cached image and the memory its decoded pixels take."""
+    image: object
+    filepath: str = ""
+    num_bytes: int = 0
+    loaded: bool = True
+
+
+def get_file_memory(filepath):
+    """Estimate the decoded size of an image file from its header, 0 if unknown.
+
+    Only dds and png headers are read, pixels are assumed to be 8 bit RGBA.
+    """
+    try:
+        with open(filepath, mode='rb') as f:
+            header = f.read(24)
+    except OSError:
+        return 0
+    if len(header) < 24:
+        return 0
+    if header[:4] == b'DDS ':
+        height, width = struct.unpack('<2I', header[12:20])
+    elif header[:8] == b'\x89PNG\r\n\x1a\n':
+        width, height = struct.unpack('>2I', header[16:24])
+    else:
+        return 0
+    return width * height * 4
+
+
+def get_image_memory(image, filepath=""):
+    """Memory of the decoded pixels of a blender image in bytes.
+
+    image.size would decode the image, so it is only used for images which are
+    loaded already, others are estimated from the file header.
+    """
+    if image.has_data:
+        width, height = image.size
+        bytes_per_channel = 4 if image.is_float else 1
+        return width * height * image.channels * bytes_per_channel
+    return get_file_memory(filepath)
+
+
+class TextureCache:
+    """Images shared across imports, keyed by image, found by resolved file path.
+
+    When the decoded pixels of all images exceed the memory budget, the least
+    recently used images are unloaded. They stay in the blend file (materials
+    still use them) and blender reloads them from disk when they are needed.
+    """
+
+    def __init__(self, budget=0):
+        self.budget = budget  # in bytes, 0 is unlimited
+        self.entries = collections.OrderedDict()  # image pointer => CacheEntry
+        self.paths = {}  # file path => image pointer of the last image loaded from it
+        self.used = 0
+
+
+    def get(self, filepath):
+        """Return the image loaded from filepath or None, marks it as recently used."""
+        key = self.paths.get(filepath)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.paths.pop(filepath, None)
+            return None
+        if not self.is_valid(key, entry):
+            return None
+        self.touch(key, entry)
+        return entry.image
+
+
+    def add(self, image, filepath=""):
+        """Track a loaded or reused image, may unload older ones.
+
+        Images already tracked are only marked as recently used.
+        """
+        key = image.as_pointer()
+        entry = self.entries.get(key)
+        if entry is not None and self.is_valid(key, entry):
+            if filepath:
+                entry.filepath = entry.filepath or filepath
+                self.paths[filepath] = key
+            self.touch(key, entry)
+            return
+        entry = CacheEntry(image, filepath, get_image_memory(image, filepath))
+        self.entries[key] = entry
+        if filepath:
+            self.paths[filepath] = key
+        self.used += entry.num_bytes
+        self.trim()
+
+
+    def touch(self, key, entry):
+        """Mark an entry as recently used, images will be decoded again when used."""
+        self.entries.move_to_end(key)
+        if not entry.loaded:
+            entry.loaded = True
+            self.used += entry.num_bytes
+            self.trim()
+
+
+    def is_valid(self, key, entry):
+        """Check that the image wasn't deleted, stops tracking it otherwise."""
+        try:
+            entry.image.name
+        except ReferenceError:
+            self.remove(key)
+            return False
+        return True
+
+
+    def remove(self, key):
+        """Stop tracking an image."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        if self.paths.get(entry.filepath) == key:
+            del self.paths[entry.filepath]
+        if entry.loaded:
+            self.used -= entry.num_bytes
+
+
+    def trim(self):
+        """Unload least recently used images until the budget is met.
+
+        The most recently used image is never unloaded, even if it is larger
+        than the budget on its own.
+        """
+        if not self.budget:
+            return
+        for key, entry in list(self.entries.items())[:-1]:
+            if self.used <= self.budget:
+                break
+            if not entry.loaded:
+                continue
+            try:
+                entry.image.gl_free()
+                entry.image.buffers_free()
+            except ReferenceError:
+                self.remove(key)
+                continue
+            entry.loaded = False
+            self.used -= entry.num_bytes
+
+
+    def clear(self):
+        """Forget all images, they aren't unloaded."""
+        self.entries.clear()
+        self.paths.clear()
+        self.used = 0
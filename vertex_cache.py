@@ -0,0 +1,149 @@
+"""Reorder triangles and vertices for the GPU's post-transform vertex cache"""
+
+import numpy as np
+
+
+# Simulated FIFO cache size, used for optimizing and reporting
+CACHE_SIZE = 32
+
+
+def compute_acmr(faces, cache_size=CACHE_SIZE):
+    """Average cache miss ratio (transformed vertices per triangle) with a FIFO cache."""
+    num_faces = len(faces)
+    if not num_faces:
+        return 0.0
+    flat = np.asarray(faces).ravel()
+    # A vertex is cached if less than cache_size misses happened since it was loaded
+    loaded_at = dict()
+    num_misses = 0
+    for v in flat.tolist():
+        if num_misses - loaded_at.get(v, -cache_size) >= cache_size:
+            loaded_at[v] = num_misses
+            num_misses += 1
+    return num_misses / num_faces
+
+
+def optimize_triangle_order(faces, num_vertices, cache_size=CACHE_SIZE):
+    """Reorder triangles for vertex cache locality (Tipsify, Sander et al. 2007).
+
+    Runs in linear time. Returns the new triangle order as index array.
+    """
+    num_faces = len(faces)
+    if not num_faces:
+        return np.zeros(0, dtype=np.int64)
+    flat = np.asarray(faces).ravel()
+    # Vertex to triangle adjacency
+    adjacency_order = np.argsort(flat, kind='stable') // 3
+    adjacency_start = np.zeros(num_vertices + 1, dtype=np.int64)
+    np.cumsum(np.bincount(flat, minlength=num_vertices), out=adjacency_start[1:])
+    adjacency = adjacency_order.tolist()
+    adjacency_start = adjacency_start.tolist()
+
+    tri_vertices = np.asarray(faces).tolist()
+    live = np.bincount(flat, minlength=num_vertices).tolist()
+    timestamps = [0] * num_vertices
+    emitted = [False] * num_faces
+    dead_end = []
+    tri_order = []
+
+    time = cache_size + 1
+    cursor = 0
+    fan_vertex = int(flat[0])
+    while fan_vertex >= 0:
+        candidates = []
+        for t in adjacency[adjacency_start[fan_vertex]:adjacency_start[fan_vertex + 1]]:
+            if emitted[t]:
+                continue
+            for v in tri_vertices[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - timestamps[v] > cache_size:
+                    timestamps[v] = time
+                    time += 1
+            emitted[t] = True
+            tri_order.append(t)
+
+        # Prefer candidates still in the cache, with few remaining triangles
+        fan_vertex = -1
+        best_priority = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - timestamps[v] + 2 * live[v] <= cache_size:
+                    priority = time - timestamps[v]
+                if priority > best_priority:
+                    best_priority = priority
+                    fan_vertex = v
+        if fan_vertex < 0:
+            # Dead end, try recently used vertices first, then any vertex left
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fan_vertex = v
+                    break
+            while fan_vertex < 0 and cursor < num_vertices:
+                if live[cursor] > 0:
+                    fan_vertex = cursor
+                cursor += 1
+    return np.array(tri_order, dtype=np.int64)
+
+
+def optimize_vertex_order(faces, num_vertices):
+    """Renumber vertices in the order of first use, for vertex fetch locality.
+
+    Unused vertices are moved to the end. Returns the new faces and, for each
+    new vertex, the index of the old one.
+    """
+    flat = np.asarray(faces).ravel()
+    used, first_use = np.unique(flat, return_index=True)
+    unused = np.setdiff1d(np.arange(num_vertices), used)
+    vertex_order = np.concatenate((used[np.argsort(first_use)], unused))
+    new_index = np.empty(num_vertices, dtype=np.int64)
+    new_index[vertex_order] = np.arange(num_vertices)
+    return new_index[flat].reshape(-1, 3), vertex_order
+
+
+def optimize_groups(faces, num_vertices, group_ranges, cache_size=CACHE_SIZE):
+    """Optimize triangle and vertex order of each group separately.
+
+    group_ranges are (vertex_first, vertex_count, triangle_first, triangle_count)
+    tuples, faces use absolute vertex indices. Returns the new faces, the old
+    index for each new vertex and for each new triangle, and the ACMR before
+    and after.
+    """
+    faces = np.asarray(faces, dtype=np.int64)
+    new_faces = faces.copy()
+    vertex_order = np.arange(num_vertices)
+    tri_order = np.arange(len(faces))
+    for vertex_first, vertex_count, triangle_first, triangle_count in group_ranges:
+        grp_faces = faces[triangle_first:triangle_first+triangle_count] - vertex_first
+        if grp_faces.size and (grp_faces.min() < 0 or grp_faces.max() >= vertex_count):
+            # Triangles reference vertices of other groups, leave as is
+            continue
+        grp_tri_order = optimize_triangle_order(grp_faces, vertex_count, cache_size)
+        grp_faces, grp_vertex_order = optimize_vertex_order(grp_faces[grp_tri_order],
+                                                            vertex_count)
+        new_faces[triangle_first:triangle_first+triangle_count] = grp_faces + vertex_first
+        tri_order[triangle_first:triangle_first+triangle_count] = \
+            grp_tri_order + triangle_first
+        vertex_order[vertex_first:vertex_first+vertex_count] = \
+            grp_vertex_order + vertex_first
+    return (new_faces, vertex_order, tri_order,
+            compute_acmr(faces, cache_size), compute_acmr(new_faces, cache_size))
+
+
+def remap_edges(edges, vertex_order, tri_order):
+    """Update (face 0, face 1, vertex 0, vertex 1) edges after reordering."""
+    new_vertex_index = np.empty(len(vertex_order), dtype=np.int64)
+    new_vertex_index[vertex_order] = np.arange(len(vertex_order))
+    new_tri_index = np.empty(len(tri_order), dtype=np.int64)
+    new_tri_index[tri_order] = np.arange(len(tri_order))
+    edges = np.array(edges, dtype=np.int64)
+    for col in (0, 1):
+        # Border edges have no second face
+        has_face = edges[:, col] < len(tri_order)
+        edges[has_face, col] = new_tri_index[edges[has_face, col]]
+    has_vertex = edges[:, 2:] < len(vertex_order)
+    edges[:, 2:][has_vertex] = new_vertex_index[edges[:, 2:][has_vertex]]
+    return edges